@@ -0,0 +1,4 @@
+""" Benchmarks of the application, run from the repository root, eg:
+
+    python -m benchmarks.query_plans
+"""
@@ -0,0 +1,104 @@
+""" Synthetic data sets for the benchmarks
+
+The data set mimics the production one: markets made of branches,
+branches made of agents offering some of the services,
+and a grid of hourly appointments for every agent.
+"""
+
+import random
+from datetime import datetime, time, timedelta
+from my_app import app
+from my_app.data_model import db, Role, User, Branch, Market, Services
+from my_app.data_model import Appointment, roles_users, users_services
+from my_app.availability import rebuild_availability
+
+SERVICES = ['Deposit Account', 'Credit Card', 'Other',
+            'Mortgage - new', 'Mortgage - refinance']
+TIME_ZONES = ['Pacific/Honolulu', 'Pacific/Guam']
+HOURS = range(8, 16)
+
+def use_database(path):
+    """ Points the application to a SQLite database file
+    and recreates all the tables.
+    """
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+    db.drop_all()
+    db.create_all()
+
+def seed_dataset(markets=2, branches=4, agents=5, days=15,
+                 booked_ratio=0.2, tbd_ratio=0.1, seed=0, password=None):
+    """ Inserts a synthetic data set with bulk inserts and returns a summary.
+    branches is the number of branches per market,
+    agents the number of agents per branch,
+    days the number of days of appointments, starting today,
+    password the hashed password of every agent, if they have to log in.
+    """
+    generator = random.Random(seed)
+    today = datetime.today().date()
+    db.session.execute(Role.__table__.insert(), [
+        {'id': 1, 'name': 'admin', 'description': 'Administrator'},
+        {'id': 2, 'name': 'end-user', 'description': 'End user'},
+        {'id': 3, 'name': 'manager', 'description': 'Manager'}])
+    db.session.execute(Services.__table__.insert(), [
+        {'id': i + 1, 'name': name} for i, name in enumerate(SERVICES)])
+    market_rows, branch_rows, user_rows = [], [], []
+    role_rows, service_rows, appointment_rows = [], [], []
+    phones = []
+    for market_id in range(1, markets + 1):
+        market_rows.append({'id': market_id, 'name': 'Market %s' % market_id})
+        for b in range(branches):
+            branch_id = len(branch_rows) + 1
+            branch_rows.append({
+                'id': branch_id,
+                'name': 'Branch %s' % branch_id,
+                'address': '%s Main Street' % branch_id,
+                'time_zone': TIME_ZONES[(market_id - 1) % len(TIME_ZONES)],
+                'market_id': market_id})
+            for a in range(agents):
+                user_id = len(user_rows) + 1
+                user_rows.append({
+                    'id': user_id,
+                    'email': 'agent%s@example.com' % user_id,
+                    'active': True,
+                    'name': 'Agent %s' % user_id,
+                    'password': password,
+                    'branch_id': branch_id})
+                role_rows.append({'user_id': user_id, 'role_id': 2})
+                offered = generator.sample(range(1, len(SERVICES) + 1), 3)
+                service_rows.extend({'user_id': user_id, 'services_id': s}
+                                    for s in offered)
+                for day in range(days):
+                    for hour in HOURS:
+                        draw = generator.random()
+                        row = {'user_id': user_id,
+                               'date': today + timedelta(days=day),
+                               'time': time(hour, 0),
+                               'bookable_booked': 'bookable',
+                               'topic': 'topic',
+                               'booked_at': None,
+                               'booked_by_name': None,
+                               'booked_by_phone': None}
+                        if draw < booked_ratio:
+                            phone = '+1808%07d' % len(phones)
+                            phones.append(phone)
+                            row.update(bookable_booked='booked',
+                                       topic=SERVICES[offered[0] - 1],
+                                       booked_at=datetime.now(),
+                                       booked_by_name='Customer',
+                                       booked_by_phone=phone)
+                        elif draw < booked_ratio + tbd_ratio:
+                            row['bookable_booked'] = 'tbd'
+                        appointment_rows.append(row)
+    db.session.execute(Market.__table__.insert(), market_rows)
+    db.session.execute(Branch.__table__.insert(), branch_rows)
+    db.session.execute(User.__table__.insert(), user_rows)
+    db.session.execute(roles_users.insert(), role_rows)
+    db.session.execute(users_services.insert(), service_rows)
+    db.session.execute(Appointment.__table__.insert(), appointment_rows)
+    db.session.commit()
+    rebuild_availability()
+    return {'markets': len(market_rows),
+            'branches': len(branch_rows),
+            'agents': len(user_rows),
+            'appointments': len(appointment_rows),
+            'phones': phones}
@@ -0,0 +1,281 @@
+""" Load test of the booking funnel and of the agents' calendars
+
+Seeds a synthetic data set (see dataset.py), then runs concurrent
+virtual users, each in its own thread:
+- customers go through /, /where, /when and /book, and book
+  one appointment out of book_ratio,
+- agents log in, then load and update their calendar on /profile.
+Prints, per endpoint, the latency percentiles and the number of queries
+per request, as reported by the Server-Timing header (see
+my_app/instrumentation.py), then the CPU time of the process
+per request. Text messages and invites go to the stub
+transport: nothing leaves the machine.
+
+    python -m benchmarks.funnel --customers 20 --agents-online 5
+    python -m benchmarks.funnel --server   # through a local WSGI server
+    python -m benchmarks.funnel --engine bitmap   # see my_app/bitmap.py
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from urllib import quote
+from flask_security import utils
+from my_app import app
+from my_app.data_model import db, Appointment, User, Branch, Market
+from my_app.data_model import Services
+from my_app.availability import rebuild_availability
+from my_app.bitmap import convert_slots
+from benchmarks.dataset import use_database, seed_dataset
+
+PASSWORD = 'pwd'
+
+############################# Clients #########################################
+
+class TestClient(object):
+    """ Sends the requests through the Flask test client, in process."""
+    def __init__(self):
+        self.client = app.test_client()
+
+    def open(self, method, path, data=None, headers=None):
+        response = self.client.open(path, method=method, data=data,
+                                    headers=headers)
+        return response.status_code, response.headers.get('Server-Timing')
+
+class HttpClient(object):
+    """ Sends the requests to a server over HTTP."""
+    def __init__(self, base_url):
+        import requests
+        self.base_url = base_url
+        self.session = requests.Session()
+
+    def open(self, method, path, data=None, headers=None):
+        response = self.session.request(method, self.base_url + path,
+                                        data=data, headers=headers,
+                                        allow_redirects=False)
+        return response.status_code, response.headers.get('Server-Timing')
+
+def start_server():
+    """ Serves the application from a local threaded WSGI server
+    and returns its base URL.
+    """
+    from werkzeug.serving import make_server
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return 'http://127.0.0.1:%s' % server.server_port
+
+############################# Measures ########################################
+
+def server_queries(server_timing):
+    """ Returns the number of queries reported by a Server-Timing header."""
+    match = re.search(r'desc="(\d+) queries"', server_timing or '')
+    return int(match.group(1)) if match else None
+
+def percentile(values, fraction):
+    """ Returns the nearest-rank percentile of a list of numbers."""
+    ordered = sorted(values)
+    index = max(int(round(fraction * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(index, len(ordered) - 1)]
+
+class Stats(object):
+    """ Latencies and queries of the requests, per endpoint."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.seconds = defaultdict(list)
+        self.queries = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def timed(self, client, endpoint, method, path, data=None, headers=None):
+        start = time.time()
+        status, server_timing = client.open(method, path, data, headers)
+        seconds = time.time() - start
+        with self._lock:
+            self.seconds[endpoint].append(seconds)
+            queries = server_queries(server_timing)
+            if queries is not None:
+                self.queries[endpoint].append(queries)
+            if status >= 400:
+                self.errors[endpoint] += 1
+        return status
+
+    def report(self, elapsed, cpu_seconds=None):
+        lines = ['%-14s %8s %6s %8s %8s %8s %9s' % (
+            'endpoint', 'requests', 'errors', 'p50 ms', 'p95 ms', 'p99 ms',
+            'queries')]
+        total = 0
+        for endpoint in sorted(self.seconds):
+            seconds = self.seconds[endpoint]
+            queries = self.queries[endpoint]
+            total += len(seconds)
+            lines.append('%-14s %8s %6s %8.1f %8.1f %8.1f %9.1f' % (
+                endpoint, len(seconds), self.errors[endpoint],
+                1000 * percentile(seconds, 0.50),
+                1000 * percentile(seconds, 0.95),
+                1000 * percentile(seconds, 0.99),
+                float(sum(queries)) / max(len(queries), 1)))
+        lines.append('%s requests in %.1fs: %.1f requests/s'
+                     % (total, elapsed, total / max(elapsed, 0.001)))
+        if cpu_seconds is not None:
+            # the clients run in the same process: this is an upper bound
+            lines.append('%.2f ms of CPU per request'
+                         % (1000 * cpu_seconds / max(total, 1)))
+        return '\n'.join(lines)
+
+############################# Virtual users ###################################
+
+def bookable_slots():
+    """ Returns the bookable appointments of the coming days as
+    (user_id, date, time, service, market) tuples.
+    """
+    tomorrow = datetime.today().date() + timedelta(days=1)
+    return (db.session.query(Appointment.user_id, Appointment.date,
+                             Appointment.time, Services.name, Market.name)
+            .join(User, Appointment.user_id == User.id)
+            .join(User.services)
+            .join(Branch, User.branch_id == Branch.id)
+            .join(Market, Branch.market_id == Market.id)
+            .filter(Appointment.bookable_booked == 'bookable')
+            .filter(Appointment.date >= tomorrow)
+            .all())
+
+def customer(client, stats, slots, iterations, book_ratio, number, seed):
+    """ Goes through the funnel iterations times, starting from
+    a random bookable slot, and books it book_ratio of the time.
+    """
+    generator = random.Random(seed)
+    for iteration in range(iterations):
+        user_id, day, hour, what, where = generator.choice(slots)
+        when = day.strftime('%Y-%m-%d')
+        path = '/%s' % quote(what)
+        stats.timed(client, 'search_what', 'GET', '/')
+        stats.timed(client, 'search_where', 'GET', '/where' + path)
+        path += '/%s' % quote(where)
+        stats.timed(client, 'search_when', 'GET', '/when' + path)
+        path += '/%s' % when
+        stats.timed(client, 'book GET', 'GET', '/book' + path)
+        if generator.random() < book_ratio:
+            stats.timed(client, 'book POST', 'POST', '/book' + path, data={
+                'wtf_phone': '555%03d%04d' % (number, iteration),
+                'wtf_user_id': user_id,
+                'wtf_time': datetime.combine(day, hour)
+                            .strftime('%Y-%m-%d-%H:%M:%S'),
+                'wtf_date': when,
+                'wtf_topic': what,
+                'wtf_name': 'Customer %s' % number})
+
+def agent(client, stats, user_id, days, iterations, seed):
+    """ Logs in, then loads the calendar and switches one slot
+    to not bookable and back, iterations times.
+    """
+    generator = random.Random(seed)
+    client.open('POST', '/login', data={
+        'email': 'agent%s@example.com' % user_id, 'password': PASSWORD})
+    headers = {'Accept': 'application/json'}
+    for _ in range(iterations):
+        stats.timed(client, 'profile GET', 'GET', '/profile')
+        day = datetime.today().date() + timedelta(
+            days=generator.randint(1, days - 1))
+        item = {'user_id': user_id, 'date': day.strftime('%Y-%m-%d'),
+                'time': '%02d:00:00' % generator.randint(8, 15)}
+        for status in ('bookable', 'tbd'):
+            item['status'] = status
+            stats.timed(client, 'profile POST', 'POST', '/profile',
+                        data={'submit_check_val': json.dumps([item])},
+                        headers=headers)
+
+def cpu_time():
+    """ Returns the user and system CPU time of the process, in seconds."""
+    times = os.times()
+    return times[0] + times[1]
+
+def run(options):
+    """ Seeds the data set, runs the virtual users and returns the stats,
+    the elapsed time and the CPU time used meanwhile.
+    """
+    app.config.update(TESTING=True, WTF_CSRF_ENABLED=False,
+                      NOTIFICATION_TRANSPORT='stub',
+                      OUTBOX_DISPATCH='inline')
+    with app.app_context():
+        summary = seed_dataset(markets=options.markets,
+                               branches=options.branches,
+                               agents=options.agents,
+                               days=options.days,
+                               password=utils.encrypt_password(PASSWORD))
+        print('%(agents)s agents, %(appointments)s appointments' % summary)
+        slots = bookable_slots()
+        if options.engine == 'bitmap':
+            report = convert_slots('bitmap')
+            print('bitmap engine: %(agent_days)s agent-days, '
+                  '%(appointments_removed)s appointments removed' % report)
+            app.config['AVAILABILITY_ENGINE'] = 'bitmap'
+            rebuild_availability()
+        db.session.remove()
+    if options.server:
+        base_url = start_server()
+        new_client = lambda: HttpClient(base_url)
+    else:
+        new_client = TestClient
+    stats = Stats()
+    threads = []
+    for number in range(options.customers):
+        threads.append(threading.Thread(target=customer, args=(
+            new_client(), stats, slots, options.iterations,
+            options.book_ratio, number, number)))
+    agent_ids = random.Random(0).sample(
+        range(1, summary['agents'] + 1),
+        min(options.agents_online, summary['agents']))
+    for user_id in agent_ids:
+        threads.append(threading.Thread(target=agent, args=(
+            new_client(), stats, user_id, options.days, options.iterations,
+            user_id)))
+    start = time.time()
+    start_cpu = cpu_time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return stats, time.time() - start, cpu_time() - start_cpu
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--markets', type=int, default=2)
+    parser.add_argument('--branches', type=int, default=4)
+    parser.add_argument('--agents', type=int, default=5,
+                        help='agents per branch')
+    parser.add_argument('--days', type=int, default=15)
+    parser.add_argument('--customers', type=int, default=20,
+                        help='concurrent virtual customers')
+    parser.add_argument('--agents-online', type=int, default=5,
+                        help='concurrent virtual agents')
+    parser.add_argument('--iterations', type=int, default=10,
+                        help='funnel runs per customer, '
+                             'calendar updates per agent')
+    parser.add_argument('--book-ratio', type=float, default=0.2)
+    parser.add_argument('--server', action='store_true',
+                        help='send the requests to a local WSGI server '
+                             'instead of the Flask test client')
+    parser.add_argument('--engine', choices=['rows', 'bitmap'],
+                        default='rows',
+                        help='how the slots are stored, see my_app/bitmap.py')
+    options = parser.parse_args()
+    handle, path = tempfile.mkstemp(suffix='.db')
+    os.close(handle)
+    try:
+        with app.app_context():
+            use_database(path)
+        stats, elapsed, cpu_seconds = run(options)
+        print(stats.report(elapsed, cpu_seconds))
+    finally:
+        os.remove(path)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+""" Shows the query plans and timings of the booking funnel queries
+on a database without the indexes of the data model, then after
+migrations.upgrade() created them. The cache of the funnel queries is
+disabled, so that every call reaches the database.
+
+    python -m benchmarks.query_plans --agents 20 --days 15
+"""
+
+import argparse
+import os
+import tempfile
+import timeit
+from datetime import datetime, timedelta
+from sqlalchemy import event
+from my_app import app
+from my_app import crud
+from my_app.data_model import db
+from my_app.migrations import upgrade
+from benchmarks.dataset import SERVICES, use_database, seed_dataset
+
+def funnel_calls(user_id, phone):
+    """ Returns the (name, function, arguments) of the queries to study."""
+    what = SERVICES[0]
+    where = 'Market 1'
+    when = (datetime.today() + timedelta(days=3)).strftime('%Y-%m-%d')
+    return [
+        ('query_available_services', crud.query_available_services, (10,)),
+        ('query_available_markets', crud.query_available_markets,
+            (10, what)),
+        ('query_available_days', crud.query_available_days,
+            (what, where, 10)),
+        ('query_market_appointments', crud.query_market_appointments,
+            (what, where, when)),
+        ('query_user_appointment', crud.query_user_appointment, (user_id,)),
+        ('phone_has_appointment', crud.phone_has_appointment, (phone,)),
+    ]
+
+def capture_selects(function, args):
+    """ Runs the function and returns the SELECT statements it sent."""
+    statements = []
+    def collect(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+    event.listen(db.engine, 'before_cursor_execute', collect)
+    try:
+        function(*args)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', collect)
+        db.session.rollback()
+    return [(statement, parameters) for statement, parameters in statements
+            if statement.lstrip().upper().startswith('SELECT')]
+
+def explain(statement, parameters):
+    """ Returns the query plan of a statement as a list of lines."""
+    if db.engine.dialect.name == 'sqlite':
+        rows = db.engine.execute('EXPLAIN QUERY PLAN ' + statement,
+                                 parameters).fetchall()
+        return [row[-1] for row in rows]
+    rows = db.engine.execute('EXPLAIN ' + statement, parameters).fetchall()
+    return [' | '.join(str(column) for column in row) for row in rows]
+
+def report(calls, repeat):
+    """ Returns the plans and mean time (ms) of every call."""
+    results = {}
+    for name, function, args in calls:
+        plans = [explain(statement, parameters) for statement, parameters
+                 in capture_selects(function, args)]
+        seconds = timeit.timeit(lambda: function(*args), number=repeat)
+        db.session.rollback()
+        results[name] = (plans, 1000.0 * seconds / repeat)
+    return results
+
+def drop_indexes():
+    """ Drops the indexes of the data model, as in an old database."""
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.drop(bind=db.engine)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--markets', type=int, default=2)
+    parser.add_argument('--branches', type=int, default=4)
+    parser.add_argument('--agents', type=int, default=20)
+    parser.add_argument('--days', type=int, default=15)
+    parser.add_argument('--repeat', type=int, default=20)
+    options = parser.parse_args()
+    handle, path = tempfile.mkstemp(suffix='.db')
+    os.close(handle)
+    # the memoized funnel queries would be timed as cache hits
+    app.config['CACHE_DISABLED'] = True
+    try:
+        with app.app_context():
+            use_database(path)
+            drop_indexes()
+            summary = seed_dataset(markets=options.markets,
+                                   branches=options.branches,
+                                   agents=options.agents,
+                                   days=options.days)
+            print('%(agents)s agents, %(appointments)s appointments' % summary)
+            calls = funnel_calls(user_id=1, phone=summary['phones'][0])
+            db.engine.execute('ANALYZE')
+            before = report(calls, options.repeat)
+            upgrade()
+            db.engine.execute('ANALYZE')
+            after = report(calls, options.repeat)
+            for name, function, args in calls:
+                print('\n=== %s: %.2f ms -> %.2f ms'
+                      % (name, before[name][1], after[name][1]))
+                for label, result in (('before', before), ('after', after)):
+                    print('--- %s' % label)
+                    for plan in result[name][0]:
+                        for line in plan:
+                            print('    ' + line)
+                        print('')
+    finally:
+        os.remove(path)
+
+if __name__ == '__main__':
+    main()
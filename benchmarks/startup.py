@@ -0,0 +1,80 @@
+""" Start up time of an instance, ie the import time of the application
+and of its dependencies
+
+Every module is imported in a fresh interpreter, repeat times, and the
+median is kept: an import measured in the current process would be
+cached. Also lists the heavy modules loaded by the application on start up,
+which should be loaded on first use instead.
+
+    python -m benchmarks.startup --repeat 5
+    python -m benchmarks.startup --budget 1.5   # fails above 1.5 s
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+MODULES = ['flask', 'sqlalchemy', 'flask_sqlalchemy', 'flask_security',
+           'flask_wtf', 'flask_admin', 'requests', 'twilio.rest', 'pytz']
+
+# modules that must not be imported when an instance starts
+LAZY_MODULES = ['flask_admin', 'requests', 'twilio.rest']
+
+ENVIRONMENTS = {
+    'test': {'APP_ENV': 'test'},
+    'production': {'APP_ENV': 'production',
+                   'DATABASE_URI': 'sqlite:///./startup.db'},
+}
+
+MEASURE = ('import sys, time\n'
+           'start = time.time()\n'
+           'import %s\n'
+           'print(time.time() - start)\n'
+           'print(",".join(sorted(sys.modules)))\n')
+
+def import_time(module, environment='test'):
+    """ Returns the time taken to import a module in a fresh interpreter
+    and the names of the modules loaded with it.
+    """
+    environ = dict(os.environ)
+    environ.update(ENVIRONMENTS[environment])
+    output = subprocess.check_output([sys.executable, '-c', MEASURE % module],
+                                     env=environ, stderr=open(os.devnull, 'w'))
+    seconds, modules = output.strip().split('\n')[-2:]
+    return float(seconds), modules.split(',')
+
+def median_import_time(module, repeat, environment='test'):
+    times = []
+    for _ in range(repeat):
+        seconds, modules = import_time(module, environment)
+        times.append(seconds)
+    return sorted(times)[len(times) // 2], modules
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--budget', type=float, default=None,
+                        help='maximum import time of my_app in production, '
+                             'in seconds')
+    options = parser.parse_args()
+    print('%-28s %8s' % ('module', 'ms'))
+    for module in MODULES:
+        seconds, _ = median_import_time(module, options.repeat)
+        print('%-28s %8.1f' % (module, 1000 * seconds))
+    result = 0
+    for environment in sorted(ENVIRONMENTS):
+        seconds, modules = median_import_time('my_app', options.repeat,
+                                              environment)
+        loaded = [module for module in LAZY_MODULES if module in modules]
+        print('%-28s %8.1f   loaded on start up: %s' % (
+            'my_app (%s)' % environment, 1000 * seconds,
+            ', '.join(loaded) or 'none of %s' % ', '.join(LAZY_MODULES)))
+        if (environment == 'production' and options.budget is not None
+                and seconds > options.budget):
+            print('my_app takes more than %.1fs to import' % options.budget)
+            result = 1
+    return result
+
+if __name__ == '__main__':
+    sys.exit(main())
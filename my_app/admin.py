@@ -1,12 +1,23 @@
 """ Creation of the admin pages """
 
+from datetime import datetime
 from my_app import app
 from data_model import db, Branch, User, Appointment, Market, Services
+from data_model import SlotTemplate, Holiday, AppointmentArchive, Role
 from wtforms import PasswordField
+from wtforms.validators import NumberRange, Regexp, ValidationError
 from flask_admin import Admin, expose, AdminIndexView
 from flask_admin.contrib import sqla
 from flask_login import current_user
 from flask_security import utils
+from sqlalchemy import inspect
+from sqlalchemy.orm.attributes import flag_modified
+from crud import provision_slots, availability_changed, resync_slots
+from crud import release_past_bookings, upcoming_phone
+from availability import rebuild_availability, bump_availability_version
+from availability import record_changes
+from bitmap import bitmap_engine
+from calendar_feed import bump_calendar_versions
 
 ############################# Customization ###################################
 
@@ -23,6 +34,20 @@ class ProtectedAdmin(sqla.ModelView):
         if current_user.is_authenticated:
             return current_user.has_role('admin')
         return None
+    # the change and the new availability version are committed together
+    def on_model_change(self, form, model, is_created):
+        bump_availability_version()
+    def on_model_delete(self, model):
+        bump_availability_version()
+    def after_model_change(self, form, model, is_created):
+        # the services of the agents, their branches... make the
+        # availability summary, rebuilt after these structural changes;
+        # the appointment admin records the change of the slot instead
+        rebuild_availability()
+        availability_changed()
+    def after_model_delete(self, model):
+        rebuild_availability()
+        availability_changed()
 
 class BranchAdmin(ProtectedAdmin):
     """ Customizes the Branch Admin Interface.
@@ -43,15 +68,153 @@ class MarketAdmin(ProtectedAdmin):
 class ServicesAdmin(ProtectedAdmin):
     pass
 
+def previous_value(model, attribute):
+    """ Returns the value of a column of model before the form set it."""
+    history = inspect(model).attrs[attribute].history
+    if history.deleted:
+        return history.deleted[0]
+    return getattr(model, attribute)
+
+def bookable_changes(before, after):
+    """ Returns the changes of the bookable counts (see
+    availability.record_changes) of an appointment edited, given
+    before and after: its (user_id, date, status).
+    """
+    changes = {}
+    for (user_id, day, status), change in ((before, -1), (after, 1)):
+        if status == 'bookable' and user_id is not None:
+            changes[(user_id, day)] = changes.get((user_id, day), 0) + change
+    return changes
+
 class AppointmentAdmin(ProtectedAdmin):
     """ Customizes the Branch Admin Interface.
     In particular, appointments cannot be deleted - just updated.
     
     """
     column_filters = ('date', 'time','user.name')
-    form_excluded_columns = ('appointment')
+    form_excluded_columns = ('appointment', 'active_phone')
     can_create = False
     can_delete = False
+    def on_model_change(self, form, model, is_created):
+        # the slot before and after the change, read before anything
+        # is flushed: the form only sets the user relationship
+        with db.session.no_autoflush:
+            before = (model.user_id, previous_value(model, 'date'),
+                      previous_value(model, 'bookable_booked'))
+            after = (model.user.id if model.user is not None else None,
+                     model.date, model.bookable_booked)
+        # active_phone follows the booking, so that a phone number
+        # still holds at most one upcoming booking (see data_model.py)
+        today = datetime.now().date()
+        phone_number = upcoming_phone(model, today)
+        if phone_number is not None:
+            with db.session.no_autoflush:
+                release_past_bookings(phone_number, today)
+                if (db.session.query(Appointment.id)
+                        .filter(Appointment.active_phone == phone_number)
+                        .filter(Appointment.id != model.id)
+                        .first() is not None):
+                    raise ValidationError('%s already has an upcoming '
+                                          'appointment' % phone_number)
+        model.active_phone = phone_number
+        # written even if unchanged: the row may have just been released
+        flag_modified(model, 'active_phone')
+        # the summary gets the change of the slot, as for a toggle,
+        # and the calendar feeds of the agents show it; with the bitmap
+        # engine, the masks, which the summary counts, do not change
+        if not bitmap_engine():
+            record_changes(bookable_changes(before, after))
+        bump_calendar_versions(set([before[0], after[0]]) - set([None]))
+        super(AppointmentAdmin, self).on_model_change(form, model,
+                                                      is_created)
+    def after_model_change(self, form, model, is_created):
+        # the summary was updated with the change, no rebuild
+        availability_changed()
+
+class AppointmentArchiveAdmin(ProtectedAdmin):
+    """ Customizes the Appointment Archive Admin Interface.
+    The past bookings are read only.
+
+    """
+    column_filters = ('date', 'booked_by_phone', 'user.name')
+    column_default_sort = ('date', True)
+    can_create = False
+    can_edit = False
+    can_delete = False
+
+def schedule_agents(model):
+    """ Returns the ids of the agents whose slots depend on a template
+    or a holiday: its user, else the agents of its branch, else all agents.
+    Before a change is flushed, these are the agents of the former
+    user and branch: the form only sets the relationships.
+    """
+    user_id = getattr(model, 'user_id', None)
+    if user_id is not None:
+        return [user_id]
+    agents = db.session.query(User.id).join(User.roles).filter(
+        Role.name == 'end-user')
+    if model.branch_id is not None:
+        agents = agents.filter(User.branch_id == model.branch_id)
+    return [agent_id for (agent_id,) in agents]
+
+class ScheduleAdmin(ProtectedAdmin):
+    """ Admin of the models the slots are generated from: once a change
+    is committed, the slots to come of the agents concerned, before and
+    after the change, are brought in line with it (see crud.resync_slots),
+    then the availability summary is rebuilt.
+    """
+    def on_model_change(self, form, model, is_created):
+        with db.session.no_autoflush:
+            model.resync_user_ids = ([] if is_created
+                                     else schedule_agents(model))
+        super(ScheduleAdmin, self).on_model_change(form, model, is_created)
+    def after_model_change(self, form, model, is_created):
+        resync_slots(set(model.resync_user_ids) | set(schedule_agents(model)))
+        super(ScheduleAdmin, self).after_model_change(form, model,
+                                                      is_created)
+    def on_model_delete(self, model):
+        # the agents are looked up while the model is still there
+        model.resync_user_ids = schedule_agents(model)
+        super(ScheduleAdmin, self).on_model_delete(model)
+    def after_model_delete(self, model):
+        resync_slots(model.resync_user_ids)
+        super(ScheduleAdmin, self).after_model_delete(model)
+
+class SlotTemplateAdmin(ScheduleAdmin):
+    """ Customizes the Slot Template Admin Interface.
+    A template is attached to a branch, or to a user to override
+    the template of the user's branch.
+
+    """
+    column_list = ('branch', 'user', 'opening_time', 'closing_time',
+                   'slot_minutes', 'closed_weekdays', 'horizon_days')
+    form_args = {
+        'slot_minutes': {
+            'validators': [NumberRange(min=1)]},
+        'closed_weekdays': {
+            'description': 'Comma separated week days, 0 for Monday',
+            'validators': [Regexp(r'^\s*([0-6]\s*(,\s*[0-6]\s*)*)?$',
+                                  message='Comma separated week days '
+                                          'from 0 (Monday) to 6 (Sunday)')]},
+        'horizon_days': {
+            'description': 'Number of days, starting today, '
+                           'for which appointments are created',
+            'validators': [NumberRange(min=1)]}}
+    def on_model_change(self, form, model, is_created):
+        if model.branch is None and model.user is None:
+            raise ValidationError('A template needs a branch or a user')
+        if model.opening_time >= model.closing_time:
+            raise ValidationError('The opening time must be before '
+                                  'the closing time')
+        super(SlotTemplateAdmin, self).on_model_change(form, model,
+                                                       is_created)
+
+class HolidayAdmin(ScheduleAdmin):
+    """ Customizes the Holiday Admin Interface.
+    A holiday without branch closes every branch.
+
+    """
+    column_filters = ('date', 'branch.name')
 
 class UserAdmin(ProtectedAdmin):
     """ Customizes the Branch Admin Interface.
@@ -76,6 +239,12 @@ class UserAdmin(ProtectedAdmin):
             model.password = utils.encrypt_password(model.password2)
         # .. and make the user must be active if this is not the case
         model.active=True
+        super(UserAdmin, self).on_model_change(form, model, is_created)
+    # once the change is committed...
+    def after_model_change(self, form, model, is_created):
+        # ... a new agent, or a user who just became one, gets a calendar
+        provision_slots(model)
+        super(UserAdmin, self).after_model_change(form, model, is_created)
 
 ########################### Initialization ###################################
 
@@ -84,6 +253,10 @@ admin.add_view(UserAdmin(User, db.session))
 admin.add_view(BranchAdmin(Branch, db.session))
 admin.add_view(MarketAdmin(Market, db.session))
 admin.add_view(AppointmentAdmin(Appointment, db.session))
+admin.add_view(AppointmentArchiveAdmin(AppointmentArchive, db.session,
+                                       name='Archive'))
 admin.add_view(ServicesAdmin(Services, db.session))
+admin.add_view(SlotTemplateAdmin(SlotTemplate, db.session))
+admin.add_view(HolidayAdmin(Holiday, db.session))
 
 
@@ -0,0 +1,135 @@
+""" JSON API of the customer funnel, for booking widgets on other sites
+
+    GET /api/v1/services
+    GET /api/v1/markets?service=<service>
+    GET /api/v1/days?service=<service>&market=<market>
+    GET /api/v1/slots?service=<service>&market=<market>&date=<YYYY-MM-DD>
+
+The responses carry a strong ETag made of the availability version
+(see availability.py), of the current date of the funnel (and of the
+market for the slots, which start from tomorrow there) and of the URL,
+and may be cached for app.config['API_MAX_AGE'] seconds: a request with
+a matching If-None-Match gets a 304 without any other query.
+"""
+
+import hashlib
+import json
+from datetime import datetime
+import pytz
+from flask import request
+from my_app import app
+from availability import availability_version
+from crud import funnel_cache, query_available_services
+from crud import query_available_markets, query_available_days
+from crud import query_market_appointments, query_market_time_zone
+from crud import funnel_today
+
+DEFAULT_MAX_AGE = 30
+DAYS_AVAILABLE = 10
+
+# version of the availability this instance last saw
+_seen_version = []
+
+def _json_response(payload, status=200):
+    response = app.response_class(
+        json.dumps(payload, separators=(',', ':'), sort_keys=True),
+        status=status, mimetype='application/json')
+    # the widgets run on other sites
+    response.headers['Access-Control-Allow-Origin'] = app.config.get(
+        'API_ALLOWED_ORIGIN', '*')
+    return response
+
+def _error(message):
+    return _json_response({'error': message}, status=400)
+
+def cached_json(build, market=None):
+    """ Returns the JSON response of build(), or a 304 if the client
+    already has it. An instance seeing a new availability version
+    empties its funnel cache, which may be local to the instance.
+    The answers change at midnight too: in the funnel's time zone,
+    and in the market's one for the slots of a market.
+    """
+    version = availability_version()
+    if _seen_version != [version]:
+        funnel_cache.invalidate()
+        _seen_version[:] = [version]
+    dates = [funnel_today()]
+    time_zone = query_market_time_zone(market) if market else None
+    if time_zone:
+        dates.append(datetime.now(pytz.timezone(time_zone)).date())
+    etag = hashlib.md5('%s:%s:%s' % (
+        version, ','.join(day.isoformat() for day in dates),
+        request.full_path)).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = _json_response(None, status=304)
+        response.set_data('')
+        del response.headers['Content-Type']
+    else:
+        response = _json_response(build())
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'public, max-age=%s' % (
+        app.config.get('API_MAX_AGE', DEFAULT_MAX_AGE))
+    return response
+
+def slots_payload(grid):
+    """ Returns the bookable slots of query_market_appointments as
+    one dictionary per branch: days maps each day to its
+    [time, agent id] pairs.
+    """
+    branches = []
+    for branch in grid:
+        days = dict((day.strftime('%Y-%m-%d'), [])
+                    for day in branch['branch_apt_days'])
+        for row in branch['branch_apt']:
+            for appointment in row:
+                if appointment is not None:
+                    days[appointment.date.strftime('%Y-%m-%d')].append(
+                        [appointment.time.strftime('%H:%M'),
+                         appointment.user_id])
+        branches.append({'id': branch['branch_id'],
+                         'name': branch['branch'],
+                         'address': branch['branch_address'],
+                         'days': days})
+    return branches
+
+############################# Routes ##########################################
+
+@app.route('/api/v1/services')
+def api_services():
+    return cached_json(lambda: {
+        'services': query_available_services(days_available=DAYS_AVAILABLE)})
+
+@app.route('/api/v1/markets')
+def api_markets():
+    service = request.args.get('service')
+    if not service:
+        return _error('service is required')
+    return cached_json(lambda: {
+        'markets': query_available_markets(days_available=DAYS_AVAILABLE,
+                                           what=service)})
+
+@app.route('/api/v1/days')
+def api_days():
+    service = request.args.get('service')
+    market = request.args.get('market')
+    if not service or not market:
+        return _error('service and market are required')
+    return cached_json(lambda: {
+        'days': query_available_days(service, market,
+                                     days_available=DAYS_AVAILABLE)})
+
+@app.route('/api/v1/slots')
+def api_slots():
+    service = request.args.get('service')
+    market = request.args.get('market')
+    day = request.args.get('date')
+    if not service or not market or not day:
+        return _error('service, market and date are required')
+    try:
+        datetime.strptime(day, '%Y-%m-%d')
+    except ValueError:
+        return _error('date must be YYYY-MM-DD')
+    return cached_json(lambda: {
+        'branches': slots_payload(
+            query_market_appointments(service, market, day))},
+        market=market)
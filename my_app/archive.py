@@ -0,0 +1,105 @@
+""" Archival of the past appointments
+
+The customer funnel and the calendars only look at the days to come:
+the nightly /cron/archive_appointments keeps the tables they read
+limited to them, ie
+- moves the past bookings to the appointment_archive table,
+- deletes the past slots nobody booked,
+- deletes the past agent-days (bitmap engine) and availability summary rows.
+Rows go ARCHIVE_BATCH_SIZE at a time, one short transaction per batch, and
+a run stops after ARCHIVE_MAX_BATCHES batches per table: the next run goes
+on where it stopped, so that a first run on a large table stays bounded.
+The appointments of yesterday are kept: it is still yesterday
+in the branches west of the server.
+"""
+
+import logging
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import and_, or_, select, literal
+from data_model import db, Appointment, AppointmentArchive, AgentDay
+from data_model import AvailabilitySummary
+
+ARCHIVE_BATCH_SIZE = 500
+ARCHIVE_MAX_BATCHES = 20
+KEEP_PAST_DAYS = 1
+
+def archive_cutoff(today=None):
+    """ Returns the first day whose rows are kept."""
+    today = today or datetime.today().date()
+    return today - timedelta(days=KEEP_PAST_DAYS)
+
+def delete_in_batches(table, condition, batch_size, max_batches, copy=None):
+    """ Deletes the rows of table matching condition, batch_size at a time,
+    in one transaction per batch, at most max_batches batches.
+    copy(ids) is called in the transaction of every batch, before the delete.
+    Returns the number of rows deleted and whether none is left.
+    """
+    deleted = 0
+    for _ in range(max_batches):
+        ids = [row_id for (row_id,) in db.session.execute(
+            select([table.c.id]).where(condition)
+            .order_by(table.c.id).limit(batch_size))]
+        if not ids:
+            return deleted, True
+        if copy is not None:
+            copy(ids)
+        db.session.execute(table.delete().where(table.c.id.in_(ids)))
+        db.session.commit()
+        deleted += len(ids)
+    return deleted, False
+
+def copy_to_archive(ids):
+    """ Copies appointments to the archive, in the current transaction.
+    Appointments archived by an earlier, interrupted run are skipped.
+    """
+    appointments = Appointment.__table__
+    names = [column.name for column in appointments.columns]
+    archived_at = literal(datetime.now(), AppointmentArchive.archived_at.type)
+    db.session.execute(
+        AppointmentArchive.__table__.insert()
+        .prefix_with('OR IGNORE', dialect='sqlite')
+        .prefix_with('IGNORE', dialect='mysql')
+        .from_select(names + ['archived_at'],
+                     select([appointments.c[name] for name in names]
+                            + [archived_at])
+                     .where(appointments.c.id.in_(ids))))
+
+def archive_appointments(today=None, batch_size=ARCHIVE_BATCH_SIZE,
+                         max_batches=ARCHIVE_MAX_BATCHES):
+    """ Nightly entry point: moves the past bookings to the archive,
+    deletes the past slots, agent-days and summary rows, see above.
+    Returns a dictionary with the number of rows of each kind,
+    complete: whether nothing is left to do, and the time taken.
+    """
+    start = time.time()
+    cutoff = archive_cutoff(today)
+    appointments = Appointment.__table__
+    agent_days = AgentDay.__table__
+    summary = AvailabilitySummary.__table__
+    stats = {'cutoff': cutoff.isoformat()}
+    stats['archived'], archived = delete_in_batches(
+        appointments,
+        and_(appointments.c.bookable_booked == 'booked',
+             appointments.c.date < cutoff),
+        batch_size, max_batches, copy=copy_to_archive)
+    stats['slots_purged'], purged = delete_in_batches(
+        appointments,
+        and_(or_(appointments.c.bookable_booked != 'booked',
+                 appointments.c.bookable_booked.is_(None)),
+             appointments.c.date < cutoff),
+        batch_size, max_batches)
+    stats['agent_days_purged'], agent_days_purged = delete_in_batches(
+        agent_days, agent_days.c.date < cutoff, batch_size, max_batches)
+    stats['summary_rows_purged'], summary_purged = delete_in_batches(
+        summary, summary.c.date < cutoff, batch_size, max_batches)
+    stats['complete'] = (archived and purged and agent_days_purged
+                         and summary_purged)
+    stats['seconds'] = round(time.time() - start, 3)
+    logging.info('Archival before %s: %s bookings archived, %s slots, '
+                 '%s agent-days and %s summary rows purged in %.1fs%s',
+                 cutoff, stats['archived'], stats['slots_purged'],
+                 stats['agent_days_purged'], stats['summary_rows_purged'],
+                 stats['seconds'],
+                 '' if stats['complete'] else ', more to do')
+    return stats
@@ -0,0 +1,202 @@
+""" Summary of the bookable appointments, read by the customer funnel
+
+The availability_summary table holds the number of bookable appointments
+per service, market, branch and day, so that the options of the first
+funnel pages (services, markets, days) come from one indexed lookup
+instead of a join of the appointments with the agents and their services.
+
+The code changing the status of appointments records, in the same
+transaction, how many appointments became bookable (+) or stopped being
+bookable (-) per agent and day (record_changes). Changes of the agents
+themselves (services, branch) go through the admin, which rebuilds the
+whole summary (rebuild_availability). check_availability compares the
+summary with the appointments. With the bitmap engine (see bitmap.py),
+the counts come from the masks of the agent-days instead.
+
+Every change also bumps, in its transaction, the 'availability' version
+counter (bump_availability_version), which the JSON API uses as a cache
+validator.
+"""
+
+from collections import defaultdict
+from sqlalchemy import and_, or_, func, select
+from data_model import db, Appointment, User, Branch, AvailabilitySummary
+from data_model import DataVersion, users_services
+from bitmap import bitmap_engine, bookable_counts
+
+# keys per UPDATE statement, SQLite limits the depth of expressions
+UPDATE_CHUNK = 100
+
+############################# Incremental updates #############################
+
+def summary_deltas(changes):
+    """ Returns the changes of bookable counts per summary key
+    (services_id, market_id, branch_id, date), given
+    changes: a dictionary (user_id, date): change of the number
+    of bookable appointments of the agent on that day.
+    """
+    user_ids = set(user_id for user_id, day in changes)
+    if not user_ids:
+        return {}
+    offers = defaultdict(list)
+    for user_id, services_id, branch_id, market_id in (
+            db.session.query(users_services.c.user_id,
+                             users_services.c.services_id,
+                             User.branch_id, Branch.market_id)
+            .join(User, users_services.c.user_id == User.id)
+            .join(Branch, User.branch_id == Branch.id)
+            .filter(users_services.c.user_id.in_(user_ids))):
+        offers[user_id].append((services_id, market_id, branch_id))
+    deltas = defaultdict(int)
+    for (user_id, day), change in changes.items():
+        for services_id, market_id, branch_id in offers[user_id]:
+            deltas[(services_id, market_id, branch_id, day)] += change
+    return dict((key, delta) for key, delta in deltas.items() if delta)
+
+def _matching(columns, keys):
+    """ Returns the condition matching the summary keys
+    (services_id, market_id, branch_id, date) on columns, in the same order.
+    """
+    return or_(*[and_(*[column == value
+                        for column, value in zip(columns, key)])
+                 for key in keys])
+
+def apply_deltas(deltas):
+    """ Adds the deltas to the bookable counts of the summary,
+    in the current transaction: the missing rows are inserted,
+    then the counts are updated with one UPDATE per delta value.
+    """
+    if not deltas:
+        return
+    summary = AvailabilitySummary.__table__
+    insert = (summary.insert()
+              .prefix_with('OR IGNORE', dialect='sqlite')
+              .prefix_with('IGNORE', dialect='mysql'))
+    db.session.execute(insert, [
+        {'services_id': services_id, 'market_id': market_id,
+         'branch_id': branch_id, 'date': day, 'bookable_count': 0}
+        for services_id, market_id, branch_id, day in deltas])
+    keys_by_delta = defaultdict(list)
+    for key, delta in deltas.items():
+        keys_by_delta[delta].append(key)
+    columns = [summary.c.services_id, summary.c.market_id,
+               summary.c.branch_id, summary.c.date]
+    for delta, keys in keys_by_delta.items():
+        for start in range(0, len(keys), UPDATE_CHUNK):
+            matching = _matching(columns, keys[start:start + UPDATE_CHUNK])
+            db.session.execute(summary.update().where(matching).values(
+                bookable_count=summary.c.bookable_count + delta))
+
+def record_changes(changes):
+    """ Updates the summary in the current transaction, given
+    changes: a dictionary (user_id, date): change of the number
+    of bookable appointments of the agent on that day.
+    """
+    apply_deltas(summary_deltas(changes))
+
+############################# Full rebuild ####################################
+
+def _bookable_counts():
+    """ Returns the query counting the bookable appointments
+    per summary key, from the appointments.
+    """
+    return (select([users_services.c.services_id, Branch.market_id,
+                    User.branch_id, Appointment.date,
+                    func.count(Appointment.id)])
+            .select_from(Appointment.__table__
+                         .join(User.__table__,
+                               Appointment.user_id == User.id)
+                         .join(Branch.__table__,
+                               User.branch_id == Branch.id)
+                         .join(users_services,
+                               users_services.c.user_id == User.id))
+            .where(Appointment.bookable_booked == 'bookable')
+            .group_by(users_services.c.services_id, Branch.market_id,
+                      User.branch_id, Appointment.date))
+
+def _expected_counts():
+    """ Returns the bookable counts per summary key, from the slots."""
+    if bitmap_engine():
+        return summary_deltas(bookable_counts())
+    return dict((tuple(row[:4]), row[4])
+                for row in db.session.execute(_bookable_counts()))
+
+def rebuild_availability():
+    """ Recomputes the whole summary from the appointments
+    and commits it with a new availability version.
+    Returns the number of summary rows.
+    """
+    summary = AvailabilitySummary.__table__
+    db.session.execute(summary.delete())
+    if bitmap_engine():
+        rows = [{'services_id': services_id, 'market_id': market_id,
+                 'branch_id': branch_id, 'date': day, 'bookable_count': count}
+                for (services_id, market_id, branch_id, day), count
+                in _expected_counts().items()]
+        if rows:
+            db.session.execute(summary.insert(), rows)
+    else:
+        db.session.execute(summary.insert().from_select(
+            ['services_id', 'market_id', 'branch_id', 'date',
+             'bookable_count'],
+            _bookable_counts()))
+    bump_availability_version()
+    db.session.commit()
+    return db.session.query(func.count(AvailabilitySummary.id)).scalar()
+
+def refresh_availability(changed):
+    """ Recomputes from the appointments, in the current transaction,
+    the summary rows of the agents and days changed, (user_id, date) pairs,
+    for when the changes themselves are not known, eg rows inserted
+    or skipped without a reliable row count.
+    """
+    keys = list(summary_deltas(dict((key, 1) for key in changed)))
+    summary = AvailabilitySummary.__table__
+    columns = [summary.c.services_id, summary.c.market_id,
+               summary.c.branch_id, summary.c.date]
+    for start in range(0, len(keys), UPDATE_CHUNK):
+        chunk = keys[start:start + UPDATE_CHUNK]
+        db.session.execute(summary.delete().where(_matching(columns, chunk)))
+        db.session.execute(summary.insert().from_select(
+            ['services_id', 'market_id', 'branch_id', 'date',
+             'bookable_count'],
+            _bookable_counts().where(_matching(
+                [users_services.c.services_id, Branch.market_id,
+                 User.branch_id, Appointment.date], chunk))))
+
+def check_availability():
+    """ Compares the summary with the appointments and returns the
+    differences, as a list of (key, count in the summary, actual count).
+    Rows of the summary with a count of 0 are the same as missing rows.
+    """
+    expected = _expected_counts()
+    actual = dict(((row.services_id, row.market_id, row.branch_id,
+                    row.date), row.bookable_count)
+                  for row in AvailabilitySummary.query
+                  .filter(AvailabilitySummary.bookable_count != 0))
+    return sorted((key, actual.get(key, 0), expected.get(key, 0))
+                  for key in set(expected) | set(actual)
+                  if actual.get(key, 0) != expected.get(key, 0))
+
+############################# Version #########################################
+
+def availability_version():
+    """ Returns the version of the availability, 0 until the first change."""
+    version = (db.session.query(DataVersion.version)
+               .filter(DataVersion.name == 'availability')
+               .scalar())
+    return version or 0
+
+def bump_availability_version():
+    """ Increments the version of the availability,
+    in the current transaction, ie the one of the change.
+    """
+    versions = DataVersion.__table__
+    result = db.session.execute(versions.update()
+                                .where(versions.c.name == 'availability')
+                                .values(version=versions.c.version + 1))
+    if result.rowcount == 0:
+        db.session.execute(versions.insert()
+                           .prefix_with('OR IGNORE', dialect='sqlite')
+                           .prefix_with('IGNORE', dialect='mysql'),
+                           {'name': 'availability', 'version': 1})
@@ -0,0 +1,433 @@
+""" Compact slot store: the slots of an agent on a day as bit masks
+
+With app.config['AVAILABILITY_ENGINE'] set to 'bitmap', the slots nobody
+booked are not Appointment rows: every agent-day is one AgentDay row, whose
+bit i stands for the slot starting i * slot_minutes after first_slot,
+in three masks:
+- open_slots: the slots of the agent on that day,
+- bookable_slots: the slots customers can book,
+- booked_slots: the booked slots, the only ones with an Appointment row,
+  inserted by the booking (claim_slot) and deleted by the cancellation
+  (release_slots).
+An open slot which is neither bookable nor booked is 'tbd'.
+
+The grid of a branch on a day is the OR of the bookable masks of its agents
+offering the service (first_bookable_slots): 15 days of 8 hourly slots are
+15 rows per agent instead of 120.
+convert_slots moves the slots of an existing database from one engine
+to the other.
+"""
+
+from collections import defaultdict, namedtuple
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import and_, or_, select
+from data_model import db, AgentDay, Appointment, User, Services
+from data_model import users_services
+from schedule import compile_schedules
+
+# the masks are signed 64 bit integers in the database
+MAX_SLOTS = 63
+
+# agent-days read per statement, SQLite limits the depth of expressions
+DAY_CHUNK = 100
+
+# a slot nobody booked, shown like an Appointment by the templates
+Slot = namedtuple('Slot', ['user_id', 'date', 'time', 'bookable_booked',
+                           'topic', 'booked_by_name', 'booked_by_phone'])
+
+############################# Masks ###########################################
+
+def bitmap_engine():
+    """ Tells whether the slots are stored as bit masks."""
+    return current_app.config.get('AVAILABILITY_ENGINE') == 'bitmap'
+
+def popcount(mask):
+    """ Returns the number of slots of a mask."""
+    return bin(mask).count('1')
+
+def schedule_mask(schedule):
+    """ Returns the mask of the slots of an opened day of a SlotSchedule."""
+    if len(schedule.slot_times) > MAX_SLOTS:
+        raise ValueError('%s slots a day, at most %s fit in a mask'
+                         % (len(schedule.slot_times), MAX_SLOTS))
+    return (1 << len(schedule.slot_times)) - 1
+
+def grid_index(first_slot, slot_minutes, slot_time):
+    """ Returns the index of the slot starting at slot_time on the grid
+    of slots starting at first_slot, None if no slot starts then.
+    """
+    minutes = ((slot_time.hour - first_slot.hour) * 60
+               + slot_time.minute - first_slot.minute)
+    if minutes < 0 or minutes % slot_minutes or slot_time.second:
+        return None
+    index = minutes // slot_minutes
+    return index if index < MAX_SLOTS else None
+
+def slot_bit(agent_day, slot_time):
+    """ Returns the bit of the open slot of agent_day starting at slot_time,
+    None if no slot starts then.
+    """
+    index = grid_index(agent_day.first_slot, agent_day.slot_minutes,
+                       slot_time)
+    if index is None or not agent_day.open_slots >> index & 1:
+        return None
+    return 1 << index
+
+def day_slots(agent_day, mask=None):
+    """ Returns the (bit, start time) of the slots of mask,
+    by default of the open slots of agent_day.
+    """
+    mask = agent_day.open_slots if mask is None else mask
+    start = datetime.combine(agent_day.date, agent_day.first_slot)
+    return [(1 << index,
+             (start + timedelta(minutes=index * agent_day.slot_minutes)).time())
+            for index in range(MAX_SLOTS) if mask >> index & 1]
+
+def _agent_days(*conditions):
+    """ Returns the agent-days matching conditions, read with Core so that
+    the masks are never stale copies from the session.
+    """
+    return db.session.execute(select([AgentDay.__table__])
+                              .where(and_(*conditions))
+                              .order_by(AgentDay.user_id, AgentDay.date))
+
+############################# Queries #########################################
+
+def agent_slots(user_ids, start_date, end_date=None):
+    """ Returns a dictionary user_id: the slots of the agent from start_date
+    (to end_date), ie the Appointment of the booked slots
+    and a Slot for the others, with two queries.
+    """
+    user_ids = list(user_ids)
+    slots = dict((user_id, []) for user_id in user_ids)
+    if not user_ids:
+        return slots
+    conditions = [AgentDay.user_id.in_(user_ids), AgentDay.date >= start_date]
+    bookings = (Appointment.query
+                .filter(Appointment.user_id.in_(user_ids))
+                .filter(Appointment.bookable_booked == 'booked')
+                .filter(Appointment.date >= start_date))
+    if end_date is not None:
+        conditions.append(AgentDay.date <= end_date)
+        bookings = bookings.filter(Appointment.date <= end_date)
+    booked = dict(((appointment.user_id, appointment.date, appointment.time),
+                   appointment) for appointment in bookings)
+    for agent_day in _agent_days(*conditions):
+        for bit, slot_time in day_slots(agent_day):
+            key = (agent_day.user_id, agent_day.date, slot_time)
+            if agent_day.booked_slots & bit and key in booked:
+                slots[agent_day.user_id].append(booked[key])
+                continue
+            if agent_day.booked_slots & bit:
+                status = 'booked'
+            elif agent_day.bookable_slots & bit:
+                status = 'bookable'
+            else:
+                status = 'tbd'
+            slots[agent_day.user_id].append(
+                Slot(agent_day.user_id, agent_day.date, slot_time, status,
+                     None, None, None))
+    return slots
+
+def first_bookable_slots(what, branch_ids, start_query_date, end_query_date):
+    """ Returns (branch_id, Slot) for the first bookable slot of every
+    branch, date and time, for agents offering the service, like
+    crud.query_first_bookable_appointments: the bookable masks of the
+    agents of a branch are ORed, the first agent setting a bit gets the slot.
+    """
+    agent_days = (db.session.query(User.branch_id, AgentDay.user_id,
+                                   AgentDay.date, AgentDay.first_slot,
+                                   AgentDay.slot_minutes,
+                                   AgentDay.open_slots,
+                                   AgentDay.bookable_slots)
+                  .select_from(AgentDay)
+                  .join(User, AgentDay.user_id == User.id)
+                  .join(users_services, users_services.c.user_id == User.id)
+                  .join(Services, users_services.c.services_id == Services.id)
+                  .filter(Services.name == what)
+                  .filter(User.branch_id.in_(branch_ids))
+                  .filter(AgentDay.bookable_slots != 0)
+                  .filter(AgentDay.date >= start_query_date)
+                  .filter(AgentDay.date <= end_query_date)
+                  .order_by(AgentDay.user_id))
+    # agents with different working hours have different grids
+    covered = defaultdict(int)
+    slots = []
+    for agent_day in agent_days:
+        grid = (agent_day.branch_id, agent_day.date, agent_day.first_slot,
+                agent_day.slot_minutes)
+        mask = agent_day.bookable_slots & ~covered[grid]
+        covered[grid] |= agent_day.bookable_slots
+        slots.extend((agent_day.branch_id,
+                      Slot(agent_day.user_id, agent_day.date, slot_time,
+                           'bookable', None, None, None))
+                     for bit, slot_time in day_slots(agent_day, mask))
+    return slots
+
+def bookable_counts(start_date=None):
+    """ Returns a dictionary (user_id, date): number of bookable slots."""
+    query = (db.session.query(AgentDay.user_id, AgentDay.date,
+                              AgentDay.bookable_slots)
+             .filter(AgentDay.bookable_slots != 0))
+    if start_date is not None:
+        query = query.filter(AgentDay.date >= start_date)
+    return dict(((user_id, day), popcount(mask))
+                for user_id, day, mask in query)
+
+############################# Changes #########################################
+
+def generate_agent_days(user_ids):
+    """ Adds the missing agent-days of several agents, every slot bookable,
+    with one query and one multi-row insert, in the current transaction.
+    Agent-days created meanwhile by another process are skipped
+    thanks to the unique index on (user_id, date).
+    Returns the number of agent-days inserted and the bookable slots
+    per (user_id, date) of the ones meant to be inserted.
+    """
+    today = datetime.today().date()
+    schedules = compile_schedules(user_ids)
+    horizon = max(schedule.horizon_days for schedule in schedules.values())
+    existing = set(db.session.query(AgentDay.user_id, AgentDay.date)
+                   .filter(AgentDay.user_id.in_(user_ids))
+                   .filter(AgentDay.date >= today)
+                   .filter(AgentDay.date < today + timedelta(days=horizon)))
+    rows = []
+    for user_id in user_ids:
+        schedule = schedules[user_id]
+        if not schedule.slot_times:
+            continue
+        mask = schedule_mask(schedule)
+        rows.extend({'user_id': user_id, 'date': day,
+                     'first_slot': schedule.slot_times[0],
+                     'slot_minutes': schedule.slot_minutes,
+                     'open_slots': mask, 'bookable_slots': mask,
+                     'booked_slots': 0}
+                    for day in schedule.days(today)
+                    if (user_id, day) not in existing)
+    inserted = 0
+    if rows:
+        insert = (AgentDay.__table__.insert()
+                  .prefix_with('OR IGNORE', dialect='sqlite')
+                  .prefix_with('IGNORE', dialect='mysql'))
+        result = db.session.execute(insert, rows)
+        if db.engine.dialect.supports_sane_multi_rowcount:
+            inserted = result.rowcount
+        else:
+            inserted = len(rows)
+    changes = dict(((row['user_id'], row['date']),
+                    popcount(row['open_slots'])) for row in rows)
+    return inserted, changes
+
+def resync_agent_days(schedules, today):
+    """ Brings the agent-days to come in line with schedules, a dictionary
+    user_id: SlotSchedule, in the current transaction: the agent-days
+    without bookings whose day is closed or whose grid changed are deleted,
+    for generate_agent_days to create them again, the agent-days with
+    bookings on a closed day keep their bookings only.
+    Returns the number of agent-days deleted.
+    """
+    agent_days = AgentDay.__table__
+    stale, closed = [], []
+    for agent_day in _agent_days(AgentDay.user_id.in_(list(schedules)),
+                                 AgentDay.date >= today):
+        schedule = schedules[agent_day.user_id]
+        opened = (schedule.is_open(agent_day.date)
+                  and (agent_day.date - today).days < schedule.horizon_days)
+        same_grid = (opened and schedule.slot_times
+                     and agent_day.first_slot == schedule.slot_times[0]
+                     and agent_day.slot_minutes == schedule.slot_minutes
+                     and agent_day.open_slots == schedule_mask(schedule))
+        if same_grid:
+            continue
+        if not agent_day.booked_slots:
+            stale.append(agent_day.id)
+        elif not opened:
+            closed.append(agent_day.id)
+    if stale:
+        db.session.execute(agent_days.delete()
+                           .where(agent_days.c.id.in_(stale)))
+    if closed:
+        db.session.execute(agent_days.update()
+                           .where(agent_days.c.id.in_(closed))
+                           .values(bookable_slots=0))
+    return len(stale)
+
+def claim_slot(user_id, apt_date, apt_time):
+    """ Marks a bookable slot as booked with one conditional UPDATE,
+    in the current transaction: the slot is only updated if it is still
+    bookable. Returns True if it was.
+    """
+    agent_days = AgentDay.__table__
+    agent_day = _agent_days(AgentDay.user_id == user_id,
+                            AgentDay.date == apt_date).first()
+    bit = slot_bit(agent_day, apt_time) if agent_day else None
+    if bit is None:
+        return False
+    result = db.session.execute(
+        agent_days.update()
+        .where(agent_days.c.id == agent_day.id)
+        .where(agent_days.c.bookable_slots.op('&')(bit) != 0)
+        .values(bookable_slots=agent_days.c.bookable_slots - bit,
+                booked_slots=agent_days.c.booked_slots + bit))
+    return result.rowcount == 1
+
+def release_slots(appointments):
+    """ Makes the slots of booked appointments bookable again and deletes
+    the appointments, in the current transaction.
+    Returns the bookable slots added per (user_id, date).
+    """
+    agent_days = AgentDay.__table__
+    changes = {}
+    for appointment in appointments:
+        agent_day = _agent_days(AgentDay.user_id == appointment.user_id,
+                                AgentDay.date == appointment.date).first()
+        bit = slot_bit(agent_day, appointment.time) if agent_day else None
+        if bit is not None:
+            result = db.session.execute(
+                agent_days.update()
+                .where(agent_days.c.id == agent_day.id)
+                .where(agent_days.c.booked_slots.op('&')(bit) != 0)
+                .values(bookable_slots=agent_days.c.bookable_slots + bit,
+                        booked_slots=agent_days.c.booked_slots - bit))
+            if result.rowcount:
+                key = (appointment.user_id, appointment.date)
+                changes[key] = changes.get(key, 0) + 1
+        db.session.delete(appointment)
+    return changes
+
+def toggle_slots(keys):
+    """ Switches slots from bookable to not bookable ('tbd') and vice versa,
+    given keys (user_id, date, time, current status), in the current
+    transaction, with one UPDATE per agent-day, guarded by its previous
+    bookable mask: an agent-day changed meanwhile is left as it is.
+    Returns the keys of the slots switched.
+    """
+    by_day = defaultdict(list)
+    for key in keys:
+        by_day[(key[0], key[1])].append(key)
+    if not by_day:
+        return set()
+    agent_days = AgentDay.__table__
+    days = sorted(by_day)
+    rows = []
+    for start in range(0, len(days), DAY_CHUNK):
+        rows.extend(_agent_days(or_(*[and_(AgentDay.user_id == user_id,
+                                           AgentDay.date == day)
+                                      for user_id, day
+                                      in days[start:start + DAY_CHUNK]])))
+    switched = set()
+    for agent_day in rows:
+        bookable = agent_day.bookable_slots
+        day_switched = []
+        for key in by_day[(agent_day.user_id, agent_day.date)]:
+            bit = slot_bit(agent_day, key[2])
+            if bit is None or agent_day.booked_slots & bit:
+                continue
+            if key[3] == 'bookable' and bookable & bit:
+                bookable -= bit
+            elif key[3] == 'tbd' and not bookable & bit:
+                bookable += bit
+            else:
+                continue
+            day_switched.append(key)
+        if day_switched:
+            result = db.session.execute(
+                agent_days.update()
+                .where(agent_days.c.id == agent_day.id)
+                .where(agent_days.c.bookable_slots
+                       == agent_day.bookable_slots)
+                .values(bookable_slots=bookable))
+            if result.rowcount == 1:
+                switched.update(day_switched)
+    return switched
+
+############################# Conversion ######################################
+
+def _to_bitmap(today):
+    """ Turns the appointments to come into agent-days, see convert_slots."""
+    appointments = (db.session.query(Appointment.id, Appointment.user_id,
+                                     Appointment.date, Appointment.time,
+                                     Appointment.bookable_booked)
+                    .filter(Appointment.date >= today)
+                    .all())
+    schedules = compile_schedules(set(row.user_id for row in appointments))
+    existing = set(db.session.query(AgentDay.user_id, AgentDay.date)
+                   .filter(AgentDay.date >= today))
+    days = {}
+    removed = []
+    for row in appointments:
+        key = (row.user_id, row.date)
+        if key in existing:
+            continue
+        schedule = schedules[row.user_id]
+        if not schedule.slot_times:
+            continue
+        if key not in days:
+            days[key] = {'user_id': row.user_id, 'date': row.date,
+                         'first_slot': schedule.slot_times[0],
+                         'slot_minutes': schedule.slot_minutes,
+                         'open_slots': 0, 'bookable_slots': 0,
+                         'booked_slots': 0}
+        agent_day = days[key]
+        index = grid_index(agent_day['first_slot'],
+                           agent_day['slot_minutes'], row.time)
+        if index is None:
+            # off the agent's grid: kept as an appointment
+            continue
+        bit = 1 << index
+        agent_day['open_slots'] |= bit
+        if row.bookable_booked == 'booked':
+            agent_day['booked_slots'] |= bit
+            continue
+        if row.bookable_booked == 'bookable':
+            agent_day['bookable_slots'] |= bit
+        removed.append(row.id)
+    if days:
+        db.session.execute(AgentDay.__table__.insert(), list(days.values()))
+    appointments = Appointment.__table__
+    for start in range(0, len(removed), 500):
+        db.session.execute(appointments.delete().where(
+            appointments.c.id.in_(removed[start:start + 500])))
+    return {'agent_days': len(days), 'appointments_added': 0,
+            'appointments_removed': len(removed)}
+
+def _to_rows(today):
+    """ Turns the agent-days to come into appointments, see convert_slots."""
+    rows = []
+    agent_days = list(_agent_days(AgentDay.date >= today))
+    for agent_day in agent_days:
+        for bit, slot_time in day_slots(agent_day, agent_day.open_slots
+                                        & ~agent_day.booked_slots):
+            status = 'bookable' if agent_day.bookable_slots & bit else 'tbd'
+            rows.append({'date': agent_day.date, 'time': slot_time,
+                         'booked_at': None, 'bookable_booked': status,
+                         'topic': 'topic', 'booked_by_name': None,
+                         'booked_by_phone': None,
+                         'user_id': agent_day.user_id})
+    if rows:
+        db.session.execute(Appointment.__table__.insert()
+                           .prefix_with('OR IGNORE', dialect='sqlite')
+                           .prefix_with('IGNORE', dialect='mysql'), rows)
+    db.session.execute(AgentDay.__table__.delete())
+    return {'agent_days': len(agent_days), 'appointments_added': len(rows),
+            'appointments_removed': 0}
+
+def convert_slots(engine):
+    """ Moves the slots to come to engine, ie
+    'bitmap': the appointments not booked become agent-days,
+    on the grid of the agent's schedule,
+    'rows': the agent-days become appointments and are deleted.
+    The booked appointments stay as they are. Commits, then the
+    availability summary is to be rebuilt.
+    Returns a dictionary describing what was done.
+    """
+    today = datetime.today().date()
+    if engine == 'bitmap':
+        report = _to_bitmap(today)
+    elif engine == 'rows':
+        report = _to_rows(today)
+    else:
+        raise ValueError('Unknown availability engine %s' % engine)
+    db.session.commit()
+    return report
@@ -0,0 +1,149 @@
+""" Caching of query results that seldom change
+
+A Cache stores the results of decorated functions in a backend:
+- 'memory': an in-process LRU with a time to live, the default,
+- 'memcache': the App Engine memcache, shared by all the instances.
+The backend is picked with app.config['CACHE_BACKEND'] on first use.
+app.config['CACHE_DISABLED'] makes every call run the function, eg for
+the benchmarks of the queries themselves.
+
+Invalidation does not delete entries: every key embeds a generation
+number stored in the backend itself, and invalidate() bumps it, so that
+all the entries of the cache become unreachable at once on every instance.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import current_app
+
+DEFAULT_TTL = 60
+DEFAULT_MAX_SIZE = 512
+
+############################# Backends ########################################
+
+class MemoryBackend(object):
+    """ Least recently used cache of at most max_size entries,
+    each entry expiring after ttl seconds.
+    """
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, ttl=DEFAULT_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.time():
+                return None
+            self._entries[key] = entry
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time.time() + self.ttl)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def incr(self, key, initial_value):
+        """ Increments a counter that never expires."""
+        with self._lock:
+            value, expires_at = self._entries.pop(key, (initial_value, None))
+            self._entries[key] = (value + 1, float('inf'))
+            return value + 1
+
+class MemcacheBackend(object):
+    """ App Engine memcache, shared by all the instances of the application.
+    """
+    def __init__(self, ttl=DEFAULT_TTL):
+        from google.appengine.api import memcache
+        self.client = memcache.Client()
+        self.ttl = ttl
+
+    def get(self, key):
+        return self.client.get(key)
+
+    def set(self, key, value):
+        self.client.set(key, value, time=self.ttl)
+
+    def incr(self, key, initial_value):
+        return self.client.incr(key, initial_value=initial_value)
+
+def create_backend(config):
+    """ Returns the backend described by the application configuration."""
+    name = config.get('CACHE_BACKEND', 'memory')
+    ttl = config.get('CACHE_TTL', DEFAULT_TTL)
+    if name == 'memory':
+        return MemoryBackend(max_size=config.get('CACHE_MAX_SIZE',
+                                                 DEFAULT_MAX_SIZE),
+                             ttl=ttl)
+    if name == 'memcache':
+        return MemcacheBackend(ttl=ttl)
+    raise ValueError('Unknown cache backend %s' % name)
+
+############################# Cache ###########################################
+
+class Cache(object):
+    """ Read-through cache of function results, see the module docstring.
+
+    funnel_cache = Cache('funnel')
+
+    @funnel_cache.memoize('services')
+    def query_available_services(days_available):
+        ...
+
+    funnel_cache.invalidate()
+    """
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self._backend = None
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            self._backend = create_backend(current_app.config)
+        return self._backend
+
+    def reset(self):
+        """ Drops the backend, so that the next call uses a fresh one."""
+        self._backend = None
+
+    def _generation(self):
+        key = '%s:generation' % self.namespace
+        generation = self.backend.get(key)
+        if generation is None:
+            # starting from the clock rather than from 0 makes sure
+            # that an evicted counter never points back to old entries
+            generation = self.backend.incr(key, int(time.time() * 1000))
+        return generation
+
+    def invalidate(self):
+        """ Makes every entry of the cache unreachable."""
+        self.backend.incr('%s:generation' % self.namespace,
+                          int(time.time() * 1000))
+
+    def memoize(self, name):
+        """ Decorator caching the results of a function
+        by its positional and keyword arguments.
+        """
+        def decorator(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                if current_app.config.get('CACHE_DISABLED'):
+                    return function(*args, **kwargs)
+                key = '%s:%s:%s:%r:%r' % (self.namespace, self._generation(),
+                                          name, args,
+                                          sorted(kwargs.items()))
+                value = self.backend.get(key)
+                if value is None:
+                    value = function(*args, **kwargs)
+                    self.backend.set(key, value)
+                return value
+            return wrapper
+        return decorator
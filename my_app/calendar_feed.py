@@ -0,0 +1,177 @@
+""" Calendar feeds the agents subscribe to in Outlook or Google Calendar
+
+    GET /calendar/<token>.ics
+
+returns the bookings of an agent, or of the agents of the branch of
+a manager, as an iCalendar file, from FEED_PAST_DAYS days ago on.
+Calendar clients cannot log in: the secret token in the URL, shown on
+the profile page (see calendar_url), authenticates them. The agents and
+managers get their token when they are provisioned (fill_calendar_tokens),
+so that showing the URL is a read only.
+
+Every booking or cancellation bumps, in its transaction, the
+calendar_version of the agent (bump_calendar_versions). A feed is
+identified by the versions of its agents and by the day: a poll with a
+matching If-None-Match or If-Modified-Since gets a 304 after one or two
+indexed queries, the body of a feed that did not change comes from
+feed_cache, so that calendars polling every few minutes cost little.
+"""
+
+import binascii
+import hashlib
+import os
+from datetime import datetime, timedelta
+from flask import abort, request, url_for
+from sqlalchemy import func, or_
+from sqlalchemy.orm import joinedload
+from my_app import app
+from data_model import db, User, Role, Appointment, AppointmentArchive
+from communications import invite_event, MAILGUN_EMAIL
+from schedule import compile_schedules
+from cache import Cache
+from ics import calendar
+
+FEED_PAST_DAYS = 30
+DEFAULT_FEED_MAX_AGE = 300
+
+feed_cache = Cache('calendar_feed')
+
+############################# Tokens and versions #############################
+
+def new_calendar_token():
+    return binascii.hexlify(os.urandom(20))
+
+def fill_calendar_tokens(user_ids=None):
+    """ Gives a token to the agents and managers without one, all of them
+    or those of user_ids, in the current transaction. A token is only
+    written if there is none yet, so that two processes provisioning the
+    same user agree on the first one. Returns the number of tokens written.
+    """
+    missing = (db.session.query(User.id)
+               .filter(User.calendar_token.is_(None))
+               .filter(User.roles.any(or_(Role.name == 'end-user',
+                                          Role.name == 'manager'))))
+    if user_ids is not None:
+        missing = missing.filter(User.id.in_(list(user_ids)))
+    users = User.__table__
+    filled = 0
+    for (user_id,) in missing.all():
+        result = db.session.execute(
+            users.update()
+            .where(users.c.id == user_id)
+            .where(users.c.calendar_token.is_(None))
+            .values(calendar_token=new_calendar_token()))
+        filled += result.rowcount
+    return filled
+
+def calendar_url(user):
+    """ Returns the URL of the feed of a user, None if the user has
+    no token, ie is neither an agent nor a manager.
+    """
+    if not user.calendar_token:
+        return None
+    return url_for('calendar_feed', token=user.calendar_token, _external=True)
+
+def bump_calendar_versions(user_ids):
+    """ Marks the calendars of agents as changed, in the current transaction.
+    """
+    user_ids = set(user_ids)
+    if not user_ids:
+        return
+    users = User.__table__
+    db.session.execute(
+        users.update()
+        .where(users.c.id.in_(user_ids))
+        .values(calendar_version=func.coalesce(users.c.calendar_version, 0)
+                + 1,
+                calendar_changed_at=datetime.utcnow()))
+
+############################# Feed ############################################
+
+def feed_versions(owner):
+    """ Returns (user_id, calendar_version, calendar_changed_at)
+    of the agents in the feed of owner: the agents of the branch
+    for a manager, else the owner.
+    """
+    if owner.has_role('manager'):
+        return (db.session.query(User.id, User.calendar_version,
+                                 User.calendar_changed_at)
+                .filter(User.branch_id == owner.branch_id)
+                .filter(User.roles.any(Role.name == 'end-user'))
+                .order_by(User.id)
+                .all())
+    return [(owner.id, owner.calendar_version, owner.calendar_changed_at)]
+
+def feed_events(user_ids, today):
+    """ Returns the events of the bookings of agents from FEED_PAST_DAYS
+    days before today, including the archived ones.
+    """
+    if not user_ids:
+        return []
+    start = today - timedelta(days=FEED_PAST_DAYS)
+    schedules = compile_schedules(user_ids)
+    bookings = []
+    for model in (Appointment, AppointmentArchive):
+        bookings.extend(model.query
+                        .filter(model.user_id.in_(user_ids))
+                        .filter(model.bookable_booked == 'booked')
+                        .filter(model.date >= start)
+                        .options(joinedload(model.user)
+                                 .joinedload(User.branch))
+                        .all())
+    bookings.sort(key=lambda booking: (booking.date, booking.time,
+                                       booking.user_id))
+    return [invite_event(booking, 'PUBLISH',
+                         slot_minutes=schedules[booking.user_id].slot_minutes)
+            for booking in bookings]
+
+@feed_cache.memoize('body')
+def feed_body(name, versions, today):
+    """ Returns the content of a feed, given
+    versions: ((user_id, calendar_version), ...) of its agents,
+    which, with today, make the cache key.
+    """
+    events = feed_events([user_id for user_id, version in versions], today)
+    return calendar('PUBLISH', events, MAILGUN_EMAIL, name=name)
+
+def last_modified(versions, today):
+    """ Returns the last change of a feed, in UTC, to the second:
+    the last change of its agents, or the start of the day.
+    """
+    changes = [changed_at for user_id, version, changed_at in versions
+               if changed_at is not None]
+    moment = max(changes + [datetime.combine(today, datetime.min.time())])
+    return moment.replace(microsecond=0)
+
+############################# Routes ##########################################
+
+@app.route('/calendar/<token>.ics')
+def calendar_feed(token):
+    owner = (User.query.filter(User.calendar_token == token)
+             .options(joinedload(User.roles))
+             .first())
+    if owner is None or not owner.active:
+        abort(404)
+    today = datetime.utcnow().date()
+    versions = feed_versions(owner)
+    key = tuple((user_id, version or 0) for user_id, version, _ in versions)
+    etag = hashlib.md5('%s:%r:%s' % (owner.id, key, today)).hexdigest()
+    modified = last_modified(versions, today)
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains(etag)
+    else:
+        not_modified = (request.if_modified_since is not None
+                        and modified <= request.if_modified_since
+                        .replace(tzinfo=None))
+    if not_modified:
+        response = app.response_class(status=304)
+        del response.headers['Content-Type']
+    else:
+        response = app.response_class(
+            feed_body(owner.name or owner.email, key, today),
+            mimetype='text/calendar')
+    response.set_etag(etag)
+    response.last_modified = modified
+    response.headers['Cache-Control'] = 'private, max-age=%s' % (
+        app.config.get('CALENDAR_FEED_MAX_AGE', DEFAULT_FEED_MAX_AGE))
+    return response
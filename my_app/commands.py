@@ -0,0 +1,67 @@
+""" Maintenance commands, run with the flask command line:
+
+    FLASK_APP=my_app flask <command>
+"""
+
+import click
+from my_app import app
+from migrations import upgrade
+from initial_data import seed
+from availability import rebuild_availability, check_availability
+from bitmap import convert_slots
+
+@app.cli.command('upgrade-db')
+def upgrade_db():
+    """ Creates the missing tables and indexes of an existing database."""
+    report = upgrade()
+    click.echo('columns added: %s'
+               % (', '.join(report['columns_added']) or 'none'))
+    click.echo('duplicate slots removed: %s'
+               % report['duplicate_slots_removed'])
+    click.echo('upcoming bookings marked: %s'
+               % report['active_phones_filled'])
+    click.echo('calendar tokens created: %s'
+               % report['calendar_tokens_filled'])
+    click.echo('indexes created: %s'
+               % (', '.join(report['indexes_created']) or 'none'))
+    click.echo('availability summary rows: %s' % report['availability_rows'])
+
+@app.cli.command('seed')
+def seed_db():
+    """ Creates or upgrades the database, then adds the initial data."""
+    upgrade()
+    report = seed()
+    for table in sorted(report):
+        click.echo('%s rows added: %s' % (table, report[table]))
+
+@app.cli.command('rebuild-availability')
+def rebuild_availability_command():
+    """ Recomputes the availability summary from the appointments."""
+    click.echo('availability summary rows: %s' % rebuild_availability())
+
+@app.cli.command('check-availability')
+@click.pass_context
+def check_availability_command(context):
+    """ Lists the differences between the availability summary
+    and the appointments, exits with status 1 if there are some.
+    """
+    differences = check_availability()
+    for key, summary_count, actual_count in differences:
+        click.echo('service %s, market %s, branch %s, %s: %s in the summary, '
+                   '%s bookable' % (key + (summary_count, actual_count)))
+    click.echo('%s differences' % len(differences))
+    if differences:
+        context.exit(1)
+
+@app.cli.command('convert-slots')
+@click.argument('engine', type=click.Choice(['bitmap', 'rows']))
+def convert_slots_command(engine):
+    """ Moves the slots to come to an availability engine (see bitmap.py),
+    to be run before setting AVAILABILITY_ENGINE to it.
+    """
+    report = convert_slots(engine)
+    click.echo('agent-days converted: %s' % report['agent_days'])
+    click.echo('appointments added: %s' % report['appointments_added'])
+    click.echo('appointments removed: %s' % report['appointments_removed'])
+    app.config['AVAILABILITY_ENGINE'] = engine
+    click.echo('availability summary rows: %s' % rebuild_availability())
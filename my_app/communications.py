@@ -1,12 +1,16 @@
 """ Functions to communicate with employees/ customers """
 
 import pytz
-import requests
+import threading
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from icalendar import Calendar, Event
-from twilio.rest import Client
 import StringIO
-from data_model import Branch, User, Appointment
+from flask import current_app
+from ics import calendar, utc_stamp
+from schedule import compile_schedules
+
+# the provider SDKs (requests, twilio) are imported by the
+# functions using them, so that an instance does not load them on start up
 
 ##################### SMS COMMUNICATION #######################################
 
@@ -17,8 +21,51 @@ MAILGUN_ADDRESS = '<your_hhtp_call_address>'
 MAILGUN_EMAIL = '<your_email_address>'
 MAILGUN_KEY = '<your_key>'
 
-def send_sms(appointment, sms_method):
-    """ Sends a message to the customers via the Twilio API
+# connections kept open to each provider, ie the number of messages
+# that can be delivered at the same time without reconnecting
+HTTP_POOL_SIZE = 10
+
+# seconds to connect and to wait for an answer, well under the lease
+# of the outbox messages (outbox.LEASE_SECONDS): a delivery timing out
+# is retried by the outbox instead of being claimed by another worker
+HTTP_TIMEOUT = (5, 30)
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def http_session():
+    """ Returns the HTTP session shared by all the deliveries,
+    which keeps the connections to the providers open.
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+    with _clients_lock:
+        if 'http' not in _clients:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _clients['http'] = session
+        return _clients['http']
+
+def twilio_client():
+    """ Returns the Twilio client shared by all the deliveries."""
+    from requests.adapters import HTTPAdapter
+    from twilio.rest import Client
+    from twilio.http.http_client import TwilioHttpClient
+    with _clients_lock:
+        if 'twilio' not in _clients:
+            http_client = TwilioHttpClient(pool_connections=True)
+            adapter = HTTPAdapter(
+                pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+            http_client.session.mount('https://', adapter)
+            _clients['twilio'] = Client(TWILIO_SID, TWILIO_TOKEN,
+                                        http_client=http_client)
+        return _clients['twilio']
+
+def sms_message(appointment, sms_method):
+    """ Returns the text sent to the customers
     to create, cancel, or confirm the appointment.  
     """
     if sms_method == 'PUBLISH':
@@ -30,68 +77,128 @@ cancel" %(appointment.time,appointment.date)
         message= "A friendly reminder: %s is expecting you tomorrow %s at %s."%(
                 appointment.user.name, appointment.time,
                 appointment.user.branch.name)
-    account_sid = TWILIO_SID
-    auth_token = TWILIO_TOKEN
-    client=Client(account_sid,auth_token)
-    client.messages.create(to=appointment.booked_by_phone,
+    return message
+
+def send_sms(to, message):
+    """ Sends a message to a customer via the Twilio API."""
+    twilio_client().messages.create(to=to,
                         from_=TWILIO_NUMBER,
                         body=message)
     return
 
-def send_reminder(timezone):
-    """ Triggers the send_sms function for the right customers
-    to remind the customers of the appointment.
-    """
-    tomorrow = datetime.now(pytz.timezone(timezone)).date()+timedelta(days=1)
-    appointments = (Appointment.query
-                    .filter(Appointment.date==tomorrow)
-                    .filter(Appointment.bookable_booked=="booked")
-                    .join(Appointment.user).join(User.branch)
-                    .filter(Branch.time_zone==timezone)
-                    .all())
-    for appointment in appointments:
-        send_sms(appointment, sms_method='CONFIRM')
-    return
-
 ######################### EMAIL COMMUNICATION #################################
 
+UID_DOMAIN = 'flask-appointments'
+
+def invite_event(appointment, method, slot_minutes=None):
+    """ Returns the event (see ics.py) of the invite sent to the agent
+    about the booking (method 'PUBLISH') or cancellation ('CANCEL')
+    of an appointment. The UID is made of the id of the appointment and
+    of the time of the booking: the cancellation replaces the event of
+    the booking, a new booking of the same slot is a new event.
+    slot_minutes is the length of the appointment, by default
+    the one of the agent's schedule.
+    """
+    tz = pytz.timezone(appointment.user.branch.time_zone)
+    date_start = tz.localize(
+        datetime.combine(appointment.date, appointment.time))
+    if slot_minutes is None:
+        schedule = compile_schedules([appointment.user_id])
+        slot_minutes = schedule[appointment.user_id].slot_minutes
+    date_end = date_start + timedelta(minutes=slot_minutes)
+    booked_at = (appointment.booked_at.strftime('%Y%m%dT%H%M%S')
+                 if appointment.booked_at else '')
+    if method == 'PUBLISH':
+        sequence = 0
+        summary = appointment.booked_by_name + "'s appointment"
+        description = (appointment.booked_by_name + ' would like to meet for '
+                       + appointment.topic + '. Their number: '
+                       + appointment.booked_by_phone)
+    if method == 'CANCEL':
+        sequence = 1
+        summary = appointment.booked_by_name + ' appointment cancellation'
+        description = ('Cancelling ' + appointment.booked_by_name
+                       + "'s appointment")
+    return {'uid': 'booking-%s-%s@%s' % (appointment.id, booked_at,
+                                         UID_DOMAIN),
+            'sequence': sequence,
+            'method': method,
+            'start': utc_stamp(date_start),
+            'end': utc_stamp(date_end),
+            'summary': summary,
+            'description': description,
+            'appointment_id': appointment.id}
+
 def create_ics_file(_appointment, _ics_method):
     """ Returns an ICS file (the standard for email invitations)
     that will be sent to the agent to let them know
     if an appointment is booked or cancelled
     """
-    tz = pytz.timezone(_appointment.user.branch.time_zone)
-    date_start = tz.localize(
-        datetime.combine(_appointment.date,_appointment.time))
-    date_end = date_start+timedelta(hours=1)
-    filename = str(_appointment.id)+".ics"
-    #step 1: creating the message
-    if _ics_method =='PUBLISH':
-        sequence = 1
-        summary = _appointment.booked_by_name+"'s appointment"
-        description = _appointment.booked_by_name+' would like to meet for '\
-                    +_appointment.topic+'.His number :'+_appointment.booked_by_phone
-    if _ics_method =='CANCEL':
-        sequence = 2
-        summary = _appointment.booked_by_name+' appointment cancellation'
-        description = 'Cancelling' +_appointment.booked_by_name+"'s appointment"
-    #step 2: embedding message in the ICS format
-    event = Event()
-    event.add('dtstart', date_start)
-    event.add('dtend', date_end)
-    event.add('description', description)
-    event.add('summary', summary)
-    event.add('organizer', MAILGUN_EMAIL)
-    event.add('sequence', sequence)
-    event['uid'] = 'boh_booking'+str(_appointment.id)
-    cal = Calendar()
-    cal.add('prodid', '-//My calendar application//example.com//')
-    cal.add('method', _ics_method)
-    cal.add_component(event)
-    cal_content = cal.to_ical()
+    event = invite_event(_appointment, _ics_method)
     ics_file = StringIO.StringIO()
-    ics_file.write(cal_content)
-    return ics_file, filename
+    ics_file.write(calendar(_ics_method, [event], MAILGUN_EMAIL))
+    return ics_file, str(_appointment.id) + ".ics"
+
+def invite_due(event, now=None):
+    """ Returns when the invite of an event is to be sent (UTC), ie
+    now with app.config['INVITE_MODE'] 'immediate',
+    with 'digest', at the end of the current window of
+    INVITE_DIGEST_MINUTES minutes, unless the appointment starts within
+    INVITE_IMMEDIATE_HOURS hours: the windows are aligned on the clock,
+    so that the invites of a window are sent together (see send_events).
+    """
+    now = now or datetime.utcnow()
+    config = current_app.config
+    if config.get('INVITE_MODE', 'immediate') != 'digest':
+        return now
+    start = datetime.strptime(event['start'], '%Y%m%dT%H%M%SZ')
+    if start - now < timedelta(hours=config.get('INVITE_IMMEDIATE_HOURS',
+                                                24)):
+        return now
+    window = 60 * config.get('INVITE_DIGEST_MINUTES', 30)
+    epoch = datetime(1970, 1, 1)
+    elapsed = int((now - epoch).total_seconds())
+    return epoch + timedelta(seconds=(elapsed // window + 1) * window)
+
+def digest_calendars(events):
+    """ Returns the ICS files (filename, content) of the events sent
+    to an agent at once, coalesced by UID: an appointment booked then
+    cancelled before the agent heard of it is left out.
+    The bookings and the cancellations go in two calendars,
+    a calendar having a single method.
+    """
+    latest = OrderedDict()
+    for event in events:
+        previous = latest.get(event['uid'])
+        if (previous is not None and previous['method'] == 'PUBLISH'
+                and event['method'] == 'CANCEL'):
+            del latest[event['uid']]
+            continue
+        latest[event['uid']] = event
+    files = []
+    for method, filename in (('PUBLISH', 'bookings.ics'),
+                             ('CANCEL', 'cancellations.ics')):
+        selected = [event for event in latest.values()
+                    if event['method'] == method]
+        if selected:
+            files.append((filename,
+                          calendar(method, selected, MAILGUN_EMAIL)))
+    return files
+
+def send_events(transport, recepient, events):
+    """ Sends the invites of events to an agent: the ICS file of a single
+    event as before, or a digest of several events in one email.
+    """
+    if len(events) == 1:
+        event = events[0]
+        transport.send_invite(recepient, '%s.ics' % event['appointment_id'],
+                              calendar(event['method'], [event],
+                                       MAILGUN_EMAIL),
+                              event['method'])
+        return
+    files = digest_calendars(events)
+    if files:
+        transport.send_digest(recepient, files)
 
 def send_outlook_invite(filename, recepient, ics_file, invite_method):
     """ Sends an email with the ICS file in it via Mailgun API """
@@ -104,16 +211,75 @@ def send_outlook_invite(filename, recepient, ics_file, invite_method):
         text = "Please remove it to your calendar!"
     #step 2: send message"
     ics_file.seek(0)
-    requests.post(
+    try:
+        response = http_session().post(
+            MAILGUN_ADDRESS,
+            auth = ("api", MAILGUN_KEY),
+            files = [("attachment", (filename, ics_file))],
+            data = {
+                "from": MAILGUN_EMAIL,
+                "to": recepient,
+                "subject": subject,
+                "text": text},
+            timeout = HTTP_TIMEOUT)
+    finally:
+        ics_file.close()
+    # an error of Mailgun is retried by the outbox
+    response.raise_for_status()
+    return
+
+def send_digest_invite(recepient, files):
+    """ Sends one email with several ICS files via Mailgun API """
+    response = http_session().post(
         MAILGUN_ADDRESS,
         auth = ("api", MAILGUN_KEY),
-        files = [("attachment", (filename, ics_file))],
+        files = [("attachment", (filename, StringIO.StringIO(content)))
+                 for filename, content in files],
         data = {
             "from": MAILGUN_EMAIL,
             "to": recepient,
-            "subject": subject,
-            "text": text})
-    ics_file.close()
+            "subject": "Your appointments were updated",
+            "text": "Please update your calendar with the attached files!"},
+        timeout = HTTP_TIMEOUT)
+    response.raise_for_status()
     return
 
+######################### TRANSPORTS ##########################################
+
+class LiveTransport(object):
+    """ Delivers the messages through Twilio and Mailgun """
+    def send_sms(self, to, message):
+        send_sms(to, message)
+
+    def send_invite(self, recepient, filename, ics_content, invite_method):
+        ics_file = StringIO.StringIO()
+        ics_file.write(ics_content)
+        send_outlook_invite(filename=filename,
+                            recepient=recepient,
+                            ics_file=ics_file,
+                            invite_method=invite_method)
+
+    def send_digest(self, recepient, files):
+        send_digest_invite(recepient, files)
+
+class StubTransport(object):
+    """ Keeps the messages in memory instead of delivering them,
+    for tests, benchmarks and local runs.
+    """
+    def __init__(self):
+        self.sent = []
+
+    def send_sms(self, to, message):
+        self.sent.append(('sms', to, message))
+
+    def send_invite(self, recepient, filename, ics_content, invite_method):
+        self.sent.append(('invite', recepient, filename, invite_method))
+
+    def send_digest(self, recepient, files):
+        self.sent.append(('digest', recepient, files))
+
+_transports = {'live': LiveTransport(), 'stub': StubTransport()}
 
+def get_transport(name):
+    """ Returns the transport named in app.config['NOTIFICATION_TRANSPORT']"""
+    return _transports[name]
@@ -0,0 +1,196 @@
+""" Configuration of the application for each environment
+
+The environment is read from the APP_ENV environment variable:
+- 'production': Cloud SQL (MySQL) over its unix socket, live notifications,
+  memcache, admin pages loaded on first use; the default on App Engine,
+- 'test': the SQLite file my_app/test.db, notifications kept in memory;
+  the default everywhere else.
+
+The database settings come from environment variables, set in app.yaml
+(secrets in secrets.yaml, which is not under version control):
+- CLOUDSQL_USER, CLOUDSQL_PASSWORD, CLOUDSQL_DATABASE,
+  CLOUDSQL_CONNECTION_NAME: the Cloud SQL instance,
+- DATABASE_URI: any SQLAlchemy URI, overrides the above,
+- DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_RECYCLE, DB_POOL_TIMEOUT:
+  the connection pool of MySQL.
+
+AVAILABILITY_ENGINE picks how the slots are stored (see bitmap.py):
+'rows' (the default), one appointment per slot, or 'bitmap', one row per
+agent and day, the appointments being created when booked.
+
+On MySQL the connections come from a TimedQueuePool, which measures how
+long the requests wait for a connection (see pool_stats), and are checked
+with a ping when taken from the pool, so that a connection closed by
+the server is replaced instead of failing with "MySQL server has gone away".
+"""
+
+import os
+import threading
+import time
+from urllib import quote_plus
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool
+
+# the pool of an instance serves max_concurrent_requests (see app.yaml):
+# 10 connections kept open, 10 more under load, the ones idle for more
+# than 30 minutes are reopened before the server closes them
+DEFAULT_POOL_SIZE = 10
+DEFAULT_MAX_OVERFLOW = 10
+DEFAULT_POOL_RECYCLE = 1800
+DEFAULT_POOL_TIMEOUT = 10
+
+AVAILABILITY_ENGINES = ('rows', 'bitmap')
+
+# the SQLite file of the test environment, next to this module
+TEST_DATABASE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'test.db')
+
+CLOUDSQL_URI = ('mysql+mysqldb://{user}:{password}@/{database}'
+                '?unix_socket=/cloudsql/{connection_name}')
+
+ENVIRONMENTS = {
+    'production': {
+        'NOTIFICATION_TRANSPORT': 'live',
+        'OUTBOX_DISPATCH': 'taskqueue',
+        'TWILIO_VALIDATE_SIGNATURE': True,
+        'CACHE_BACKEND': 'memcache',
+        'LAZY_ADMIN': True,
+    },
+    'test': {
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + TEST_DATABASE,
+        'NOTIFICATION_TRANSPORT': 'stub',
+        'OUTBOX_DISPATCH': 'thread',
+        'CACHE_BACKEND': 'memory',
+        'LAZY_ADMIN': False,
+    },
+}
+
+############################# Environment #####################################
+
+def current_environment(environ=None):
+    """ Returns the name of the environment the application runs in."""
+    environ = os.environ if environ is None else environ
+    if environ.get('APP_ENV'):
+        return environ['APP_ENV']
+    if environ.get('SERVER_SOFTWARE', '').startswith('Google App Engine'):
+        return 'production'
+    return 'test'
+
+def cloudsql_uri(environ):
+    """ Returns the URI of the Cloud SQL database described by environ."""
+    names = ('CLOUDSQL_USER', 'CLOUDSQL_PASSWORD', 'CLOUDSQL_DATABASE',
+             'CLOUDSQL_CONNECTION_NAME')
+    missing = [name for name in names if name not in environ]
+    if missing:
+        raise RuntimeError('Missing environment variables: %s'
+                           % ', '.join(missing))
+    return CLOUDSQL_URI.format(
+        user=environ['CLOUDSQL_USER'],
+        password=quote_plus(environ['CLOUDSQL_PASSWORD']),
+        database=environ['CLOUDSQL_DATABASE'],
+        connection_name=environ['CLOUDSQL_CONNECTION_NAME'])
+
+def database_config(environment, environ):
+    """ Returns the database settings of an environment."""
+    uri = environ.get('DATABASE_URI')
+    if uri is None:
+        if environment == 'production':
+            uri = cloudsql_uri(environ)
+        else:
+            uri = ENVIRONMENTS[environment]['SQLALCHEMY_DATABASE_URI']
+    config = {'SQLALCHEMY_DATABASE_URI': uri}
+    if uri.startswith('mysql'):
+        config.update({
+            'SQLALCHEMY_POOL_SIZE':
+                int(environ.get('DB_POOL_SIZE', DEFAULT_POOL_SIZE)),
+            'SQLALCHEMY_MAX_OVERFLOW':
+                int(environ.get('DB_MAX_OVERFLOW', DEFAULT_MAX_OVERFLOW)),
+            'SQLALCHEMY_POOL_RECYCLE':
+                int(environ.get('DB_POOL_RECYCLE', DEFAULT_POOL_RECYCLE)),
+            'SQLALCHEMY_POOL_TIMEOUT':
+                int(environ.get('DB_POOL_TIMEOUT', DEFAULT_POOL_TIMEOUT)),
+            'SQLALCHEMY_POOL_CLASS': TimedQueuePool})
+    return config
+
+def configure(app, environ=None):
+    """ Sets the configuration of app for the current environment."""
+    environ = os.environ if environ is None else environ
+    environment = current_environment(environ)
+    if environment not in ENVIRONMENTS:
+        raise ValueError('Unknown environment %s' % environment)
+    engine = environ.get('AVAILABILITY_ENGINE', 'rows')
+    if engine not in AVAILABILITY_ENGINES:
+        raise ValueError('Unknown availability engine %s' % engine)
+    app.config['ENVIRONMENT'] = environment
+    app.config['AVAILABILITY_ENGINE'] = engine
+    app.config.update(ENVIRONMENTS[environment])
+    app.config.update(database_config(environment, environ))
+
+############################# Connection pool #################################
+
+class TimedQueuePool(QueuePool):
+    """ QueuePool recording how long the connections are waited for."""
+    def __init__(self, *args, **kwargs):
+        QueuePool.__init__(self, *args, **kwargs)
+        self._wait_lock = threading.Lock()
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.timeouts = 0
+
+    def _do_get(self):
+        start = time.time()
+        try:
+            return QueuePool._do_get(self)
+        except exc.TimeoutError:
+            with self._wait_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            waited = time.time() - start
+            with self._wait_lock:
+                self.waits += 1
+                self.wait_seconds += waited
+                self.max_wait_seconds = max(self.max_wait_seconds, waited)
+
+@event.listens_for(TimedQueuePool, 'checkout')
+def ping_connection(dbapi_connection, connection_record, connection_proxy):
+    """ Makes sure that a connection taken from the pool is still open:
+    a DisconnectionError makes the pool retry with a new connection.
+    """
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute('SELECT 1')
+    except Exception:
+        raise exc.DisconnectionError()
+    finally:
+        cursor.close()
+
+def pool_stats(engine):
+    """ Returns the state of the connection pool of an engine."""
+    pool = engine.pool
+    stats = {'pool': type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        stats.update({'size': pool.size(),
+                      'checked_in': pool.checkedin(),
+                      'checked_out': pool.checkedout(),
+                      'overflow': pool.overflow()})
+    if isinstance(pool, TimedQueuePool):
+        with pool._wait_lock:
+            stats.update({'waits': pool.waits,
+                          'timeouts': pool.timeouts,
+                          'max_wait_seconds': pool.max_wait_seconds,
+                          'mean_wait_seconds':
+                              pool.wait_seconds / max(pool.waits, 1)})
+    return stats
+
+class Database(SQLAlchemy):
+    """ Flask-SQLAlchemy using app.config['SQLALCHEMY_POOL_CLASS']
+    as the connection pool, when set.
+    """
+    def apply_driver_hacks(self, app, info, options):
+        pool_class = app.config.get('SQLALCHEMY_POOL_CLASS')
+        if pool_class is not None:
+            options['poolclass'] = pool_class
+        super(Database, self).apply_driver_hacks(app, info, options)
@@ -1,99 +1,170 @@
 """ Functions that involve querying the database, called from views.py """
 
-from datetime import datetime, timedelta, time
-from data_model import db, Branch, User, Appointment, Market
-from data_model import Services, users_services
-from communications import create_ics_file, send_outlook_invite, send_sms
+from datetime import datetime, timedelta
+# the first datetime.strptime imports _strptime, which fails when
+# two threads of the instance do it at the same time
+import _strptime
+from data_model import db, Branch, User, Appointment, Market, Role
+from data_model import Services, users_services, AvailabilitySummary
+from data_model import AgentDay
+from availability import record_changes, rebuild_availability
+from availability import refresh_availability
+from availability import bump_availability_version
+from bitmap import bitmap_engine, agent_slots, first_bookable_slots
+from bitmap import generate_agent_days, claim_slot, release_slots
+from bitmap import toggle_slots, resync_agent_days
+from communications import invite_event, invite_due, sms_message
+from outbox import enqueue, dispatch_outbox, pending_due
+from schedule import compile_schedules, max_horizon_days, DEFAULT_HORIZON_DAYS
+from cache import Cache
+from calendar_feed import bump_calendar_versions, fill_calendar_tokens
+from sqlalchemy import func, and_, or_, select, exists
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import contains_eager
 from operator import attrgetter
 import pytz
 
+# number of days shown around the day picked by the customer
+DISPLAY_WINDOW_DAYS = 5
+
+# slots deleted per statement when the schedules change
+RESYNC_CHUNK = 500
+
+# slots matched per statement when toggled,
+# SQLite limits the depth of expressions
+TOGGLE_CHUNK = 100
+
+# option lists of the customer funnel, see availability_changed()
+funnel_cache = Cache('funnel')
+
+# the days offered by the customer funnel start from the date there
+FUNNEL_TIME_ZONE = 'Pacific/Honolulu'
+
 ############################# Queries #########################################
 
+def funnel_today():
+    """ Returns the date the days offered by the funnel start from."""
+    return datetime.now(pytz.timezone(FUNNEL_TIME_ZONE)).date()
+
+@funnel_cache.memoize('market_time_zone')
+def query_market_time_zone(where):
+    """ Returns the time zone of the branches of a market, None if
+    the market has none, see query_market_appointments.
+    """
+    branch = (Branch.query.join(Market)
+              .filter(Market.name == where)
+              .order_by(Branch.id)
+              .first())
+    return branch.time_zone if branch else None
+
+@funnel_cache.memoize('services')
 def query_available_services(days_available):
     """ Returns the list of all services that can be booked."""
-    today = datetime.now(pytz.timezone('Pacific/Honolulu')).date()
-    available_services = (Services.query.distinct()
-        .join(users_services)
-        .join(User)
-        .join(Appointment)
-        .filter(Appointment.bookable_booked=='bookable')
-        .filter(Appointment.date >today)
-        .filter(Appointment.date <= today + timedelta (days=days_available))
+    today = funnel_today()
+    available_services = (db.session.query(Services.name).distinct()
+        .join(AvailabilitySummary,
+              AvailabilitySummary.services_id == Services.id)
+        .filter(AvailabilitySummary.bookable_count > 0)
+        .filter(AvailabilitySummary.date > today)
+        .filter(AvailabilitySummary.date
+                <= today + timedelta(days=days_available))
         .all())
     available_services = [service.name for service in available_services]
     available_services.sort()
     return available_services
 
+@funnel_cache.memoize('markets')
 def query_available_markets(days_available, what):
     """ Returns the list of all markets where appointments can be booked."""
-    today = datetime.now(pytz.timezone('Pacific/Honolulu')).date()
-    available_locations = (Market.query.distinct()
-                            .with_entities(Market.name)
-                            .join(Branch)
-                            .join(User)
-                            .join(users_services)
-                            .join(Appointment)
-                            .filter(Appointment.bookable_booked=='bookable')
-                            .filter(Appointment.date >today)
-                            .join(Services)
+    today = funnel_today()
+    available_locations = (db.session.query(Market.name).distinct()
+                            .join(AvailabilitySummary,
+                                  AvailabilitySummary.market_id == Market.id)
+                            .join(Services,
+                                  AvailabilitySummary.services_id
+                                  == Services.id)
                             .filter(Services.name == what)
+                            .filter(AvailabilitySummary.bookable_count > 0)
+                            .filter(AvailabilitySummary.date > today)
                             .all())
     available_locations = [mkt.name for mkt in available_locations]
     available_locations.sort()
     return available_locations
 
+@funnel_cache.memoize('days')
 def query_available_days(what, where, days_available):
     """ Returns the list of all days when appointments can be booked."""
-    today = datetime.now(pytz.timezone('Pacific/Honolulu')).date()
-    available_days = (Appointment.query
-                        .distinct()
-                        .filter(Appointment.bookable_booked=='bookable')
-                        .filter(Appointment.date >today)
-                        .join(User)
-                        .join(users_services)
-                        .join(Services)
+    today = funnel_today()
+    available_days = (db.session.query(AvailabilitySummary.date).distinct()
+                        .join(Services,
+                              AvailabilitySummary.services_id == Services.id)
                         .filter(Services.name == what)
-                        .join(Branch)
-                        .join(Market)
+                        .join(Market,
+                              AvailabilitySummary.market_id == Market.id)
                         .filter(Market.name == where)
-                        .all())        
+                        .filter(AvailabilitySummary.bookable_count > 0)
+                        .filter(AvailabilitySummary.date > today)
+                        .all())
     available_days = [apt.date.strftime('%Y-%m-%d') for apt in available_days]
-    available_days = list(set(available_days))
     available_days.sort()
     return available_days
 
-def find_relevant_days(day_picked, time_zone):
+@funnel_cache.memoize('service_names')
+def query_service_names():
+    """ Returns the names of all the services, bookable or not."""
+    return [name for (name,) in
+            db.session.query(Services.name).order_by(Services.id)]
+
+@funnel_cache.memoize('horizon_days')
+def query_horizon_days():
+    """ Returns the number of days, starting today,
+    for which appointments can be booked, see schedule.max_horizon_days.
+    """
+    return max_horizon_days()
+
+def find_relevant_days(day_picked, time_zone,
+                       horizon_days=DEFAULT_HORIZON_DAYS,
+                       window_days=DISPLAY_WINDOW_DAYS):
     """ Returns the first and last day to show the customer
     when booking appointment,
     The application shows days around the day chosen by the customer
     to increase the level of choice
     """
     first_apt_day = datetime.now(pytz.timezone(time_zone)).date() + timedelta(days=1)
-    last_apt_day = first_apt_day + timedelta(days=13)
-    if (day_picked - timedelta(days=2))< first_apt_day:
-        start_query_date = first_apt_day
-        end_query_date = start_query_date+timedelta(days=4)
-    elif (day_picked + timedelta(days=2))>= last_apt_day:
-        end_query_date = last_apt_day
-        start_query_date = end_query_date - timedelta(days=4)
-    else:
-        start_query_date = day_picked - timedelta(days=2)
-        end_query_date = day_picked + timedelta(days=2)
+    last_apt_day = first_apt_day + timedelta(days=horizon_days - 2)
+    start_query_date = day_picked - timedelta(days=window_days // 2)
+    start_query_date = min(start_query_date,
+                           last_apt_day - timedelta(days=window_days - 1))
+    start_query_date = max(start_query_date, first_apt_day)
+    end_query_date = start_query_date + timedelta(days=window_days - 1)
     return start_query_date, end_query_date
 
 def query_market_appointments(what, where, when):
-    """ Returns available appointments for a full market"""
+    """ Returns available appointments for a full market, ie
+    one dictionary per branch as returned by query_branch_appointment,
+    the first bookable appointments of every branch being loaded
+    with a single query.
+    """
     branches = (Branch.query
                     .join(Market)
                 .filter(Market.name==where)
                 .join(User)
                 .join(User.services)
                 .filter(Services.name==what)
+                .order_by(Branch.id)
                 .all())
+    if not branches:
+        return []
     time_zone=branches[0].time_zone
     selected_date=datetime.strptime(when, '%Y-%m-%d').date()
-    start, stop = find_relevant_days(selected_date, time_zone=time_zone)
-    data = [query_branch_appointment(branch, what, start, stop)
+    start, stop = find_relevant_days(selected_date, time_zone=time_zone,
+                                     horizon_days=query_horizon_days())
+    slots = query_first_bookable_appointments(
+        what, [branch.id for branch in branches], start, stop)
+    branch_slots = {}
+    for branch_id, appointment in slots:
+        branch_slots.setdefault(branch_id, []).append(appointment)
+    data = [build_branch_grid(branch, branch_slots.get(branch.id, []))
             for branch in branches]
     return data
 
@@ -108,80 +179,122 @@ def query_user_appointment(user_id, start_query_date=None, end_query_date=None):
     user_apt_days: a list of all the days for which we have an appointment
     """
     user = User.query.filter_by(id=user_id).join(User.branch).first()
-    if start_query_date and end_query_date:
-        appointments = (Appointment.query.
-                            filter_by(user_id=user.id).
-                            filter(Appointment.date >=start_query_date).
-                            filter(Appointment.date <=end_query_date).
-                            order_by(Appointment.time.asc()).
-                            all())
-    else:
+    if not (start_query_date and end_query_date):
         time_zone = user.branch.time_zone
-        today = datetime.now(pytz.timezone(time_zone)).date()
-        appointments = (Appointment.query.
-                            filter_by(user_id=user.id).
-                            filter(Appointment.date >=today).
-                            order_by(Appointment.time.asc()).
-                            all())
-        if not appointments:
-            #checkpoint 1: the user has some appointments (ie not just added)
-            add_tbd_appointments(user_id)
-            appointments = (Appointment.query.
-                                filter_by(user_id=user.id).
-                                filter(Appointment.date >=today).
-                                order_by(Appointment.time.asc()).
-                                all())
-    user_apt=[]
-    user_apt_days=list(set([appointment.date for appointment in appointments]))
-    user_apt_days.sort()
-    user_apt_times=list(set([appointment.time for appointment in appointments]))
-    user_apt_times.sort()
-    for my_time in user_apt_times:
-        user_apt.append(sorted([appointment for appointment in appointments if appointment.time==my_time],
-                               key=attrgetter('date')))
+        start_query_date = datetime.now(pytz.timezone(time_zone)).date()
+        end_query_date = None
+    if bitmap_engine():
+        appointments = agent_slots([user.id], start_query_date,
+                                   end_query_date)[user.id]
+        return build_user_calendar(user, appointments)
+    appointments = (Appointment.query.
+                        filter_by(user_id=user.id).
+                        filter(Appointment.date >=start_query_date))
+    if end_query_date:
+        appointments = appointments.filter(Appointment.date <=end_query_date)
+    appointments = appointments.order_by(Appointment.time.asc()).all()
+    return build_user_calendar(user, appointments)
+
+def build_user_calendar(user, appointments):
+    """returns the appointments of one agent
+    in a way that is easy to use for the front end
+    ie a dictionary with:
+    user_id
+    user_branch_name
+    user_branch_address
+    user_apt: a list (one per time) of list of user appointment, by date
+    user_apt_days: a list of all the days for which we have an appointment
+    The appointments are grouped in a single pass.
+    """
+    rows = {}
+    days = set()
+    for appointment in appointments:
+        rows.setdefault(appointment.time, []).append(appointment)
+        days.add(appointment.date)
+    user_apt = [sorted(rows[my_time], key=attrgetter('date'))
+                for my_time in sorted(rows)]
     data={'user': user.name,
     'user_id': user.id,
     'user_apt':user_apt,
-    'user_apt_days':user_apt_days,
+    'user_apt_days':sorted(days),
     'user_branch_name':user.branch.name,
     'user_branch_address':user.branch.address }
     return data
 
-def query_branch_appointment(branch, what, start_query_date, end_query_date):
+def query_branch_calendar(branch_id):
+    """returns the appointments of every agent of a branch,
+    as a list of dictionaries (see build_user_calendar),
+    loading the agents with one query and their appointments with another.
+    """
+    users = (User.query
+             .filter_by(branch_id=branch_id)
+             .join(User.roles)
+             .filter(Role.id == 2)
+             .join(User.branch)
+             .options(contains_eager(User.branch))
+             .order_by(User.id)
+             .all())
+    if not users:
+        return []
+    today = datetime.now(pytz.timezone(users[0].branch.time_zone)).date()
+    if bitmap_engine():
+        user_appointments = agent_slots([user.id for user in users], today)
+        return [build_user_calendar(user, user_appointments[user.id])
+                for user in users]
+    user_appointments = dict((user.id, []) for user in users)
+    appointments = (Appointment.query
+                    .filter(Appointment.user_id.in_(list(user_appointments)))
+                    .filter(Appointment.date >= today)
+                    .all())
+    for appointment in appointments:
+        user_appointments[appointment.user_id].append(appointment)
+    return [build_user_calendar(user, user_appointments[user.id])
+            for user in users]
+
+def query_first_bookable_appointments(what, branch_ids,
+                                     start_query_date, end_query_date):
+    """ Returns (branch_id, appointment) for the first bookable appointment
+    of every branch, date and time, for agents offering the service.
+    The grouping happens in the database so that a single query returns
+    at most one appointment per slot of the grid.
+    """
+    if bitmap_engine():
+        return first_bookable_slots(what, branch_ids, start_query_date,
+                                    end_query_date)
+    first_appointments = (db.session.query(func.min(Appointment.id))
+                          .select_from(Appointment)
+                          .join(User)
+                          .join(users_services)
+                          .join(Services)
+                          .filter(Services.name == what)
+                          .filter(User.branch_id.in_(branch_ids))
+                          .filter(Appointment.bookable_booked == 'bookable')
+                          .filter(Appointment.date >= start_query_date)
+                          .filter(Appointment.date <= end_query_date)
+                          .group_by(User.branch_id,
+                                    Appointment.date,
+                                    Appointment.time))
+    return (db.session.query(User.branch_id, Appointment)
+            .select_from(Appointment)
+            .join(Appointment.user)
+            .filter(Appointment.id.in_(first_appointments.subquery()))
+            .all())
+
+def build_branch_grid(branch, appointments):
     """returns the appointments of one branch
     in a way that is easy to use for the front end
-    selecting a 'bookable' appointment for a specific time slot if possible
     ie a dictionary with:
-    user_id
-    user_branch_name
-    user_branch_address
-    user_apt: a list of list of user appointment 
-    user_apt_days: a list of all the days for which we have an appointment
+    branch, branch_id, branch_address
+    branch_apt: a list (one per time) of list (one per day) of appointments,
+        None when nothing can be booked
+    branch_apt_days: a list of all the days for which we have an appointment
+    appointments must hold at most one appointment per date and time
     """
-    bookable_apt = (Appointment.query.
-                join(User).
-                filter(User.branch_id == branch.id).
-                filter(Appointment.date >= start_query_date).
-                filter(Appointment.date <= end_query_date).
-                filter(Appointment.bookable_booked == 'bookable').
-                join(users_services).
-                join(Services).
-                filter(Services.name == what).
-                all())
-    branch_apt_days=sorted(list(set([x.date for x in bookable_apt])))
-    branch_apt_times=sorted(list(set([x.time for x in bookable_apt])) )
-    branch_apt=[]
-    for hour in branch_apt_times:
-        my_apt=[]
-        # for day in branch_apt_days:
-        for day in branch_apt_days:
-            try:
-                first_bookable_apt=next(x for x in bookable_apt if
-                                        (x.date==day) and (x.time==hour))
-                my_apt.append(first_bookable_apt)
-            except:
-                my_apt.append(None)
-        branch_apt.append(my_apt)
+    cells = dict(((apt.date, apt.time), apt) for apt in appointments)
+    branch_apt_days = sorted(set(day for day, hour in cells))
+    branch_apt_times = sorted(set(hour for day, hour in cells))
+    branch_apt = [[cells.get((day, hour)) for day in branch_apt_days]
+                  for hour in branch_apt_times]
     data={'branch': branch.name,
     'branch_id': branch.id,
     'branch_apt':branch_apt,
@@ -189,6 +302,16 @@ def query_branch_appointment(branch, what, start_query_date, end_query_date):
     'branch_address':branch.address }
     return data
 
+def query_branch_appointment(branch, what, start_query_date, end_query_date):
+    """returns the appointments of one branch
+    in a way that is easy to use for the front end
+    selecting a 'bookable' appointment for a specific time slot if possible
+    see build_branch_grid
+    """
+    slots = query_first_bookable_appointments(
+        what, [branch.id], start_query_date, end_query_date)
+    return build_branch_grid(branch, [apt for branch_id, apt in slots])
+
 def phone_has_appointment(phone_number):
     """ Returns the future appointment attached to the phone number
     if any. Else returns None. 
@@ -200,82 +323,394 @@ def phone_has_appointment(phone_number):
     .filter(Appointment.date >today).first()
     return appointment
  
+def toggle_rows(requested):
+    """ Switches the appointments of toggle_appointments, given
+    requested: (user_id, date, time, current status) keys,
+    with one UPDATE per target status and chunk of TOGGLE_CHUNK keys,
+    in the current transaction.
+    Returns the keys found with their status and the number of
+    appointments switched.
+    """
+    targets = {'tbd': 'bookable', 'bookable': 'tbd'}
+    appointments = Appointment.__table__
+    def matching(keys):
+        return or_(*[and_(appointments.c.user_id == user_id,
+                          appointments.c.date == data_date,
+                          appointments.c.time == data_time,
+                          appointments.c.bookable_booked == data_status)
+                     for user_id, data_date, data_time, data_status in keys])
+    def chunks(keys):
+        keys = list(keys)
+        for start in range(0, len(keys), TOGGLE_CHUNK):
+            yield keys[start:start + TOGGLE_CHUNK]
+    found = set()
+    for chunk in chunks(requested):
+        found.update(tuple(row) for row in db.session.execute(
+            select([appointments.c.user_id, appointments.c.date,
+                    appointments.c.time, appointments.c.bookable_booked])
+            .where(matching(chunk))))
+    changed = 0
+    for status, target in targets.items():
+        for chunk in chunks(key for key in found if key[3] == status):
+            result = db.session.execute(appointments.update()
+                                        .where(matching(chunk))
+                                        .values(bookable_booked=target))
+            changed += result.rowcount
+    return found, changed
+
 def toggle_appointments(data_list):
+    """ Switches appointments from bookable to not bookable ('tbd')
+    and vice versa, ie
+    data_list is a list of dictionaries with the date, time, user_id
+    and current status of the appointments,
+    the appointments are updated in a single transaction
+    (see toggle_rows, or bitmap.toggle_slots).
+    Returns a dictionary with:
+    changed: the number of appointments switched
+    skipped: the items of data_list which were not switched,
+        because they are malformed, do not exist or changed status meanwhile
+    """
+    targets = {'tbd': 'bookable', 'bookable': 'tbd'}
+    requested = {}
+    skipped = []
     for data in data_list:
-        data_date = datetime.strptime(data['date'],"%Y-%m-%d").date()
-        data_time = datetime.strptime(data['time'],"%H:%M:%S").time()
-        data_user_id = data['user_id']
-        data_status = data['status']
-        appointment_to_toggle = Appointment.query.filter_by(date = data_date,
-                                            time=data_time,
-                                            bookable_booked=data_status,
-                                            user_id=data_user_id).first()
-        if data_status == "tbd":
-            appointment_to_toggle.bookable_booked = "bookable"
-        else:
-            appointment_to_toggle.bookable_booked = "tbd"
+        try:
+            key = (int(data['user_id']),
+                   datetime.strptime(data['date'],"%Y-%m-%d").date(),
+                   datetime.strptime(data['time'],"%H:%M:%S").time(),
+                   data['status'])
+        except (KeyError, TypeError, ValueError):
+            skipped.append(data)
+            continue
+        if key[3] not in targets:
+            skipped.append(data)
+            continue
+        requested.setdefault(key, []).append(data)
+    if bitmap_engine():
+        found = toggle_slots(requested)
+        changed = len(found)
+    else:
+        found, changed = toggle_rows(requested)
+    bookable_changes = {}
+    for user_id, data_date, data_time, data_status in found:
+        key = (user_id, data_date)
+        bookable_changes[key] = (bookable_changes.get(key, 0)
+                                 + (1 if data_status == 'tbd' else -1))
+    record_changes(bookable_changes)
+    if changed:
+        bump_availability_version()
+    db.session.commit()
+    for key, items in requested.items():
+        if key not in found:
+            skipped.extend(items)
+    if changed:
+        availability_changed()
+    return {'changed': changed, 'skipped': skipped}
+
+def availability_changed():
+    """ To be called whenever appointments are created, booked, cancelled
+    or toggled, or the admin changes the data, once committed: the option
+    lists of the customer funnel are out of date. The transaction of the
+    change bumps the availability version (bump_availability_version).
+    """
+    funnel_cache.invalidate()
+
+def provision_slots(user):
+    """ Creates the appointments of an agent, to be called when a user
+    is created or gains the end-user role, so that reading a calendar
+    never has to create them, and the calendar feed token of an agent
+    or a manager. Does nothing for the other users.
+    Returns the number of appointments created.
+    """
+    if fill_calendar_tokens([user.id]):
         db.session.commit()
-    return
+    if not user.has_role('end-user'):
+        return 0
+    return generate_appointments([user.id])
 
-def add_tbd_appointments(user_id):
-    """ Adds new bookable appointments to the database for each agent."""
-    today=datetime.today()
-    for i in range(0,15):
-        current_date=today+timedelta(days=i)
-        current_date=current_date.date()
-        for j in range (8,16):
-            current_hour=time(j, 00)
-            is_there_appointment=Appointment.query.filter_by(user_id=user_id,
-                                                    time=current_hour,
-                                                    date=current_date).first()
-            if is_there_appointment:
-                pass
-            else:
-                new_appointment=Appointment(date=current_date,
-                                            time=current_hour,
-                                            booked_at= None,
-                                            bookable_booked="bookable",
-                                            topic="topic",
-                                            booked_by_name=None,
-                                            booked_by_phone=None,
-                                            user_id=user_id )
-                db.session.add(new_appointment)
-                db.session.commit()
-    return
+def resync_slots(user_ids):
+    """ Brings the slots to come of agents in line with their schedules,
+    to be called when a template or a holiday changes: deletes the slots
+    nobody booked that the schedules no longer have, eg on a closed day
+    or on the former grid, then creates the missing ones (see
+    generate_appointments). Bookings are kept, and the slots still in the
+    schedules keep their status. The caller rebuilds the availability
+    summary. Returns the number of slots, or agent-days, deleted.
+    """
+    user_ids = list(user_ids)
+    if not user_ids:
+        return 0
+    today = datetime.today().date()
+    schedules = compile_schedules(user_ids)
+    if bitmap_engine():
+        deleted = resync_agent_days(schedules, today)
+    else:
+        wanted = set((user_id, day, slot_time)
+                     for user_id, schedule in schedules.items()
+                     for day, slot_time in schedule.slots(today))
+        stale = [appointment_id for appointment_id, user_id, day, slot_time
+                 in db.session.query(Appointment.id, Appointment.user_id,
+                                     Appointment.date, Appointment.time)
+                 .filter(Appointment.user_id.in_(user_ids))
+                 .filter(Appointment.date >= today)
+                 .filter(or_(Appointment.bookable_booked != 'booked',
+                             Appointment.bookable_booked.is_(None)))
+                 if (user_id, day, slot_time) not in wanted]
+        appointments = Appointment.__table__
+        for start in range(0, len(stale), RESYNC_CHUNK):
+            db.session.execute(appointments.delete().where(
+                appointments.c.id.in_(stale[start:start + RESYNC_CHUNK])))
+        deleted = len(stale)
+    if deleted:
+        bump_availability_version()
+    db.session.commit()
+    generate_appointments(user_ids)
+    return deleted
+
+def backfill_slots():
+    """ Creates the appointments of the agents who have none to come,
+    eg agents whose provisioning failed or who were added in the database
+    directly. Returns the number of appointments created.
+    """
+    today = datetime.today().date()
+    if bitmap_engine():
+        has_slots = (exists()
+                     .where(AgentDay.user_id == User.id)
+                     .where(AgentDay.date >= today))
+    else:
+        has_slots = (exists()
+                     .where(Appointment.user_id == User.id)
+                     .where(Appointment.date >= today))
+    user_ids = [user_id for (user_id,) in db.session.query(User.id)
+                .join(User.roles)
+                .filter(Role.id == 2)
+                .filter(~has_slots)]
+    return generate_appointments(user_ids)
+
+def count_new_slots(new_appointments, existing, today, horizon):
+    """ Returns how many of the slots of new_appointments are now in the
+    database and were not in existing, the slots found before the insert,
+    including those another process added meanwhile.
+    """
+    user_ids = set(appointment['user_id'] for appointment in new_appointments)
+    present = set(db.session.query(Appointment.user_id,
+                                   Appointment.date,
+                                   Appointment.time)
+                  .filter(Appointment.user_id.in_(user_ids))
+                  .filter(Appointment.date >= today)
+                  .filter(Appointment.date < today + timedelta(days=horizon))
+                  .all())
+    slots = set((appointment['user_id'], appointment['date'],
+                 appointment['time']) for appointment in new_appointments)
+    return len((slots & present) - existing)
+
+def generate_appointments(user_ids):
+    """ Adds the missing bookable appointments of several agents, ie
+    loads the existing slots of all the agents with one query,
+    computes the missing ones in memory,
+    inserts them with one multi-row insert, in a single transaction.
+    Slots created meanwhile by another process are skipped
+    thanks to the unique index on (user_id, date, time).
+    Returns the number of appointments created.
+    With the bitmap engine, adds the missing agent-days instead and
+    returns the number of their slots.
+    """
+    user_ids = list(user_ids)
+    if not user_ids:
+        return 0
+    if bitmap_engine():
+        inserted, bookable_changes = generate_agent_days(user_ids)
+        created = sum(bookable_changes.values())
+        record_changes(bookable_changes)
+        if inserted:
+            bump_availability_version()
+        db.session.commit()
+        if inserted != len(bookable_changes):
+            # some agent-days were created meanwhile by another process
+            rebuild_availability()
+        if inserted:
+            availability_changed()
+        return created
+    today = datetime.today().date()
+    schedules = compile_schedules(user_ids)
+    horizon = max(schedule.horizon_days for schedule in schedules.values())
+    existing = set(db.session.query(Appointment.user_id,
+                                    Appointment.date,
+                                    Appointment.time)
+                   .filter(Appointment.user_id.in_(user_ids))
+                   .filter(Appointment.date >= today)
+                   .filter(Appointment.date < today + timedelta(days=horizon))
+                   .all())
+    new_appointments = [{'date': day,
+                         'time': slot_time,
+                         'booked_at': None,
+                         'bookable_booked': 'bookable',
+                         'topic': 'topic',
+                         'booked_by_name': None,
+                         'booked_by_phone': None,
+                         'user_id': user_id}
+                        for user_id in user_ids
+                        for day, slot_time in schedules[user_id].slots(today)
+                        if (user_id, day, slot_time) not in existing]
+    created = 0
+    if new_appointments:
+        insert = (Appointment.__table__.insert()
+                  .prefix_with('OR IGNORE', dialect='sqlite')
+                  .prefix_with('IGNORE', dialect='mysql'))
+        result = db.session.execute(insert, new_appointments)
+        bookable_changes = {}
+        for appointment in new_appointments:
+            key = (appointment['user_id'], appointment['date'])
+            bookable_changes[key] = bookable_changes.get(key, 0) + 1
+        if db.engine.dialect.supports_sane_multi_rowcount:
+            created = result.rowcount
+            record_changes(bookable_changes)
+        else:
+            # the rows skipped by the insert cannot be told apart:
+            # the summary of these agents and days is read again instead
+            created = count_new_slots(new_appointments, existing, today,
+                                      horizon)
+            refresh_availability(bookable_changes)
+        if created:
+            bump_availability_version()
+    db.session.commit()
+    if (created != len(new_appointments)
+            and db.engine.dialect.supports_sane_multi_rowcount):
+        # some slots were created meanwhile by another process
+        rebuild_availability()
+    if created:
+        availability_changed()
+    return created
 
 ###################### High level functions ###################################
 
-def create_appointment(appointment, phone_number, topic, booked_by_name):
+def release_past_bookings(phone_number, today):
+    """ Clears active_phone on the bookings of a phone number of today
+    or of the past, which do not prevent a new one, in the current
+    transaction.
+    """
+    appointments = Appointment.__table__
+    db.session.execute(appointments.update()
+                       .where(appointments.c.active_phone == phone_number)
+                       .where(appointments.c.date <= today)
+                       .values(active_phone=None))
+
+def upcoming_phone(appointment, today):
+    """ Returns the active_phone of an appointment: its phone number
+    if it is booked for after today, else None.
+    """
+    if (appointment.bookable_booked == 'booked'
+            and appointment.date is not None and appointment.date > today):
+        return appointment.booked_by_phone or None
+    return None
+
+def claim_appointment(user_id, apt_date, apt_time, phone_number, topic,
+                      booked_by_name):
+    """ Books a slot in the database in one conditional UPDATE, ie
+    the slot is only updated if it is still bookable,
+    the unique index on active_phone rejects a second upcoming booking
+    of the same phone number.
+    No row is read beforehand, so that two customers cannot both see
+    the slot as bookable. Returns the status (see book_appointment):
+    the transaction is rolled back unless the status is 'all_good',
+    in which case the caller commits it.
+    With the bitmap engine, the conditional UPDATE is the one of the
+    agent-day (see bitmap.claim_slot), then the appointment is inserted.
+    """
+    appointments = Appointment.__table__
+    today = datetime.now().date()
+    # bookings of today or of the past do not prevent a new one
+    release_past_bookings(phone_number, today)
+    booking = dict(bookable_booked='booked',
+                   booked_by_phone=phone_number,
+                   active_phone=phone_number,
+                   topic=topic,
+                   booked_by_name=booked_by_name,
+                   booked_at=datetime.now())
+    if bitmap_engine():
+        # only the booked slots are appointments, see bitmap.py
+        if not claim_slot(user_id, apt_date, apt_time):
+            db.session.rollback()
+            return 'appointment_just_booked'
+        statement = appointments.insert().values(
+            user_id=user_id, date=apt_date, time=apt_time, **booking)
+    else:
+        statement = (appointments.update()
+                     .where(appointments.c.user_id == user_id)
+                     .where(appointments.c.date == apt_date)
+                     .where(appointments.c.time == apt_time)
+                     .where(appointments.c.bookable_booked == 'bookable')
+                     .values(**booking))
+    try:
+        result = db.session.execute(statement)
+    except IntegrityError:
+        db.session.rollback()
+        return 'customer_has_appointment'
+    if result.rowcount != 1:
+        db.session.rollback()
+        return 'appointment_just_booked'
+    record_changes({(user_id, apt_date): -1})
+    bump_calendar_versions([user_id])
+    return 'all_good'
+
+def enqueue_notifications(appointment, method, slot_minutes=None):
+    """ Writes to the outbox, in the current transaction,
+    the invite to the agent (an event, see communications.invite_due
+    for when it is sent) and the text message to the customer
+    about the booking (method 'PUBLISH') or cancellation ('CANCEL')
+    of the appointment, slot_minutes being its length if known.
+    """
+    booked_at = appointment.booked_at.isoformat() if appointment.booked_at else ''
+    key = '%s:%s:%s' % (method, appointment.id, booked_at)
+    event = invite_event(appointment, method, slot_minutes=slot_minutes)
+    due = invite_due(event)
+    if method == 'CANCEL':
+        # the invite of the booking waiting for its digest goes with it
+        publish_due = pending_due('invite:PUBLISH:%s:%s'
+                                  % (appointment.id, booked_at))
+        if publish_due is not None:
+            due = max(due, publish_due)
+    enqueue('event', 'invite:' + key,
+            dict(event, recepient=appointment.user.email), due=due)
+    enqueue('sms', 'sms:' + key, {
+            'to': appointment.booked_by_phone,
+            'message': sms_message(appointment, sms_method=method)})
+
+def create_appointment(user_id, apt_date, apt_time, phone_number, topic,
+                       booked_by_name):
     """ Takes necessary actions when a customer books an appointment, ie
-    update the database,
-    sends an email to the agent, 
-    sends a text message to the customer
+    update the database (see claim_appointment),
+    queues an email to the agent and a text message to the customer
+    in the same transaction (see outbox.py),
+    Returns the booking status
     """
     #step 1 - update the database with the client info
-    appointment.bookable_booked = "booked"
-    appointment.booked_by_phone = phone_number
-    appointment.topic = topic
-    appointment.booked_by_name = booked_by_name
-    appointment.booked_at = datetime.now()
+    status = claim_appointment(user_id, apt_date, apt_time, phone_number,
+                               topic, booked_by_name)
+    if status != 'all_good':
+        return status
+    # populate_existing: the claim updated the row behind the session
+    appointment = (Appointment.query
+                   .filter_by(user_id=user_id, date=apt_date, time=apt_time)
+                   .join(Appointment.user)
+                   .join(User.branch)
+                   .populate_existing()
+                   .first())
+    # "step 2 - queue invite to user via email (ics file)
+    # and confirmation to client via SMS"
+    enqueue_notifications(appointment, 'PUBLISH')
+    bump_availability_version()
     db.session.commit()
-    # "step 2 - send invite to user via email (ics file)"
-    ics_file, ics_file_name = create_ics_file(
-            _appointment=appointment,
-            _ics_method='PUBLISH')
-    send_outlook_invite(
-            filename=ics_file_name,
-            recepient=appointment.user.email,
-            ics_file=ics_file,
-            invite_method='PUBLISH')
-    # "step 3 - confirm appointment to client via SMS"
-    send_sms(appointment, sms_method='PUBLISH')
-    return
+    availability_changed()
+    # "step 3 - deliver them, outside of the transaction"
+    dispatch_outbox()
+    return status
 
 def cancel_appointments(phone_number):
     """ Takes necessary actions when a customer cancels an appointment, ie
-    sends an email to the agent, 
-    sends a text message to the customer
-    updates the database
+    queues emails to the employees and text messages to the customer,
+    updates the database with one UPDATE for all the appointments
+    in a single transaction, then asks for the messages to be delivered
     """
     #step 1 - find all the client's appointments
     today=datetime.now().date()
@@ -285,27 +720,40 @@ def cancel_appointments(phone_number):
                     .join(Appointment.user)
                     .join(User.branch)
                     .all())
+    schedules = compile_schedules(set(appointment.user_id
+                                      for appointment in appointments))
+    bookable_changes = {}
     for appointment in appointments:
-        # "step 2 - send cancellations to employee via email (ics file)"
-        ics_file, ics_file_name=create_ics_file(
-                                    _appointment=appointment,
-                                    _ics_method="CANCEL")
-        send_outlook_invite(
-                 filename=ics_file_name,
-                 recepient=appointment.user.email,
-                 ics_file=ics_file,
-                 invite_method='CANCEL')
-
-        # "step 3 - confirm cancellation to client via SMS"
-        send_sms(appointment, sms_method='CANCEL')
-
-        #"step 4 - update the database"
-        appointment.bookable_booked ='bookable'
-        appointment.booked_by_name = None
-        appointment.booked_by_phone = None
-        appointment.booked_at = None
-        appointment.topic = None
-        db.session.commit()
+        # "step 2 - queue cancellations to employee via email (ics file)
+        # and to the client via SMS"
+        enqueue_notifications(
+            appointment, 'CANCEL',
+            slot_minutes=schedules[appointment.user_id].slot_minutes)
+        if appointment.bookable_booked != 'bookable':
+            key = (appointment.user_id, appointment.date)
+            bookable_changes[key] = bookable_changes.get(key, 0) + 1
+    #"step 3 - update the database"
+    if bitmap_engine():
+        # the slots become bookable again, the appointments are deleted
+        bookable_changes = release_slots(appointments)
+    elif appointments:
+        table = Appointment.__table__
+        db.session.execute(
+            table.update()
+            .where(table.c.id.in_([appointment.id
+                                   for appointment in appointments]))
+            .where(table.c.booked_by_phone == phone_number)
+            .values(bookable_booked='bookable', booked_by_name=None,
+                    booked_by_phone=None, active_phone=None,
+                    booked_at=None, topic=None))
+    record_changes(bookable_changes)
+    bump_calendar_versions(appointment.user_id for appointment in appointments)
+    if appointments:
+        bump_availability_version()
+    db.session.commit()
+    if appointments:
+        availability_changed()
+        dispatch_outbox()
     return
 
 def book_appointment(phone_number, user_id, apt_time, apt_date, topic, name):
@@ -315,25 +763,10 @@ def book_appointment(phone_number, user_id, apt_time, apt_date, topic, name):
     status 'appointment_just_booked':
         another customer just booked the appointment
     status 'all_good':
-        the appointment has been booked, ie the employee was notified,
-        the database was updated, the text confirmation was sent.
+        the appointment has been booked, ie the database was updated,
+        the employee invite and the text confirmation were queued.
     
     """
     phone_number = "+1"+str(phone_number)
-    today = datetime.now().date()
-    appointment = (Appointment.query
-        .filter(Appointment.booked_by_phone == phone_number)
-        .filter(Appointment.date >today).first())
-    if appointment is not None:
-        return 'customer_has_appointment'
-    else:
-        appointment = (Appointment.query
-                .filter_by(user_id=user_id, time=apt_time, date=apt_date)
-                .join(Appointment.user)
-                .join(User.branch)
-                .first())
-        if appointment.bookable_booked != "bookable":
-            return 'appointment_just_booked'
-        else:
-            create_appointment(appointment, phone_number, topic, name)
-            return 'all_good'
+    return create_appointment(user_id, apt_date, apt_time, phone_number,
+                              topic, name)
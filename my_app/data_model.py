@@ -2,12 +2,12 @@
 
 
 from my_app import app
-from flask_sqlalchemy import SQLAlchemy
+from config import Database
 from flask_security import RoleMixin, UserMixin
 
 ############################ Defining Tables ##########################################
 
-db = SQLAlchemy(app)
+db = Database(app)
 
 # Helper tables for many-to-many relationshipss
 # for Users-Role and Users-Services
@@ -20,7 +20,8 @@ roles_users = db.Table(
 users_services = db.Table(
     'users_services',
     db.Column('user_id', db.Integer(), db.ForeignKey('user.id')),
-    db.Column('services_id', db.Integer(), db.ForeignKey('services.id'))
+    db.Column('services_id', db.Integer(), db.ForeignKey('services.id')),
+    db.Index('ix_users_services_services_user', 'services_id', 'user_id')
 )
 
 # Other tables 
@@ -42,13 +43,22 @@ class Role(db.Model, RoleMixin):
 class User(db.Model, UserMixin):
     """ Defines the employees
     linked to a role, a branch, one or several services and appointments
+    calendar_token is the secret of the agent's calendar feed,
+    calendar_version and calendar_changed_at change with its bookings
+    (see calendar_feed.py)
     
     """
+    __table_args__ = (
+        db.Index('uq_user_calendar_token', 'calendar_token', unique=True),
+    )
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(255), unique=False)
     password = db.Column(db.String(255))
     active = db.Column(db.Boolean())
     name = db.Column(db.String(120), unique=False)
+    calendar_token = db.Column(db.String(64))
+    calendar_version = db.Column(db.Integer, default=0)
+    calendar_changed_at = db.Column(db.DateTime)
     branch_id = db.Column(db.Integer, db.ForeignKey('branch.id'))
     branch=db.relationship('Branch', backref=db.backref('branch'))
     roles = db.relationship('Role',
@@ -95,11 +105,61 @@ class Services(db.Model):
     def __str__(self):
         return self.name
 
+class SlotTemplate(db.Model):
+    """ Defines the working hours used to create the appointments
+    linked to a branch, or to one user to override the branch's template
+    closed_weekdays is a comma separated list of week days, 0 for Monday
+
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    branch_id = db.Column(db.Integer, db.ForeignKey('branch.id'))
+    branch = db.relationship('Branch', backref=db.backref('slot_templates'))
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    user = db.relationship('User', backref=db.backref('slot_templates'))
+    slot_minutes = db.Column(db.Integer, nullable=False, default=60)
+    opening_time = db.Column(db.Time, nullable=False)
+    closing_time = db.Column(db.Time, nullable=False)
+    closed_weekdays = db.Column(db.String(20), nullable=False, default='')
+    horizon_days = db.Column(db.Integer, nullable=False, default=15)
+    def __str__(self):
+        return '%s-%s every %s min' % (self.opening_time, self.closing_time,
+                                       self.slot_minutes)
+
+class Holiday(db.Model):
+    """ Defines the days when no appointment can be booked
+    linked to a branch, or to every branch if no branch is given
+
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    date = db.Column(db.Date, nullable=False, index=True)
+    name = db.Column(db.String(120))
+    branch_id = db.Column(db.Integer, db.ForeignKey('branch.id'))
+    branch = db.relationship('Branch', backref=db.backref('holidays'))
+    def __str__(self):
+        return '%s %s' % (self.date, self.name)
+
 class Appointment(db.Model):
     """ Defines the appointments
     linked to one or several users
-    
+
+    Indexes follow the access paths of crud.py:
+    - the customer funnel filters on status and date, then joins on user
+    - an agent has at most one slot per date and time
+    - bookings and cancellations look up a phone number's future slots
+    - a phone number holds at most one upcoming booking: active_phone is
+    the phone number of the booking until the appointment date is past,
+    and is otherwise NULL, which the unique index allows many times
+    Existing databases get them through migrations.upgrade().
+
     """
+    __table_args__ = (
+        db.Index('ix_appointment_status_date_user',
+                 'bookable_booked', 'date', 'user_id'),
+        db.Index('uq_appointment_user_date_time',
+                 'user_id', 'date', 'time', unique=True),
+        db.Index('ix_appointment_phone_date', 'booked_by_phone', 'date'),
+        db.Index('uq_appointment_active_phone', 'active_phone', unique=True),
+    )
     id = db.Column(db.Integer, primary_key=True)
     date= db.Column(db.Date)
     time= db.Column(db.Time)
@@ -108,9 +168,152 @@ class Appointment(db.Model):
     topic = db.Column(db.String(120))
     booked_by_name = db.Column(db.String(120))
     booked_by_phone = db.Column(db.String(120))
+    active_phone = db.Column(db.String(120))
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     user = db.relationship('User', backref=db.backref('user'))
     def __repr__(self):
         return ('<Appointment with  %s and on %s at %s >'
                 % (self.user_id, self.date, self.time))
 
+class AppointmentArchive(db.Model):
+    """ Defines the past bookings, moved out of the appointments
+    by the nightly archival (see archive.py), with the same columns
+    and ids, and the time they were archived at
+
+    """
+    __tablename__ = 'appointment_archive'
+    __table_args__ = (
+        db.Index('ix_appointment_archive_date', 'date'),
+        db.Index('ix_appointment_archive_phone', 'booked_by_phone'),
+    )
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    date= db.Column(db.Date)
+    time= db.Column(db.Time)
+    bookable_booked = db.Column(db.String(120))
+    booked_at= db.Column(db.DateTime)
+    topic = db.Column(db.String(120))
+    booked_by_name = db.Column(db.String(120))
+    booked_by_phone = db.Column(db.String(120))
+    active_phone = db.Column(db.String(120))
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    user = db.relationship('User')
+    archived_at = db.Column(db.DateTime, nullable=False)
+    def __repr__(self):
+        return ('<AppointmentArchive with  %s and on %s at %s >'
+                % (self.user_id, self.date, self.time))
+
+class AgentDay(db.Model):
+    """ Defines the slots of an agent on a day as bit masks,
+    bit i being the slot starting i * slot_minutes after first_slot,
+    used instead of the appointments not booked
+    by the bitmap availability engine (see bitmap.py)
+
+    """
+    __tablename__ = 'agent_day'
+    __table_args__ = (
+        db.Index('uq_agent_day_user_date', 'user_id', 'date', unique=True),
+        db.Index('ix_agent_day_date_user', 'date', 'user_id'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    first_slot = db.Column(db.Time, nullable=False)
+    slot_minutes = db.Column(db.Integer, nullable=False)
+    open_slots = db.Column(db.BigInteger, nullable=False, default=0)
+    bookable_slots = db.Column(db.BigInteger, nullable=False, default=0)
+    booked_slots = db.Column(db.BigInteger, nullable=False, default=0)
+    def __repr__(self):
+        return ('<AgentDay of %s on %s: %s bookable, %s booked>'
+                % (self.user_id, self.date, bin(self.bookable_slots),
+                   bin(self.booked_slots)))
+
+class AvailabilitySummary(db.Model):
+    """ Defines the number of bookable appointments
+    per service, market, branch and day, ie the options of the customer
+    funnel, kept up to date by the code changing the appointments
+    (see availability.py)
+
+    """
+    __tablename__ = 'availability_summary'
+    __table_args__ = (
+        db.Index('uq_availability_summary_key',
+                 'services_id', 'market_id', 'branch_id', 'date',
+                 unique=True),
+        db.Index('ix_availability_summary_date_services',
+                 'date', 'services_id'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    services_id = db.Column(db.Integer, db.ForeignKey('services.id'),
+                            nullable=False)
+    market_id = db.Column(db.Integer, db.ForeignKey('market.id'),
+                          nullable=False)
+    branch_id = db.Column(db.Integer, db.ForeignKey('branch.id'),
+                          nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    bookable_count = db.Column(db.Integer, nullable=False, default=0)
+    def __repr__(self):
+        return ('<AvailabilitySummary %s %s %s %s: %s>'
+                % (self.services_id, self.market_id, self.branch_id,
+                   self.date, self.bookable_count))
+
+class DataVersion(db.Model):
+    """ Defines counters bumped whenever some data changes,
+    eg 'availability' for the appointments that can be booked,
+    used to tell whether a cached copy of the data is still valid
+
+    """
+    __tablename__ = 'data_version'
+    name = db.Column(db.String(40), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    def __repr__(self):
+        return '<DataVersion %s %s>' % (self.name, self.version)
+
+class OutboxMessage(db.Model):
+    """ Defines the messages (text messages, email invites) to deliver
+    written in the same transaction as the booking they are about,
+    delivered later by outbox.drain_outbox()
+
+    """
+    __table_args__ = (
+        db.Index('uq_outbox_message_idempotency_key', 'idempotency_key',
+                 unique=True),
+        db.Index('ix_outbox_message_status_next_attempt',
+                 'status', 'next_attempt_at'),
+        db.Index('ix_outbox_message_claim_token', 'claim_token'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)
+    idempotency_key = db.Column(db.String(255), nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='pending')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False)
+    claim_token = db.Column(db.String(32))
+    last_error = db.Column(db.String(255))
+    created_at = db.Column(db.DateTime, nullable=False)
+    sent_at = db.Column(db.DateTime)
+    def __repr__(self):
+        return ('<OutboxMessage %s %s %s>'
+                % (self.kind, self.idempotency_key, self.status))
+
+class InboundMessage(db.Model):
+    """ Defines the text messages received from the customers,
+    recorded by the Twilio webhook (/cancel) and processed later
+    by inbound.process_inbound(), once per Twilio MessageSid
+
+    """
+    __table_args__ = (
+        db.Index('uq_inbound_message_sid', 'message_sid', unique=True),
+        db.Index('ix_inbound_message_status_claimed', 'status', 'claimed_at'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    message_sid = db.Column(db.String(64), nullable=False)
+    from_number = db.Column(db.String(120), nullable=False)
+    body = db.Column(db.Text)
+    status = db.Column(db.String(20), nullable=False, default='pending')
+    received_at = db.Column(db.DateTime, nullable=False)
+    claimed_at = db.Column(db.DateTime)
+    processed_at = db.Column(db.DateTime)
+    def __repr__(self):
+        return ('<InboundMessage %s from %s %s>'
+                % (self.message_sid, self.from_number, self.status))
@@ -0,0 +1,84 @@
+""" Calendar invites in the iCalendar format (RFC 5545)
+
+The invites only hold events with a start, an end, a summary and a
+description: they are written with string formatting instead of
+the icalendar package, for every booking and cancellation.
+The times are written in UTC, so that no VTIMEZONE is needed.
+
+An event is a dictionary with:
+uid: the same for the booking and the cancellation of an appointment,
+sequence: 0 for the booking, 1 for the cancellation, which replaces it,
+method: 'PUBLISH' or 'CANCEL',
+start, end: UTC times, see utc_stamp,
+summary, description: text.
+"""
+
+from datetime import datetime
+import pytz
+
+PRODID = '-//My calendar application//example.com//'
+
+# longest content line, in octets, longer ones are folded
+LINE_OCTETS = 75
+
+def utc_stamp(moment):
+    """ Returns a datetime, aware or in UTC, as a UTC date-time value."""
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(pytz.utc).replace(tzinfo=None)
+    return moment.strftime('%Y%m%dT%H%M%SZ')
+
+def escape(text):
+    """ Escapes a TEXT value: backslashes, semicolons, commas, new lines."""
+    return (text.replace('\\', '\\\\').replace(';', '\\;')
+            .replace(',', '\\,').replace('\r\n', '\\n').replace('\n', '\\n'))
+
+def fold(line):
+    """ Returns a content line, UTF-8 encoded, in lines of at most
+    LINE_OCTETS octets, the next ones starting with a space.
+    """
+    data = line.encode('utf-8') if isinstance(line, unicode) else line
+    parts = []
+    limit = LINE_OCTETS
+    while len(data) > limit:
+        cut = limit
+        # a UTF-8 character is not cut in two
+        while ord(data[cut]) & 0xC0 == 0x80:
+            cut -= 1
+        parts.append(data[:cut])
+        data = data[cut:]
+        limit = LINE_OCTETS - 1
+    parts.append(data)
+    return '\r\n '.join(parts)
+
+def event_lines(event, organizer, stamp):
+    """ Returns the content lines of the VEVENT of an event."""
+    lines = ['BEGIN:VEVENT',
+             'UID:' + event['uid'],
+             'SEQUENCE:%d' % event['sequence'],
+             'DTSTAMP:' + stamp,
+             'DTSTART:' + event['start'],
+             'DTEND:' + event['end'],
+             'SUMMARY:' + escape(event['summary']),
+             'DESCRIPTION:' + escape(event['description']),
+             'ORGANIZER:mailto:' + organizer]
+    if event['method'] == 'CANCEL':
+        lines.append('STATUS:CANCELLED')
+    lines.append('END:VEVENT')
+    return lines
+
+def calendar(method, events, organizer, now=None, name=None):
+    """ Returns the content of an ICS file holding events, which all have
+    the method of the calendar, 'PUBLISH' or 'CANCEL',
+    name being the name of a calendar subscribed to.
+    """
+    stamp = utc_stamp(now or datetime.utcnow())
+    lines = ['BEGIN:VCALENDAR',
+             'VERSION:2.0',
+             'PRODID:' + PRODID,
+             'METHOD:' + method]
+    if name is not None:
+        lines.append('X-WR-CALNAME:' + escape(name))
+    for event in events:
+        lines.extend(event_lines(event, organizer, stamp))
+    lines.append('END:VCALENDAR')
+    return '\r\n'.join(fold(line) for line in lines) + '\r\n'
@@ -0,0 +1,143 @@
+""" Text messages received from the customers
+
+Twilio posts every text message sent to our number to /cancel, and posts
+it again if the answer is slow. The webhook only checks the signature of
+the request (valid_signature), records the message once per MessageSid
+(record_inbound) and answers: the cancellation runs afterwards, through
+dispatch_inbound, which follows app.config['OUTBOX_DISPATCH'] like the
+outbox (see outbox.py):
+- 'taskqueue': an App Engine push task calls /tasks/process_inbound,
+- 'thread': a background thread of the current process does it,
+- 'inline': the current request does it right away,
+- 'none': only the /cron/process_inbound cron does it.
+A message is claimed before being processed; the claim of a worker that
+died expires after LEASE_SECONDS and the cron processes the message again,
+which is harmless: cancelling twice finds nothing the second time.
+"""
+
+import base64
+import hashlib
+import hmac
+import logging
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import and_, or_
+from data_model import db, InboundMessage
+from communications import TWILIO_TOKEN
+from crud import cancel_appointments
+from outbox import OutboxWorker
+
+LEASE_SECONDS = 300
+BATCH_SIZE = 50
+
+############################# Webhook #########################################
+
+def twilio_signature(url, params, auth_token):
+    """ Returns the signature Twilio computes for a request: the HMAC-SHA1,
+    keyed by the auth token, of the URL followed by the POST parameters
+    sorted by name, base64 encoded.
+    params: a list of (name, [values]).
+    """
+    data = url
+    for name, values in sorted(params):
+        for value in values:
+            data += name + value
+    digest = hmac.new(auth_token.encode('utf-8'), data.encode('utf-8'),
+                      hashlib.sha1).digest()
+    return base64.b64encode(digest)
+
+def valid_signature(url, params, signature):
+    """ Tells whether a request comes from Twilio, always true unless
+    app.config['TWILIO_VALIDATE_SIGNATURE'] is set.
+    """
+    if not current_app.config.get('TWILIO_VALIDATE_SIGNATURE'):
+        return True
+    if not signature:
+        return False
+    expected = twilio_signature(
+        url, params, current_app.config.get('TWILIO_AUTH_TOKEN', TWILIO_TOKEN))
+    return hmac.compare_digest(expected, str(signature))
+
+def record_inbound(message_sid, from_number, body):
+    """ Records and commits a message, unless it was recorded already.
+    Returns whether the message is new.
+    """
+    insert = (InboundMessage.__table__.insert()
+              .prefix_with('OR IGNORE', dialect='sqlite')
+              .prefix_with('IGNORE', dialect='mysql'))
+    result = db.session.execute(insert, {'message_sid': message_sid,
+                                         'from_number': from_number,
+                                         'body': body,
+                                         'status': 'pending',
+                                         'received_at': datetime.utcnow()})
+    db.session.commit()
+    return result.rowcount == 1
+
+def dispatch_inbound():
+    """ Asks for the messages recorded to be processed,
+    see the module docstring.
+    """
+    mode = current_app.config.get('OUTBOX_DISPATCH', 'thread')
+    if mode == 'taskqueue':
+        from google.appengine.api import taskqueue
+        taskqueue.add(url='/tasks/process_inbound')
+    elif mode == 'thread':
+        worker.wake()
+    elif mode == 'inline':
+        process_inbound()
+
+############################# Processing ######################################
+
+def is_cancellation(body):
+    return 'no appointment' in (body or '').lower()
+
+def _claimable(now):
+    lease_start = now - timedelta(seconds=LEASE_SECONDS)
+    return or_(InboundMessage.status == 'pending',
+               and_(InboundMessage.status == 'processing',
+                    InboundMessage.claimed_at < lease_start))
+
+def claim_message(message_id):
+    """ Claims a message for this worker, returns whether it got it."""
+    now = datetime.utcnow()
+    claimed = (InboundMessage.query
+               .filter(InboundMessage.id == message_id)
+               .filter(_claimable(now))
+               .update({InboundMessage.status: 'processing',
+                        InboundMessage.claimed_at: now},
+                       synchronize_session=False))
+    db.session.commit()
+    return claimed == 1
+
+def process_inbound(batch_size=BATCH_SIZE):
+    """ Processes the messages recorded and not processed yet:
+    cancels the appointments of the customers asking for it.
+    Returns the number of messages processed and of cancellations.
+    """
+    stats = {'processed': 0, 'cancellations': 0}
+    messages = (db.session.query(InboundMessage.id,
+                                 InboundMessage.from_number,
+                                 InboundMessage.body)
+                .filter(_claimable(datetime.utcnow()))
+                .order_by(InboundMessage.id)
+                .limit(batch_size)
+                .all())
+    for message_id, from_number, body in messages:
+        if not claim_message(message_id):
+            continue
+        if is_cancellation(body):
+            cancel_appointments(from_number)
+            stats['cancellations'] += 1
+        (InboundMessage.query
+         .filter(InboundMessage.id == message_id)
+         .update({InboundMessage.status: 'done',
+                  InboundMessage.processed_at: datetime.utcnow()},
+                 synchronize_session=False))
+        db.session.commit()
+        stats['processed'] += 1
+    if stats['processed']:
+        logging.info('%s text messages processed, %s cancellations',
+                     stats['processed'], stats['cancellations'])
+    return stats
+
+worker = OutboxWorker(drain=process_inbound, name='inbound-worker')
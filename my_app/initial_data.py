@@ -1,109 +1,129 @@
-""" Initial data commit """
+""" Initial data commit
+
+The data is inserted by the seed command (see commands.py), never when an
+instance starts: seeding only adds the rows that are missing, in a few
+multi-row inserts, and hashes the password once, if a user is missing.
+"""
 
 from my_app import app
-from crud import add_tbd_appointments
+from crud import generate_appointments
+from calendar_feed import new_calendar_token
 from data_model import db, Services, Market, Branch, User, Role
+from data_model import roles_users, users_services
 from flask_security import Security,SQLAlchemyUserDatastore, utils
+from sqlalchemy import func
 
 user_datastore = SQLAlchemyUserDatastore(db, User, Role)
 security = Security(app, user_datastore)
 
-@app.before_first_request
-def before_first_request():
-
-    # Create any database tables that don't exist yet.
-    db.create_all()
-    db.session.commit()
-
-    # Create the Roles "admin" and "end-user" -- unless they already exist
-    user_datastore.find_or_create_role(name='admin', description='Administrator')
-    user_datastore.find_or_create_role(name='end-user', description='End user')
-    user_datastore.find_or_create_role(name='manager', description='Manager')
-    encrypted_password = utils.encrypt_password('pwd')
-
-    # Create the Services
-    if not Services.query.filter_by(id=1).first():
-        service=Services(name='Deposit Account', id=1)
-        db.session.add(service)
-        db.session.commit()
-    if not Services.query.filter_by(id=2).first():
-        service=Services(name='Credit Card', id=2)
-        db.session.add(service)
-        db.session.commit()
-    if not Services.query.filter_by(id=3).first():
-        service=Services(name='Other', id=3)
-        db.session.add(service)
-        db.session.commit()
-    if not Services.query.filter_by(id=4).first():
-        service=Services(name='Mortgage - new', id=4)
-        db.session.add(service)
-        db.session.commit()
-    if not Services.query.filter_by(id=5).first():
-        service=Services(name='Mortgage - refinance', id=5)
-        db.session.add(service)
-        db.session.commit()
-
-    # Create the Markets
-    if not Market.query.filter_by(id=1).first():
-        market=Market(name="Guam",id=1)
-        db.session.add(market)
-        db.session.commit()
-    if not Market.query.filter_by(id=2).first():
-        market=Market(name="Oahu",id=2)
-        db.session.add(market)
-        db.session.commit()
-
-    # Create the Branches
-    if not Branch.query.filter_by(id=1).first():
-        branch=Branch(name="Garapan",market_id=1,time_zone="Pacific/Saipan",address="Spring Plaza, Chalan Pale Arnold, 96950",id=1 )
-        db.session.add(branch)
-        db.session.commit()
-    if not Branch.query.filter_by(id=2).first():
-        branch=Branch(name="Kailua",market_id=2,time_zone="Pacific/Honolulu",address="636 KAILUA RD, 96734",id=2)
-        db.session.add(branch)
-        db.session.commit()
-    if not Branch.query.filter_by(id=3).first():
-        branch=Branch(name="Kaneohe",market_id=2,time_zone="Pacific/Honolulu",address="45-1001 KAMEHAMEHA HWY, 96744",id=3)
-        db.session.add(branch)
-        db.session.commit()
-    if not Branch.query.filter_by(id=4).first():
-        branch=Branch(name="Waikiki",market_id=2,time_zone="Pacific/Honolulu",address="2155 KALAKAUA AVE STE 104, 96815",id=4)
-        db.session.add(branch)
-        db.session.commit()
+PASSWORD = 'pwd'
 
-    # Create the Users
-    # First an admin and a branch manager
-    if not user_datastore.get_user('admin@example.com'):
-        user_datastore.create_user(email='admin@example.com', password=encrypted_password, name="Admin User")
-        user_datastore.add_role_to_user('admin@example.com', 'admin')
+ROLES = [
+    {'id': 1, 'name': 'admin', 'description': 'Administrator'},
+    {'id': 2, 'name': 'end-user', 'description': 'End user'},
+    {'id': 3, 'name': 'manager', 'description': 'Manager'},
+]
 
-    if not user_datastore.get_user('waikiki@example.com'):
-        user_datastore.create_user(email='waikiki@example.com', password=encrypted_password, name="Wikiki Manager", branch_id=4)
-        user_datastore.add_role_to_user('waikiki@example.com', 'manager')
+SERVICES = [
+    {'id': 1, 'name': 'Deposit Account'},
+    {'id': 2, 'name': 'Credit Card'},
+    {'id': 3, 'name': 'Other'},
+    {'id': 4, 'name': 'Mortgage - new'},
+    {'id': 5, 'name': 'Mortgage - refinance'},
+]
 
-    # Then regular employees
-    if not user_datastore.get_user("john.Garapan@example.com"):
-        user_datastore.create_user(email="john.Garapan@example.com", password=encrypted_password, name="John Garapan", branch_id=1, services=Services.query.filter((Services.id==1) | (Services.id==2)  |(Services.id==3)).all() )
-        add_tbd_appointments(user_datastore.get_user("john.Garapan@example.com").id)
-        user_datastore.add_role_to_user("john.Garapan@example.com", "end-user")
+MARKETS = [
+    {'id': 1, 'name': 'Guam'},
+    {'id': 2, 'name': 'Oahu'},
+]
 
-    if not user_datastore.get_user("john.Kailua@example.com"):
-        user_datastore.create_user(email="john.Kailua@example.com", password=encrypted_password, name="John Kailua", branch_id=2, services=Services.query.filter((Services.id==1) | (Services.id==2)  |(Services.id==3)).all() )
-        add_tbd_appointments(user_datastore.get_user("john.Kailua@example.com").id)
-        user_datastore.add_role_to_user("john.Kailua@example.com", "end-user")
+BRANCHES = [
+    {'id': 1, 'name': 'Garapan', 'market_id': 1,
+     'time_zone': 'Pacific/Saipan',
+     'address': 'Spring Plaza, Chalan Pale Arnold, 96950'},
+    {'id': 2, 'name': 'Kailua', 'market_id': 2,
+     'time_zone': 'Pacific/Honolulu', 'address': '636 KAILUA RD, 96734'},
+    {'id': 3, 'name': 'Kaneohe', 'market_id': 2,
+     'time_zone': 'Pacific/Honolulu',
+     'address': '45-1001 KAMEHAMEHA HWY, 96744'},
+    {'id': 4, 'name': 'Waikiki', 'market_id': 2,
+     'time_zone': 'Pacific/Honolulu',
+     'address': '2155 KALAKAUA AVE STE 104, 96815'},
+]
 
-    if not user_datastore.get_user("john.Kailua2@example.com"):
-        user_datastore.create_user(email="john.Kailua2@example.com", password=encrypted_password, name="John Kailua II", branch_id=2, services=Services.query.filter((Services.id==4) | (Services.id==5)).all() )
-        add_tbd_appointments(user_datastore.get_user("john.Kailua2@example.com").id)
-        user_datastore.add_role_to_user("john.Kailua2@example.com", "end-user")
+# First an admin and a branch manager, then regular employees
+USERS = [
+    {'email': 'admin@example.com', 'name': 'Admin User',
+     'branch_id': None, 'role_id': 1, 'services': []},
+    {'email': 'waikiki@example.com', 'name': 'Wikiki Manager',
+     'branch_id': 4, 'role_id': 3, 'services': []},
+    {'email': 'john.Garapan@example.com', 'name': 'John Garapan',
+     'branch_id': 1, 'role_id': 2, 'services': [1, 2, 3]},
+    {'email': 'john.Kailua@example.com', 'name': 'John Kailua',
+     'branch_id': 2, 'role_id': 2, 'services': [1, 2, 3]},
+    {'email': 'john.Kailua2@example.com', 'name': 'John Kailua II',
+     'branch_id': 2, 'role_id': 2, 'services': [4, 5]},
+    {'email': 'john.kaneohe@example.com', 'name': 'John kaneohe',
+     'branch_id': 3, 'role_id': 2, 'services': [1, 2, 3]},
+    {'email': 'john.waikiki@example.com', 'name': 'John waikiki',
+     'branch_id': 4, 'role_id': 2, 'services': [1, 2, 3]},
+]
 
-    if not user_datastore.get_user("john.kaneohe@example.com"):
-        user_datastore.create_user(email="john.kaneohe@example.com", password=encrypted_password, name="John kaneohe", branch_id=3, services=Services.query.filter((Services.id==1) | (Services.id==2)  |(Services.id==3)).all() )
-        add_tbd_appointments(user_datastore.get_user("john.kaneohe@example.com").id)
-        user_datastore.add_role_to_user("john.kaneohe@example.com", "end-user")
+def insert_missing(table, rows):
+    """ Inserts the rows whose primary key or unique columns are not
+    in the table yet, leaving the existing rows as they are.
+    Returns the number of rows inserted.
+    """
+    insert = (table.insert()
+              .prefix_with('OR IGNORE', dialect='sqlite')
+              .prefix_with('IGNORE', dialect='mysql'))
+    result = db.session.execute(insert, rows)
+    if db.engine.dialect.supports_sane_multi_rowcount:
+        return result.rowcount
+    return len(rows)
 
-    if not user_datastore.get_user("john.waikiki@example.com"):
-        user_datastore.create_user(email="john.waikiki@example.com", password=encrypted_password, name="John waikiki", branch_id=4, services=Services.query.filter((Services.id==1) | (Services.id==2)  |(Services.id==3)).all() )
-        add_tbd_appointments(user_datastore.get_user("john.waikiki@example.com").id)
-        user_datastore.add_role_to_user("john.waikiki@example.com", "end-user")
+def seed():
+    """ Adds the missing roles, services, markets, branches and users,
+    and the appointments of the new agents.
+    Running it again adds nothing.
+    Returns the number of rows added per table.
+    """
+    report = {'role': insert_missing(Role.__table__, ROLES),
+              'services': insert_missing(Services.__table__, SERVICES),
+              'market': insert_missing(Market.__table__, MARKETS),
+              'branch': insert_missing(Branch.__table__, BRANCHES)}
+    # users have no unique email column: the missing ones are looked up
+    existing = set(email for (email,) in
+                   db.session.query(func.lower(User.email))
+                   .filter(func.lower(User.email)
+                           .in_([user['email'].lower() for user in USERS])))
+    missing = [user for user in USERS
+               if user['email'].lower() not in existing]
+    report['user'] = len(missing)
+    report['appointment'] = 0
+    agents = []
+    if missing:
+        password = utils.encrypt_password(PASSWORD)
+        db.session.execute(User.__table__.insert(), [
+            {'email': user['email'], 'name': user['name'],
+             'branch_id': user['branch_id'], 'password': password,
+             'active': True,
+             'calendar_token': (new_calendar_token()
+                                if user['role_id'] in (2, 3) else None)}
+            for user in missing])
+        ids = dict(db.session.query(User.email, User.id)
+                   .filter(User.email.in_([user['email']
+                                           for user in missing])))
+        db.session.execute(roles_users.insert(), [
+            {'user_id': ids[user['email']], 'role_id': user['role_id']}
+            for user in missing])
+        links = [{'user_id': ids[user['email']], 'services_id': service_id}
+                 for user in missing for service_id in user['services']]
+        if links:
+            db.session.execute(users_services.insert(), links)
+        agents = [ids[user['email']] for user in missing
+                  if user['role_id'] == 2]
     db.session.commit()
+    if agents:
+        report['appointment'] = generate_appointments(agents)
+    return report
@@ -0,0 +1,154 @@
+""" Measure of the SQL statements run by each request
+
+Every statement run by SQLAlchemy, whatever the engine, is timed and added
+to the recorders active in the current thread:
+- each Flask request has one, reported in the Server-Timing header
+  of the response (seen in the browser developer tools) and as a JSON
+  log line, with the number of statements, the time spent in the database
+  and the slowest statements,
+- tests open their own with record_queries or query_budget:
+
+    with query_budget(3):
+        client.get('/book/...')
+
+app.config['SQL_INSTRUMENTATION'] turns the request recorders off,
+app.config['SQL_SLOWEST_STATEMENTS'] is the number of statements logged.
+"""
+
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from my_app import app
+
+SLOWEST_STATEMENTS = 3
+STATEMENT_LENGTH = 200
+
+_local = threading.local()
+
+############################# Recording #######################################
+
+class QueryRecorder(object):
+    """ Number, duration and slowest of the statements run
+    while the recorder is active.
+    """
+    def __init__(self, slowest=SLOWEST_STATEMENTS):
+        self.count = 0
+        self.seconds = 0.0
+        self.statements = []
+        self.slowest = []
+        self._slowest_size = slowest
+
+    def add(self, statement, seconds):
+        self.count += 1
+        self.seconds += seconds
+        self.statements.append(statement)
+        self.slowest.append((seconds, statement))
+        self.slowest.sort(key=lambda item: item[0], reverse=True)
+        del self.slowest[self._slowest_size:]
+
+    def report(self):
+        """ Returns the statements, one per line, for failure messages."""
+        return '%s statements:\n%s' % (self.count,
+                                       '\n'.join(self.statements))
+
+def _recorders():
+    if not hasattr(_local, 'recorders'):
+        _local.recorders = []
+    return _local.recorders
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(connection, cursor, statement, parameters,
+                           context, executemany):
+    if _recorders():
+        _local.started = time.time()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(connection, cursor, statement, parameters,
+                          context, executemany):
+    recorders = _recorders()
+    if recorders:
+        seconds = time.time() - getattr(_local, 'started', time.time())
+        for recorder in recorders:
+            recorder.add(statement, seconds)
+
+def start_recording(slowest=SLOWEST_STATEMENTS):
+    """ Returns a new recorder, active in the current thread
+    until stop_recording is called.
+    """
+    recorder = QueryRecorder(slowest)
+    _recorders().append(recorder)
+    return recorder
+
+def stop_recording(recorder):
+    if recorder in _recorders():
+        _recorders().remove(recorder)
+
+@contextmanager
+def record_queries():
+    """ Records the statements run in the block, in the current thread."""
+    recorder = start_recording()
+    try:
+        yield recorder
+    finally:
+        stop_recording(recorder)
+
+@contextmanager
+def query_budget(limit):
+    """ Fails with an AssertionError when the block runs
+    more than limit statements.
+    """
+    with record_queries() as recorder:
+        yield recorder
+    if recorder.count > limit:
+        raise AssertionError('Query budget of %s exceeded by %s'
+                             % (limit, recorder.report()))
+
+############################# Requests ########################################
+
+def server_timing(recorder, total_seconds):
+    """ Returns the Server-Timing header of a request."""
+    return 'db;dur=%.1f;desc="%s queries", total;dur=%.1f' % (
+        recorder.seconds * 1000, recorder.count, total_seconds * 1000)
+
+@app.before_request
+def start_request_recording():
+    if app.config.get('SQL_INSTRUMENTATION', True):
+        g.request_started = time.time()
+        g.query_recorder = start_recording(
+            app.config.get('SQL_SLOWEST_STATEMENTS', SLOWEST_STATEMENTS))
+
+@app.after_request
+def report_request_queries(response):
+    recorder = g.get('query_recorder')
+    if recorder is None:
+        return response
+    stop_recording(recorder)
+    g.query_recorder = None
+    total_seconds = time.time() - g.request_started
+    response.headers['Server-Timing'] = server_timing(recorder,
+                                                      total_seconds)
+    logging.info(json.dumps({
+        'event': 'sql',
+        'method': request.method,
+        'path': request.path,
+        'endpoint': request.endpoint,
+        'status': response.status_code,
+        'queries': recorder.count,
+        'db_ms': round(recorder.seconds * 1000, 1),
+        'total_ms': round(total_seconds * 1000, 1),
+        'slowest': [{'ms': round(seconds * 1000, 1),
+                     'statement': statement[:STATEMENT_LENGTH]}
+                    for seconds, statement in recorder.slowest]}))
+    return response
+
+@app.teardown_request
+def stop_request_recording(exception=None):
+    # after_request is skipped when the view raised
+    recorder = g.get('query_recorder')
+    if recorder is not None:
+        stop_recording(recorder)
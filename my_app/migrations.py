@@ -0,0 +1,143 @@
+""" Upgrades of databases created with an older version of the data model
+
+db.create_all() only creates missing tables: it never touches the columns
+or the indexes of a table that already exists. The functions below bring
+an existing MySQL or SQLite database up to date with data_model.py, and
+can be run as often as needed.
+"""
+
+from datetime import datetime
+from sqlalchemy import func, inspect
+from data_model import db, Appointment
+from availability import rebuild_availability
+from calendar_feed import fill_calendar_tokens
+
+############################# Helpers #########################################
+
+def _existing_indexes(engine, table_name):
+    """ Returns the names of the indexes and unique constraints of a table."""
+    inspector = inspect(engine)
+    names = set(index['name'] for index in inspector.get_indexes(table_name))
+    names.update(constraint['name'] for constraint
+                 in inspector.get_unique_constraints(table_name))
+    return names
+
+def add_missing_columns():
+    """ Adds the columns declared in data_model.py
+    that do not exist in the database yet.
+    New columns are nullable: their values are filled by the upgrade.
+    Returns the names (table.column) of the added columns.
+    """
+    engine = db.engine
+    inspector = inspect(engine)
+    added = []
+    for table in db.metadata.sorted_tables:
+        existing = set(column['name']
+                       for column in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in existing:
+                engine.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+                    table.name, column.name,
+                    column.type.compile(dialect=engine.dialect)))
+                added.append('%s.%s' % (table.name, column.name))
+    return added
+
+def fill_active_phones():
+    """ Marks the upcoming bookings made before active_phone existed.
+    When a phone number holds several of them, the first one is marked.
+    """
+    today = datetime.now().date()
+    marked = set(phone for (phone,) in
+                 db.session.query(Appointment.active_phone)
+                 .filter(Appointment.active_phone != None))
+    first_bookings = (db.session.query(func.min(Appointment.id),
+                                       Appointment.booked_by_phone)
+                      .filter(Appointment.bookable_booked == 'booked')
+                      .filter(Appointment.booked_by_phone != None)
+                      .filter(Appointment.date > today)
+                      .group_by(Appointment.booked_by_phone)
+                      .all())
+    ids = [apt_id for apt_id, phone in first_bookings if phone not in marked]
+    filled = 0
+    if ids:
+        filled = (Appointment.query
+                  .filter(Appointment.id.in_(ids))
+                  .update({Appointment.active_phone:
+                           Appointment.booked_by_phone},
+                          synchronize_session=False))
+    db.session.commit()
+    return filled
+
+def remove_duplicate_slots():
+    """ Deletes the duplicated slots of an agent (same user, date and time)
+    so that the unique index on appointments can be created.
+    The booked slot is kept if any, else the oldest one.
+    Two bookings on the same slot cannot be solved automatically and
+    raise a ValueError listing the slot.
+    """
+    duplicates = (db.session.query(Appointment.user_id,
+                                   Appointment.date,
+                                   Appointment.time)
+                  .group_by(Appointment.user_id,
+                            Appointment.date,
+                            Appointment.time)
+                  .having(func.count(Appointment.id) > 1)
+                  .all())
+    removed = 0
+    for user_id, date, time in duplicates:
+        appointments = (Appointment.query
+                        .filter_by(user_id=user_id, date=date, time=time)
+                        .order_by(Appointment.id.asc())
+                        .all())
+        booked = [apt for apt in appointments
+                  if apt.bookable_booked == 'booked']
+        if len(booked) > 1:
+            raise ValueError('Slot of user %s on %s at %s is booked %s times'
+                             % (user_id, date, time, len(booked)))
+        kept = booked[0] if booked else appointments[0]
+        for appointment in appointments:
+            if appointment is not kept:
+                db.session.delete(appointment)
+                removed += 1
+    db.session.commit()
+    return removed
+
+def create_missing_indexes():
+    """ Creates the indexes declared in data_model.py
+    that do not exist in the database yet.
+    Returns the names of the created indexes.
+    """
+    engine = db.engine
+    created = []
+    for table in db.metadata.sorted_tables:
+        existing = _existing_indexes(engine, table.name)
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            if index.name not in existing:
+                index.create(bind=engine)
+                created.append(index.name)
+    return created
+
+###################### High level functions ###################################
+
+def upgrade():
+    """ Brings the database up to date with the data model, ie
+    creates the missing tables and columns,
+    removes the duplicated slots, marks the upcoming bookings,
+    gives the agents and managers their calendar feed token,
+    creates the missing indexes, rebuilds the availability summary.
+    Returns a dictionary describing what was done.
+    """
+    db.create_all()
+    added = add_missing_columns()
+    removed = remove_duplicate_slots()
+    filled = fill_active_phones()
+    tokens = fill_calendar_tokens()
+    db.session.commit()
+    created = create_missing_indexes()
+    summary_rows = rebuild_availability()
+    return {'columns_added': added,
+            'duplicate_slots_removed': removed,
+            'active_phones_filled': filled,
+            'calendar_tokens_filled': tokens,
+            'indexes_created': created,
+            'availability_rows': summary_rows}
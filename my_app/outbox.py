@@ -0,0 +1,288 @@
+""" Durable delivery of the text messages and email invites
+
+The booking code does not talk to Twilio or Mailgun: it writes the messages
+to the outbox table in the same transaction as the booking (enqueue), and
+asks for the outbox to be drained once committed (dispatch_outbox), with
+app.config['OUTBOX_DISPATCH'] being:
+- 'taskqueue': an App Engine push task calls /tasks/drain_outbox,
+- 'thread': a background thread of the current process drains it,
+- 'inline': the current request drains it right away,
+- 'none': only the /cron/drain_outbox cron drains it.
+The cron also retries the failed deliveries, with an exponential backoff.
+
+Every message has an idempotency key, so that it is written once, and is
+claimed by one worker at a time: a claim is a lease, a message whose worker
+died is claimed again once the lease expires.
+"""
+
+import json
+import logging
+import Queue
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import and_
+from my_app import app
+from data_model import db, OutboxMessage
+from communications import get_transport, send_events
+
+MAX_ATTEMPTS = 8
+BACKOFF_SECONDS = 30
+LEASE_SECONDS = 300
+BATCH_SIZE = 50
+MAX_BATCHES = 20
+
+############################# Writing #########################################
+
+def enqueue(kind, idempotency_key, payload, due=None):
+    """ Adds a message to the outbox in the current transaction,
+    to be sent once due (UTC), by default right away.
+    kind is 'sms' (payload: to, message),
+    'event' (payload: recepient and an invite event, see ics.py)
+    or 'invite' (payload: recepient, filename, ics_content, invite_method)
+    """
+    now = datetime.utcnow()
+    db.session.add(OutboxMessage(kind=kind,
+                                 idempotency_key=idempotency_key,
+                                 payload=json.dumps(payload),
+                                 status='pending',
+                                 attempts=0,
+                                 next_attempt_at=due or now,
+                                 created_at=now))
+
+def pending_due(idempotency_key):
+    """ Returns when a message not sent yet is due, None if there is none."""
+    return (db.session.query(OutboxMessage.next_attempt_at)
+            .filter(OutboxMessage.idempotency_key == idempotency_key)
+            .filter(OutboxMessage.status == 'pending')
+            .scalar())
+
+def enqueue_many(kind, messages):
+    """ Adds messages, a list of (idempotency_key, payload), to the outbox
+    in the current transaction with a single multi-row insert.
+    Messages already in the outbox are skipped, so that a job queueing
+    the same messages twice does not deliver them twice.
+    Returns the number of messages added.
+    """
+    if not messages:
+        return 0
+    now = datetime.utcnow()
+    insert = (OutboxMessage.__table__.insert()
+              .prefix_with('OR IGNORE', dialect='sqlite')
+              .prefix_with('IGNORE', dialect='mysql'))
+    result = db.session.execute(insert, [{'kind': kind,
+                                          'idempotency_key': key,
+                                          'payload': json.dumps(payload),
+                                          'status': 'pending',
+                                          'attempts': 0,
+                                          'next_attempt_at': now,
+                                          'created_at': now}
+                                         for key, payload in messages])
+    if db.engine.dialect.supports_sane_multi_rowcount:
+        return result.rowcount
+    return len(messages)
+
+def dispatch_outbox():
+    """ Asks for the outbox to be drained, see the module docstring.
+    To be called once the messages are committed.
+    """
+    mode = current_app.config.get('OUTBOX_DISPATCH', 'thread')
+    if mode == 'taskqueue':
+        from google.appengine.api import taskqueue
+        taskqueue.add(url='/tasks/drain_outbox')
+    elif mode == 'thread':
+        worker.wake()
+    elif mode == 'inline':
+        drain_outbox()
+
+############################# Delivery ########################################
+
+def _due():
+    now = datetime.utcnow()
+    return and_(OutboxMessage.status.in_(('pending', 'sending')),
+                OutboxMessage.next_attempt_at <= now)
+
+def claim_batch(batch_size=BATCH_SIZE):
+    """ Claims the next due messages for this worker and returns them."""
+    ids = [message_id for (message_id,) in
+           db.session.query(OutboxMessage.id)
+           .filter(_due())
+           .order_by(OutboxMessage.id.asc())
+           .limit(batch_size)]
+    if not ids:
+        return []
+    token = uuid.uuid4().hex
+    lease_end = datetime.utcnow() + timedelta(seconds=LEASE_SECONDS)
+    (OutboxMessage.query
+     .filter(OutboxMessage.id.in_(ids))
+     .filter(_due())
+     .update({OutboxMessage.status: 'sending',
+              OutboxMessage.claim_token: token,
+              OutboxMessage.attempts: OutboxMessage.attempts + 1,
+              OutboxMessage.next_attempt_at: lease_end},
+             synchronize_session=False))
+    db.session.commit()
+    return (OutboxMessage.query
+            .filter_by(claim_token=token)
+            .order_by(OutboxMessage.id.asc())
+            .all())
+
+def group_messages(messages):
+    """ Returns the messages to deliver together, as a list of
+    (kind, payloads, messages): the events of an agent claimed
+    together make one digest, the other messages go one by one.
+    """
+    groups = []
+    digests = {}
+    for message in messages:
+        payload = json.loads(message.payload)
+        if message.kind != 'event':
+            groups.append((message.kind, [payload], [message]))
+        elif payload['recepient'] in digests:
+            group = digests[payload['recepient']]
+            group[1].append(payload)
+            group[2].append(message)
+        else:
+            digests[payload['recepient']] = ('event', [payload], [message])
+            groups.append(digests[payload['recepient']])
+    return groups
+
+def deliver(transport, kind, payloads):
+    """ Sends messages of one kind through the transport."""
+    if kind == 'event':
+        send_events(transport, payloads[0]['recepient'], payloads)
+        return
+    for payload in payloads:
+        if kind == 'sms':
+            transport.send_sms(payload['to'], payload['message'])
+        elif kind == 'invite':
+            transport.send_invite(payload['recepient'], payload['filename'],
+                                  payload['ics_content'],
+                                  payload['invite_method'])
+        else:
+            raise ValueError('Unknown message kind %s' % kind)
+
+def attempt_delivery(transport, kind, payloads):
+    """ Sends messages and returns the error raised if any."""
+    try:
+        deliver(transport, kind, payloads)
+    except Exception as exception:
+        # provider errors are all retried: Twilio, Mailgun, network
+        logging.exception('Delivery of a %s message failed', kind)
+        return exception
+    return None
+
+def map_concurrently(function, items, concurrency):
+    """ Returns [function(item) for item in items],
+    running at most concurrency calls at the same time, in threads.
+    function must not raise.
+    """
+    if concurrency <= 1 or len(items) <= 1:
+        return [function(item) for item in items]
+    results = [None] * len(items)
+    indexes = Queue.Queue()
+    for index in range(len(items)):
+        indexes.put(index)
+    def work():
+        while True:
+            try:
+                index = indexes.get_nowait()
+            except Queue.Empty:
+                return
+            results[index] = function(items[index])
+    threads = [threading.Thread(target=work)
+               for _ in range(min(concurrency, len(items)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+def record_delivery(message, error=None):
+    """ Stores the outcome of a delivery, in the current transaction,
+    and returns the new status:
+    'sent', 'pending' (to be retried later) or 'failed' (given up).
+    """
+    now = datetime.utcnow()
+    message.claim_token = None
+    if error is None:
+        message.status = 'sent'
+        message.sent_at = now
+        message.last_error = None
+    else:
+        message.last_error = repr(error)[:255]
+        if message.attempts >= MAX_ATTEMPTS:
+            message.status = 'failed'
+        else:
+            message.status = 'pending'
+            message.next_attempt_at = now + timedelta(
+                seconds=BACKOFF_SECONDS * 2 ** (message.attempts - 1))
+    return message.status
+
+def drain_outbox(batch_size=BATCH_SIZE, max_batches=MAX_BATCHES,
+                 concurrency=1):
+    """ Delivers the due messages, batch after batch,
+    at most concurrency messages at the same time,
+    the outcomes of a batch being committed together: a worker dying
+    in the middle of a batch leaves its messages to be claimed again
+    once the lease expires.
+    Returns the number of messages sent, pending (to retry) and failed,
+    the time taken in seconds and the number of messages sent per second.
+    """
+    transport = get_transport(current_app.config['NOTIFICATION_TRANSPORT'])
+    stats = {'sent': 0, 'pending': 0, 'failed': 0}
+    start = time.time()
+    for _ in range(max_batches):
+        messages = claim_batch(batch_size)
+        if not messages:
+            break
+        groups = group_messages(messages)
+        errors = map_concurrently(
+            lambda group: attempt_delivery(transport, group[0], group[1]),
+            groups, concurrency)
+        for (kind, payloads, delivered), error in zip(groups, errors):
+            for message in delivered:
+                stats[record_delivery(message, error)] += 1
+        db.session.commit()
+    stats['seconds'] = time.time() - start
+    stats['per_second'] = stats['sent'] / max(stats['seconds'], 0.001)
+    return stats
+
+############################# Local worker ####################################
+
+class OutboxWorker(object):
+    """ Background thread draining the outbox, or running another drain
+    function, when woken up and every poll_seconds in case a wake up
+    was missed.
+    """
+    def __init__(self, drain=drain_outbox, name='outbox-worker',
+                 poll_seconds=60):
+        self.drain = drain
+        self.name = name
+        self.poll_seconds = poll_seconds
+        self._wake_up = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def wake(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run,
+                                                name=self.name)
+                self._thread.daemon = True
+                self._thread.start()
+        self._wake_up.set()
+
+    def _run(self):
+        while True:
+            self._wake_up.wait(self.poll_seconds)
+            self._wake_up.clear()
+            try:
+                with app.app_context():
+                    self.drain()
+            except Exception:
+                logging.exception('%s failed', self.name)
+
+worker = OutboxWorker()
@@ -0,0 +1,87 @@
+""" Reminders sent to the customers the day before their appointment
+
+The /cron/send_reminders cron runs every hour and reminds the customers
+of the branches whose local time is within REMINDER_WINDOW, whatever
+the time zone of the branch.
+"""
+
+import logging
+from datetime import datetime, timedelta
+import pytz
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import contains_eager
+from data_model import db, Branch, User, Appointment
+from communications import sms_message
+from outbox import enqueue_many, drain_outbox
+
+# number of text messages sent at the same time
+REMINDER_CONCURRENCY = 10
+
+# local hours (from, to) during which the customers are reminded
+# of their appointment of the next day
+REMINDER_WINDOW = (10, 20)
+
+def reminder_key(appointment):
+    """ Returns the idempotency key of the reminder of an appointment."""
+    booked_at = appointment.booked_at.isoformat() if appointment.booked_at else ''
+    return 'sms:CONFIRM:%s:%s' % (appointment.id, booked_at)
+
+def due_time_zones(now=None):
+    """ Returns a dictionary time_zone: local tomorrow
+    for the time zones of the branches where the local time
+    is within REMINDER_WINDOW.
+    """
+    now = now or datetime.now(pytz.utc)
+    due = {}
+    for (time_zone,) in db.session.query(Branch.time_zone).distinct():
+        local_now = now.astimezone(pytz.timezone(time_zone))
+        if REMINDER_WINDOW[0] <= local_now.hour < REMINDER_WINDOW[1]:
+            due[time_zone] = local_now.date() + timedelta(days=1)
+    return due
+
+def send_reminders(days):
+    """ Reminds the customers of the appointments of several time zones, ie
+    days is a dictionary time_zone: day of the appointments to remind,
+    loads the appointments with their agent and branch in one query,
+    queues one text message per appointment in the outbox,
+    delivers them, REMINDER_CONCURRENCY at a time.
+    Running it twice does not remind a customer twice.
+    Returns the delivery statistics (see outbox.drain_outbox).
+    """
+    appointments = []
+    if days:
+        appointments = (Appointment.query
+                        .filter(Appointment.bookable_booked=="booked")
+                        .filter(Appointment.date.in_(set(days.values())))
+                        .join(Appointment.user).join(User.branch)
+                        .filter(or_(*[and_(Branch.time_zone == time_zone,
+                                           Appointment.date == day)
+                                      for time_zone, day in days.items()]))
+                        .options(contains_eager(Appointment.user)
+                                 .contains_eager(User.branch))
+                        .all())
+    queued = enqueue_many('sms', [
+        (reminder_key(appointment),
+         {'to': appointment.booked_by_phone,
+          'message': sms_message(appointment, sms_method='CONFIRM')})
+        for appointment in appointments])
+    db.session.commit()
+    stats = drain_outbox(concurrency=REMINDER_CONCURRENCY)
+    stats['queued'] = queued
+    stats['time_zones'] = sorted(days)
+    logging.info('Reminders for %s: %s queued, %s sent in %.1fs (%.1f/s)',
+                 ', '.join(sorted(days)) or 'no time zone', queued,
+                 stats['sent'], stats['seconds'], stats['per_second'])
+    return stats
+
+def send_reminder(timezone):
+    """ Reminds the customers of tomorrow's appointments in one time zone."""
+    tomorrow = datetime.now(pytz.timezone(timezone)).date()+timedelta(days=1)
+    return send_reminders({timezone: tomorrow})
+
+def schedule_reminders(now=None):
+    """ Hourly entry point: reminds the customers of every time zone
+    where it is time to do so, see due_time_zones.
+    A branch in a new time zone needs no new cron.
+    """
+    return send_reminders(due_time_zones(now))
@@ -0,0 +1,140 @@
+""" Working hours of the agents, compiled into slot schedules
+
+A SlotTemplate describes the working hours of a branch, or of one agent
+when the agent's hours differ from the branch's. Templates are compiled
+once into a SlotSchedule (the start times of the slots, the closed days)
+that generate_appointments() expands for every agent.
+Agents without any template keep the historical 8:00-16:00 hourly grid.
+"""
+
+from datetime import datetime, time, timedelta
+from sqlalchemy import or_, func
+from data_model import db, User, SlotTemplate, Holiday
+
+DEFAULT_SLOT_MINUTES = 60
+DEFAULT_OPENING_TIME = time(8, 00)
+DEFAULT_CLOSING_TIME = time(16, 00)
+DEFAULT_HORIZON_DAYS = 15
+
+############################# Schedules #######################################
+
+class SlotSchedule(object):
+    """ The slots an agent can be booked for, ie
+    the start times of the slots of an opened day,
+    the week days and the holidays when the agent does not work,
+    the number of days, starting today, for which slots are created.
+    """
+    def __init__(self, slot_times, slot_minutes, closed_weekdays=(),
+                 holidays=(), horizon_days=DEFAULT_HORIZON_DAYS):
+        self.slot_times = tuple(slot_times)
+        self.slot_minutes = slot_minutes
+        self.closed_weekdays = frozenset(closed_weekdays)
+        self.holidays = frozenset(holidays)
+        self.horizon_days = horizon_days
+
+    def is_open(self, day):
+        return (day.weekday() not in self.closed_weekdays
+                and day not in self.holidays)
+
+    def days(self, first_day):
+        """ Returns the opened days of the horizon starting on first_day."""
+        all_days = (first_day + timedelta(days=i)
+                    for i in range(0, self.horizon_days))
+        return [day for day in all_days if self.is_open(day)]
+
+    def slots(self, first_day):
+        """ Returns the (date, time) of every slot of the horizon."""
+        return [(day, slot_time) for day in self.days(first_day)
+                for slot_time in self.slot_times]
+
+def slot_times(opening_time, closing_time, slot_minutes):
+    """ Returns the start times of the slots fitting in the opening hours,
+    none for a slot length that is not positive.
+    """
+    if not slot_minutes or slot_minutes <= 0:
+        return []
+    start = datetime.combine(datetime.today(), opening_time)
+    end = datetime.combine(datetime.today(), closing_time)
+    length = timedelta(minutes=slot_minutes)
+    times = []
+    while start + length <= end:
+        times.append(start.time())
+        start += length
+    return times
+
+def parse_weekdays(closed_weekdays):
+    """ Returns the week days of a comma separated string like '5,6'."""
+    return [int(day) for day in (closed_weekdays or '').split(',')
+            if day.strip()]
+
+def compile_template(template, holidays=()):
+    """ Returns the SlotSchedule of a template, or the default one."""
+    if template is None:
+        return SlotSchedule(
+            slot_times(DEFAULT_OPENING_TIME, DEFAULT_CLOSING_TIME,
+                       DEFAULT_SLOT_MINUTES),
+            DEFAULT_SLOT_MINUTES,
+            holidays=holidays)
+    return SlotSchedule(
+        slot_times(template.opening_time, template.closing_time,
+                   template.slot_minutes),
+        template.slot_minutes,
+        closed_weekdays=parse_weekdays(template.closed_weekdays),
+        holidays=holidays,
+        horizon_days=template.horizon_days)
+
+############################# Queries #########################################
+
+def compile_schedules(user_ids):
+    """ Returns a dictionary user_id: SlotSchedule for several agents, ie
+    the agent's template if any, else the branch's template, else the default,
+    minus the holidays of the agent's branch and of every branch.
+    Uses three queries whatever the number of agents, and compiles
+    each (template, branch) combination once.
+    """
+    user_ids = list(user_ids)
+    if not user_ids:
+        return {}
+    branches = dict(db.session.query(User.id, User.branch_id)
+                    .filter(User.id.in_(user_ids))
+                    .all())
+    branch_ids = set(branch_id for branch_id in branches.values()
+                     if branch_id is not None)
+    template_filter = SlotTemplate.user_id.in_(user_ids)
+    if branch_ids:
+        template_filter = or_(template_filter,
+                              SlotTemplate.branch_id.in_(branch_ids))
+    user_templates, branch_templates = {}, {}
+    for template in SlotTemplate.query.filter(template_filter).all():
+        if template.user_id is not None:
+            user_templates[template.user_id] = template
+        elif template.branch_id is not None:
+            branch_templates[template.branch_id] = template
+    today = datetime.today().date()
+    holiday_filter = Holiday.branch_id.is_(None)
+    if branch_ids:
+        holiday_filter = or_(holiday_filter, Holiday.branch_id.in_(branch_ids))
+    holidays = {}
+    for branch_id, date in (db.session.query(Holiday.branch_id, Holiday.date)
+                            .filter(holiday_filter)
+                            .filter(Holiday.date >= today)
+                            .all()):
+        holidays.setdefault(branch_id, set()).add(date)
+    compiled = {}
+    schedules = {}
+    for user_id in user_ids:
+        branch_id = branches.get(user_id)
+        template = (user_templates.get(user_id)
+                    or branch_templates.get(branch_id))
+        key = (template.id if template else None, branch_id)
+        if key not in compiled:
+            closed_days = holidays.get(None, set()) | holidays.get(branch_id,
+                                                                   set())
+            compiled[key] = compile_template(template, closed_days)
+        schedules[user_id] = compiled[key]
+    return schedules
+
+def max_horizon_days():
+    """ Returns the longest horizon of all the templates."""
+    horizon = db.session.query(func.max(SlotTemplate.horizon_days)).scalar()
+    return max(horizon or 0, DEFAULT_HORIZON_DAYS)
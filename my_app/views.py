@@ -2,6 +2,8 @@
 
 from my_app import app
 from flask import render_template, request, redirect, url_for
+from flask import _request_ctx_stack
+import threading
 from flask_login import LoginManager, logout_user, current_user
 import json
 from datetime import datetime
@@ -10,70 +12,90 @@ from wtforms import IntegerField, StringField, SelectField
 from flask_wtf.recaptcha import RecaptchaField
 from wtforms.validators import DataRequired
 import pytz
-from data_model import db, Role, User, Services
+from data_model import db, Role, User
+from config import pool_stats
 from flask_security import login_required
-from communications import send_reminder
+from reminders import schedule_reminders
 from crud import query_available_services, query_available_markets
 from crud import query_user_appointment, query_available_days
+from crud import query_branch_calendar, query_service_names
 from crud import cancel_appointments, query_market_appointments
 from crud import toggle_appointments
 from crud import book_appointment
-from crud import add_tbd_appointments
+from crud import generate_appointments, backfill_slots
+from archive import archive_appointments
+from outbox import drain_outbox
+from inbound import valid_signature, record_inbound, dispatch_inbound
+from inbound import process_inbound
+from calendar_feed import calendar_url
 from flask_security import utils
 
 ########################## customer-facing interface ##########################
 
+# The forms are defined once: their choices are set per request,
+# from the cached option lists of crud.py.
+
+class WhatForm(Form):
+    wtf_what = SelectField('Product', choices=[])
+
+class WhereForm(Form):
+    wtf_where = SelectField('Location', choices=[])
+
+class WhenForm(Form):
+    wtf_when = SelectField('Date', choices=[])
+
+class BookForm(Form):
+    wtf_name = StringField('Your name',
+                validators=[DataRequired()])
+    wtf_phone = StringField('Your phone number',
+                validators=[DataRequired()])
+    wtf_topic = SelectField('No need - autofill', choices=[])
+    wtf_user_id = IntegerField('banker_id')
+    wtf_date = DateField('Date', format="%Y-%m-%d")
+    wtf_time = DateTimeField('time', format="%Y-%m-%d-%H:%M:%S")
+    recaptcha = RecaptchaField()
+
+def choices(values):
+    """ Returns the choices of a SelectField whose labels are the values."""
+    return [(value, value) for value in values]
+
 @app.route('/',methods = ['GET','POST'])
 def search_what():
     """ 1st customer-facing page - to choose the desired service."""
-    
-    class WhoWhereForm(Form):
-        available_services = query_available_services(days_available = 10)
-        wtf_what = SelectField('Product',
-            choices = [(service,service) for service in available_services])
     if request.method == 'POST':
-        form = WhoWhereForm(request.form)
+        form = WhatForm(request.form)
         what =  form.wtf_what.data
         return redirect(url_for('search_where', what = what))
     if request.method == 'GET':
-        form = WhoWhereForm()
+        form = WhatForm()
+        form.wtf_what.choices = choices(
+            query_available_services(days_available = 10))
         return render_template('search.html', form = form)
 
 @app.route('/where/<what>', methods = ['GET','POST'])
 def search_where(what):
     """ 2nd customer-facing page - to choose the desired market."""
-    
-    class WhoWhereForm(Form):
-        today = datetime.now(pytz.timezone('Pacific/Honolulu')).date()
-        available_locations = query_available_markets(days_available=10,
-                                                    what=what)
-        wtf_where = SelectField('Location',
-            choices = [(branch,branch) for branch in available_locations])
     if request.method == 'POST':
-        form = WhoWhereForm(request.form)
-        what = what
+        form = WhereForm(request.form)
         where = form.wtf_where.data
         return redirect(url_for('search_when', what=what, where=where))
     if request.method == 'GET':
-        form = WhoWhereForm()
+        form = WhereForm()
+        form.wtf_where.choices = choices(
+            query_available_markets(days_available=10, what=what))
         return render_template('search.html', form=form, what=what)
 
 @app.route('/when/<what>/<where>', methods=['GET','POST'])
 def search_when(what, where):
     """ 3d customer-facing page - to choose the desired date."""
-    
-    class WhoWhereForm(Form):
-        available_days = query_available_days(what, where, days_available=10)
-        wtf_when = SelectField('Date',
-            choices=[(day,day) for day in available_days])
     if request.method == 'POST':
-        form = WhoWhereForm(request.form)
-        what = what
-        where = where
+        form = WhenForm(request.form)
         when = form.wtf_when.data
         return redirect(url_for('book', what=what, where=where, when=when))
     if request.method == 'GET':
-        form = WhoWhereForm()
+        form = WhenForm()
+        form.wtf_when.choices = choices(
+            query_available_days(what, where, days_available=10))
         return render_template(
             'search.html', form=form, what=what, where=where)
 
@@ -89,25 +111,14 @@ def book(what, where, when):
                     stores the appointment details in the database
         
     """
-    
-    class BookForm(Form):
-        wtf_name = StringField('Your name',
-                    validators=[DataRequired()])
-        wtf_phone = StringField('Your phone number',
-                    validators=[DataRequired()])
-        wtf_topic = SelectField('No need - autofill',
-                    choices=[(x.name,x.name) for x in Services.query.all()])
-        wtf_user_id = IntegerField('banker_id')
-        wtf_date = DateField('Date', format="%Y-%m-%d")
-        wtf_time = DateTimeField('time', format="%Y-%m-%d-%H:%M:%S")
-        recaptcha = RecaptchaField()
-
     if request.method == 'GET':
         form = BookForm()
+        form.wtf_topic.choices = choices(query_service_names())
         data = query_market_appointments(what, where, when)
         return render_template('book.html', data=data, form=form, what=what)
     if request.method == 'POST':
         form = BookForm(request.form)
+        form.wtf_topic.choices = choices(query_service_names())
         if form.validate():
             phone_number = form.wtf_phone.data
             user_id = form.wtf_user_id.data
@@ -132,12 +143,20 @@ def cancel():
     
     This url needs to be linked to the Twilio account
     So that incoming text messages result in post request to this URL
+
+    The message is recorded, once per MessageSid, and processed
+    after the answer, see inbound.py
     
     """
-    phone_number = request.form['From']
-    message_body = request.form['Body']
-    if 'no appointment' in message_body.lower():
-        cancel_appointments(phone_number)
+    if not valid_signature(request.url, list(request.form.lists()),
+                           request.headers.get('X-Twilio-Signature')):
+        return 'invalid signature', 403
+    message_sid = request.form.get('MessageSid')
+    if not message_sid:
+        return 'MessageSid is required', 400
+    if record_inbound(message_sid, request.form['From'],
+                      request.form.get('Body')):
+        dispatch_inbound()
     return 'cancelled', 200
 
 @app.route('/thanks', methods = ['GET'])
@@ -184,7 +203,9 @@ def profile():
     """
     if request.method == 'POST':
         data_list = json.loads(request.form['submit_check_val'])
-        toggle_appointments(data_list)
+        result = toggle_appointments(data_list)
+        if request.accept_mimetypes.best == 'application/json':
+            return json.dumps(result)
         return redirect(url_for('profile'))
 
     if request.method == 'GET':
@@ -193,15 +214,12 @@ def profile():
             return redirect('/admin')
         if current_user.has_role('end-user'):
             data = query_user_appointment(current_user.id)
-            return render_template('profile.html', user_record=data, form=form)
+            return render_template('profile.html', user_record=data, form=form,
+                                   calendar_url=calendar_url(current_user))
         if current_user.has_role('manager'):
-            users = (User.query
-                .filter_by(branch_id=current_user.branch_id)
-                .join(User.roles)
-                .filter(Role.id == 2)
-                .all())
-            data=[query_user_appointment(user.id) for user in users]
-            return render_template("manager_profile.html", data=data, form=form)
+            data = query_branch_calendar(current_user.branch_id)
+            return render_template("manager_profile.html", data=data, form=form,
+                                   calendar_url=calendar_url(current_user))
 
 @app.route("/logout", methods=['GET', 'POST'])
 @login_required
@@ -227,24 +245,93 @@ def change_password():
             return "Sorry, is your old password correct?"
     return "Sorry, is there something wring in your information?"
 
+#################### Admin pages loaded on first use ##########################
+
+_admin_lock = threading.Lock()
+_admin_loaded = []
+
+def load_admin():
+    """ Imports admin.py, which adds the admin pages to the application."""
+    with _admin_lock:
+        if not _admin_loaded:
+            from my_app import admin
+            _admin_loaded.append(admin)
+
+@app.before_request
+def load_admin_on_first_use():
+    """ Loads the admin pages when app.config['LAZY_ADMIN'] is set
+    and the first /admin request comes in, which is then routed again.
+    """
+    if (app.config['LAZY_ADMIN'] and not _admin_loaded
+            and request.path.startswith('/admin')):
+        load_admin()
+        request.routing_exception = None
+        _request_ctx_stack.top.match_request()
+
+#################### Monitoring ##############################################
+
+@app.route('/internal/pool_stats')
+def pool_stats_view():
+    """ state of the database connection pool of this instance """
+    return json.dumps(pool_stats(db.engine)), 200
+
 #################### CRON jobs (recurring operations) #########################
 
 @app.route('/cron/add_appointments', methods = ['GET', 'POST'])
 def add_appointments():
     """ daily, adds 1 day's worth of appointments to the database """
-    users = User.query.join(User.roles).filter(Role.id == 2).all()
-    for user in users:
-        add_tbd_appointments(user.id)
-    return "aloha", 201
-
-@app.route('/cron/send_reminders_hi', methods = ['GET','POST'])
-def send_reminders_hi():
-    """ daily, sends reminders to the HI customers """
-    send_reminder(timezone = 'Pacific/Honolulu')
-    return "aloha", 201
-
-@app.route('/cron/send_reminders_wp', methods = ['GET','POST'])
-def send_reminders_wp():
-    """ daily, sends reminders to the West Pacific customers """
-    send_reminder(timezone = 'Pacific/Guam')
-    return "aloha", 201
+    users = db.session.query(User.id).join(User.roles).filter(Role.id == 2)
+    created = generate_appointments([user.id for user in users])
+    return "%s appointments added" % created, 201
+
+@app.route('/cron/backfill_slots', methods = ['GET', 'POST'])
+def backfill_slots_cron():
+    """ every 15 minutes, creates the appointments of the agents
+    who have none, eg whose provisioning failed
+    """
+    created = backfill_slots()
+    return "%s appointments added" % created, 201
+
+@app.route('/cron/archive_appointments', methods = ['GET', 'POST'])
+def archive_appointments_cron():
+    """ nightly, moves the past bookings to the archive and deletes
+    the past slots, see archive.py
+    """
+    stats = archive_appointments()
+    return json.dumps(stats), 200
+
+@app.route('/cron/drain_outbox', methods = ['GET', 'POST'])
+def drain_outbox_cron():
+    """ every minute, delivers the messages that are due, eg retries """
+    stats = drain_outbox()
+    return json.dumps(stats), 200
+
+@app.route('/tasks/drain_outbox', methods = ['POST'])
+def drain_outbox_task():
+    """ delivers the messages just queued, see outbox.dispatch_outbox """
+    stats = drain_outbox()
+    return json.dumps(stats), 200
+
+@app.route('/cron/process_inbound', methods = ['GET', 'POST'])
+def process_inbound_cron():
+    """ every minute, processes the text messages received and
+    not processed yet, eg whose processing failed
+    """
+    stats = process_inbound()
+    return json.dumps(stats), 200
+
+@app.route('/tasks/process_inbound', methods = ['POST'])
+def process_inbound_task():
+    """ processes the text messages just received,
+    see inbound.dispatch_inbound
+    """
+    stats = process_inbound()
+    return json.dumps(stats), 200
+
+@app.route('/cron/send_reminders', methods = ['GET','POST'])
+def send_reminders():
+    """ hourly, sends reminders to the customers of every time zone
+    where it is time to do so
+    """
+    stats = schedule_reminders()
+    return json.dumps(stats), 201
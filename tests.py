@@ -1,6 +1,42 @@
+import os
+import subprocess
+import sys
 import unittest
+from multiprocessing.pool import ThreadPool
 from my_app import app
+from my_app.crud import claim_appointment, toggle_appointments
+from my_app.crud import query_branch_calendar, query_user_appointment
+from my_app.crud import create_appointment, cancel_appointments
+from my_app.crud import query_available_services, query_market_appointments
+from my_app.crud import funnel_cache, generate_appointments, resync_slots
+from my_app.availability import check_availability, rebuild_availability
+from my_app.availability import availability_version, record_changes
+from my_app.bitmap import convert_slots
+from my_app.data_model import db, Appointment, OutboxMessage, User, Branch
+from my_app.data_model import Services
+from my_app.data_model import AgentDay, AppointmentArchive, InboundMessage
+from my_app.archive import archive_appointments
+from my_app.reminders import send_reminder, due_time_zones
+from my_app.outbox import enqueue, drain_outbox
+from my_app.communications import get_transport
+from my_app import communications
+from my_app import admin
+from my_app.ics import calendar
+from my_app.calendar_feed import calendar_url
+from my_app.inbound import process_inbound, twilio_signature
+from my_app.migrations import upgrade
+from my_app.data_model import SlotTemplate, Holiday
+from my_app.schedule import compile_template
+from my_app.cache import Cache, MemoryBackend
+from my_app.initial_data import user_datastore, seed
+from my_app.config import current_environment, database_config
+from my_app.config import TimedQueuePool, pool_stats
+from my_app.instrumentation import query_budget
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import TimeoutError
 import datetime
+import json
+import pytz
 
 what = 'Other' # a product in the initial data commit
 where = 'Guam' # a market
@@ -10,6 +46,13 @@ test_phone_number = '12345678' # your phone number
 
 class BasicTests(unittest.TestCase):
 
+    @classmethod
+    def setUpClass(cls):
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///test.db'
+        with app.app_context():
+            upgrade()
+            seed()
+
     def test_main_pages(self):
         """ Testing of the customer facing pages. """
         self.app=app.test_client()
@@ -93,6 +136,77 @@ class BasicTests(unittest.TestCase):
                      'new_pwd_2':'pwd'},
                follow_redirects=True)
 
+    def test_bitmap_engine(self):
+        """ Testing the bitmap engine on a database of its own: only the
+        booked slots are appointments, the summary stays in line
+        with the agent-days, the slots can be converted back to rows.
+
+        """
+        app.config['TESTING'] = True
+        app.config['OUTBOX_DISPATCH'] = 'none'
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///bitmap_test.db'
+        app.config['AVAILABILITY_ENGINE'] = 'bitmap'
+        phone_number = '+15550007777'
+        try:
+            with app.app_context():
+                upgrade()
+                seed()
+                self.assertEqual(Appointment.query.count(), 0)
+                agent_days = AgentDay.query.count()
+                self.assertTrue(agent_days)
+                self.assertEqual(check_availability(), [])
+                self.assertIn(what, query_available_services(10))
+                day = AgentDay.query.filter_by(user_id=3).order_by(
+                    AgentDay.date.desc()).first().date
+                grid = query_market_appointments(what, where,
+                                                 day.strftime('%Y-%m-%d'))
+                slot = [apt for row in grid[0]['branch_apt']
+                        for apt in row if apt is not None][0]
+                self.assertEqual(slot.bookable_booked, 'bookable')
+                self.assertEqual(create_appointment(
+                    slot.user_id, slot.date, slot.time, phone_number,
+                    what, 'test user'), 'all_good')
+                self.assertEqual(create_appointment(
+                    slot.user_id, slot.date, slot.time, '+15550007778',
+                    what, 'test user'), 'appointment_just_booked')
+                self.assertEqual(Appointment.query.count(), 1)
+                self.assertEqual(check_availability(), [])
+                calendar = query_user_appointment(slot.user_id)
+                statuses = [apt.bookable_booked
+                            for row in calendar['user_apt'] for apt in row]
+                self.assertEqual(statuses.count('booked'), 1)
+                item = {'user_id': slot.user_id,
+                        'date': slot.date.strftime('%Y-%m-%d'),
+                        'time': '08:00:00', 'status': 'bookable'}
+                if slot.time.hour == 8:
+                    item['time'] = '09:00:00'
+                result = toggle_appointments([item])
+                self.assertEqual(result['changed'], 1)
+                result = toggle_appointments([item])
+                self.assertEqual(result['skipped'], [item])
+                self.assertEqual(check_availability(), [])
+                cancel_appointments(phone_number)
+                self.assertEqual(Appointment.query.count(), 0)
+                self.assertEqual(check_availability(), [])
+                report = convert_slots('rows')
+                self.assertEqual(report['agent_days'], agent_days)
+                app.config['AVAILABILITY_ENGINE'] = 'rows'
+                rebuild_availability()
+                self.assertEqual(check_availability(), [])
+                self.assertEqual(Appointment.query.filter_by(
+                    bookable_booked='tbd').count(), 1)
+                report = convert_slots('bitmap')
+                self.assertEqual(report['agent_days'], agent_days)
+                self.assertEqual(Appointment.query.count(), 0)
+                db.session.remove()
+        finally:
+            app.config['AVAILABILITY_ENGINE'] = 'rows'
+            app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///test.db'
+            funnel_cache.invalidate()
+            path = os.path.join(app.root_path, 'bitmap_test.db')
+            if os.path.exists(path):
+                os.remove(path)
+
     def test_booking(self):
         """ Testing that:
         - the customers can book an appointment
@@ -104,6 +218,7 @@ class BasicTests(unittest.TestCase):
         app.config['WTF_CSRF_ENABLED'] = False
         app.config['DEBUG'] = True
         app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///test.db'
+        app.config['OUTBOX_DISPATCH'] = 'inline'
         # # trying book an appointment
         response=self.app.post(
             '/book/' + test_url,
@@ -130,7 +245,8 @@ class BasicTests(unittest.TestCase):
         response=self.app.post(
             '/cancel',
             data={
-            'From': '+18083864147',
+            'MessageSid': 'SM-test-booking',
+            'From': '+1' + test_phone_number,
             'Body': 'no appointment'
             },
              follow_redirects=True)
@@ -140,6 +256,872 @@ class BasicTests(unittest.TestCase):
         self.assertEqual(response.status_code,200)
         self.assertNotIn('booked_by_name="test user"',response.data)
 
+    def test_inbound_messages(self):
+        """ Testing that the Twilio webhook checks the signature,
+        records a message once however many times Twilio posts it,
+        and that the cancellation happens afterwards.
+
+        """
+        self.app=app.test_client()
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///test.db'
+        app.config['OUTBOX_DISPATCH'] = 'none'
+        phone_number = '+15550006666'
+        data = {'MessageSid': 'SM-test-inbound', 'From': phone_number,
+                'Body': 'No appointment please'}
+        with app.app_context():
+            appointment = (Appointment.query
+                           .filter(Appointment.bookable_booked == 'bookable')
+                           .filter(Appointment.date > datetime.date.today())
+                           .filter_by(user_id=4).first())
+            self.assertEqual(create_appointment(
+                appointment.user_id, appointment.date, appointment.time,
+                phone_number, what, 'Texting Customer'), 'all_good')
+            appointment_id = appointment.id
+        app.config['TWILIO_VALIDATE_SIGNATURE'] = True
+        app.config['TWILIO_AUTH_TOKEN'] = 'test-token'
+        try:
+            response = self.app.post('/cancel', data=data,
+                headers={'X-Twilio-Signature': 'forged'})
+            self.assertEqual(response.status_code, 403)
+            signature = twilio_signature(
+                'http://localhost/cancel',
+                [(name, [value]) for name, value in data.items()],
+                'test-token')
+            for _ in range(2):
+                response = self.app.post('/cancel', data=data,
+                    headers={'X-Twilio-Signature': signature})
+                self.assertEqual(response.status_code, 200)
+        finally:
+            app.config['TWILIO_VALIDATE_SIGNATURE'] = False
+        with app.app_context():
+            self.assertEqual(InboundMessage.query.filter_by(
+                message_sid='SM-test-inbound').count(), 1)
+            # answered, not processed yet
+            self.assertEqual(Appointment.query.get(appointment_id)
+                             .bookable_booked, 'booked')
+            stats = process_inbound()
+            self.assertEqual(stats['cancellations'], 1)
+            self.assertEqual(Appointment.query.get(appointment_id)
+                             .bookable_booked, 'bookable')
+            self.assertEqual(process_inbound()['processed'], 0)
+            self.assertEqual(check_availability(), [])
+        response = self.app.post('/cancel', data=data)
+        self.assertEqual(response.status_code, 200)
+        with app.app_context():
+            self.assertEqual(process_inbound()['processed'], 0)
+
+    def test_concurrent_booking(self):
+        """ Testing that:
+        - concurrent customers cannot book the same slot twice
+        - a customer cannot hold two upcoming bookings
+
+        """
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///test.db'
+        app.test_client().get('/thanks')
+        tomorrow = datetime.date.today() + datetime.timedelta(days=1)
+        with app.app_context():
+            slots = [(apt.user_id, apt.date, apt.time) for apt in
+                     Appointment.query
+                     .filter(Appointment.bookable_booked == 'bookable')
+                     .filter(Appointment.date > tomorrow)
+                     .limit(2)]
+        def claim(phone_number, slot):
+            with app.app_context():
+                status = claim_appointment(slot[0], slot[1], slot[2],
+                                           phone_number, what, 'test user')
+                db.session.commit()
+                return status
+        pool = ThreadPool(8)
+        statuses = pool.map(
+            lambda i: claim('+1555000%04d' % i, slots[0]), range(16))
+        pool.close()
+        self.assertEqual(statuses.count('all_good'), 1)
+        self.assertEqual(statuses.count('appointment_just_booked'), 15)
+        phone_number = '+1555000%04d' % statuses.index('all_good')
+        self.assertEqual(claim(phone_number, slots[1]),
+                         'customer_has_appointment')
+        with app.app_context():
+            for appointment in Appointment.query.filter_by(
+                    booked_by_phone=phone_number):
+                appointment.bookable_booked = 'bookable'
+                appointment.booked_by_name = None
+                appointment.booked_by_phone = None
+                appointment.active_phone = None
+                appointment.booked_at = None
+            db.session.commit()
+            rebuild_availability()
+
+    def test_manager_profile(self):
+        """ Testing that the managers see the calendar of their agents,
+        the same as the agents see it.
+
+        """
+        self.app=app.test_client()
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///test.db'
+        response = self.app.post(
+                '/login',
+                data={'email':'waikiki@example.com','password':'pwd'},
+                follow_redirects=True)
+        response = self.app.get('/profile', follow_redirects=True)
+        self.assertEqual(response.status_code,200)
+        self.assertIn('John waikiki',response.data)
+        self.app.post('/logout', follow_redirects=True)
+        with app.app_context():
+            calendar = query_branch_calendar(4)
+            self.assertEqual([record['user_id'] for record in calendar], [7])
+            self.assertEqual(calendar[0]['user_apt'],
+                             query_user_appointment(7)['user_apt'])
+
+    def test_outbox(self):
+        """ Testing that a queued message is delivered once. """
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///test.db'
+        app.config['NOTIFICATION_TRANSPORT'] = 'stub'
+        transport = get_transport('stub')
+        key = 'test:%s' % datetime.datetime.now().isoformat()
+        with app.app_context():
+            enqueue('sms', key, {'to': '+15550000000', 'message': 'hello'})
+            db.session.commit()
+            drain_outbox()
+            drain_outbox()
+            message = OutboxMessage.query.filter_by(idempotency_key=key).one()
+            self.assertEqual(message.status, 'sent')
+            self.assertEqual(message.attempts, 1)
+        self.assertEqual(transport.sent.count(
+            ('sms', '+15550000000', 'hello')), 1)
+        # a Mailgun error is raised, for the outbox to retry the delivery
+        import requests
+        class FailingSession(object):
+            calls = []
+            def post(self, *args, **kwargs):
+                self.calls.append(kwargs)
+                response = requests.models.Response()
+                response.status_code = 503
+                return response
+        communications._clients['http'] = FailingSession()
+        try:
+            with self.assertRaises(requests.HTTPError):
+                communications.send_digest_invite(
+                    'agent@example.com', [('bookings.ics', 'BEGIN:VCALENDAR')])
+        finally:
+            del communications._clients['http']
+        self.assertEqual(FailingSession.calls[0]['timeout'],
+                         communications.HTTP_TIMEOUT)
+
+    def test_digest_invites(self):
+        """ Testing that in digest mode the invites of an agent are sent
+        together once the window is over, a booking cancelled meanwhile
+        being left out, and that the ICS lines are folded.
+
+        """
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///test.db'
+        app.config['NOTIFICATION_TRANSPORT'] = 'stub'
+        app.config['OUTBOX_DISPATCH'] = 'none'
+        app.config['INVITE_MODE'] = 'digest'
+        transport = get_transport('stub')
+        later = datetime.date.today() + datetime.timedelta(days=3)
+        try:
+            with app.app_context():
+                drain_outbox()
+                first, second = (Appointment.query
+                                 .filter(Appointment.bookable_booked
+                                         == 'bookable')
+                                 .filter(Appointment.date >= later)
+                                 .filter_by(user_id=6)
+                                 .limit(2).all())
+                for appointment, phone_number in ((first, '+15550005551'),
+                                                  (second, '+15550005552')):
+                    self.assertEqual(create_appointment(
+                        appointment.user_id, appointment.date,
+                        appointment.time, phone_number, what, 'test user'),
+                        'all_good')
+                cancel_appointments('+15550005551')
+                self.assertEqual(drain_outbox()['sent'], 3)
+                events = (OutboxMessage.query
+                          .filter_by(kind='event', status='pending').all())
+                self.assertEqual(len(events), 3)
+                for message in events:
+                    message.next_attempt_at = datetime.datetime.utcnow()
+                db.session.commit()
+                self.assertEqual(drain_outbox()['sent'], 3)
+                digest = [sent for sent in transport.sent
+                          if sent[0] == 'digest'][-1]
+                self.assertEqual(digest[1], 'john.kaneohe@example.com')
+                self.assertEqual([name for name, content in digest[2]],
+                                 ['bookings.ics'])
+                content = digest[2][0][1]
+                self.assertEqual(content.count('BEGIN:VEVENT'), 1)
+                self.assertIn('UID:booking-%s-' % second.id, content)
+                self.assertIn('SEQUENCE:0', content)
+                cancel_appointments('+15550005552')
+                db.session.commit()
+        finally:
+            app.config['INVITE_MODE'] = 'immediate'
+        event = {'uid': 'test', 'sequence': 1, 'method': 'CANCEL',
+                 'start': '20180101T080000Z', 'end': '20180101T090000Z',
+                 'summary': u'Caf\xe9, ' * 20, 'description': 'a;b'}
+        content = calendar('CANCEL', [event], 'agent@example.com')
+        lines = content.split('\r\n')
+        self.assertTrue(all(len(line) <= 75 for line in lines))
+        self.assertIn('DESCRIPTION:a\\;b', lines)
+        self.assertIn('STATUS:CANCELLED', lines)
+        self.assertEqual(''.join(line[1:] if line.startswith(' ') else line
+                                 for line in lines).decode('utf-8')
+                         .count(u'Caf\xe9\\,'), 20)
+
+    def test_cold_start(self):
+        """ Testing that a production instance starts without loading
+        the provider SDKs nor the admin pages, which load on first use.
+
+        """
+        script = ('import sys\n'
+                  'from my_app import app\n'
+                  'print(sorted(sys.modules))\n'
+                  'print(app.test_client().get("/admin/").status_code)\n'
+                  'print(sorted(sys.modules))\n')
+        environ = dict(os.environ, APP_ENV='production',
+                       DATABASE_URI='sqlite:///test.db')
+        output = subprocess.check_output([sys.executable, '-c', script],
+                                         env=environ,
+                                         stderr=open(os.devnull, 'w'))
+        on_start, status, after_admin = output.strip().split('\n')[-3:]
+        for module in ('twilio.rest', 'requests', 'flask_admin'):
+            self.assertNotIn("'%s'" % module, on_start)
+        self.assertEqual(status, '200')
+        self.assertIn("'flask_admin'", after_admin)
+
+    def test_engine_config(self):
+        """ Testing that:
+        - production uses Cloud SQL with the pool settings of the environment
+        - the pool records the waits for a connection
+
+        """
+        environ = {'APP_ENV': 'production', 'CLOUDSQL_USER': 'user',
+                   'CLOUDSQL_PASSWORD': 'p@ss', 'CLOUDSQL_DATABASE': 'apt',
+                   'CLOUDSQL_CONNECTION_NAME': 'project:region:sql',
+                   'DB_POOL_SIZE': '5'}
+        config = database_config(current_environment(environ), environ)
+        self.assertEqual(config['SQLALCHEMY_DATABASE_URI'],
+                         'mysql+mysqldb://user:p%40ss@/apt'
+                         '?unix_socket=/cloudsql/project:region:sql')
+        self.assertEqual(config['SQLALCHEMY_POOL_SIZE'], 5)
+        self.assertEqual(config['SQLALCHEMY_POOL_RECYCLE'], 1800)
+        del environ['CLOUDSQL_PASSWORD']
+        self.assertRaises(RuntimeError, database_config, 'production', environ)
+        # the test database is in the package, wherever the app runs from
+        self.assertEqual(database_config('test', {})['SQLALCHEMY_DATABASE_URI'],
+                         'sqlite:///' + os.path.join(
+                             os.path.dirname(os.path.abspath(__file__)),
+                             'my_app', 'test.db'))
+        engine = create_engine('sqlite://', poolclass=TimedQueuePool,
+                               pool_size=1, max_overflow=0, pool_timeout=0.1)
+        connection = engine.connect()
+        self.assertEqual(pool_stats(engine)['checked_out'], 1)
+        self.assertRaises(TimeoutError, engine.connect)
+        connection.close()
+        stats = pool_stats(engine)
+        self.assertEqual((stats['checked_out'], stats['waits'],
+                          stats['timeouts']), (0, 2, 1))
+        self.assertGreater(stats['max_wait_seconds'], 0.05)
+
+    def test_generate_appointments(self):
+        """ Testing that the daily generation of appointments
+        does not create the same slot twice.
+
+        """
+        self.app=app.test_client()
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///test.db'
+        response = self.app.get('/cron/add_appointments')
+        self.assertEqual(response.status_code,201)
+        response = self.app.get('/cron/add_appointments')
+        self.assertEqual(response.status_code,201)
+        self.assertEqual(response.data, '0 appointments added')
+        # without a reliable row count, a slot another process added
+        # between the read and the insert is not counted twice
+        with app.app_context():
+            user = user_datastore.create_user(email='racing.agent@example.com',
+                                              password='pwd', name='Racing',
+                                              branch_id=1)
+            user_datastore.add_role_to_user(user, 'end-user')
+            user.services.append(Services.query.filter_by(
+                name=what).first())
+            db.session.commit()
+            user_id = user.id
+            table = Appointment.__table__
+            def racing_insert(conn, clauseelement, multiparams, params):
+                if (getattr(clauseelement, 'table', None) is table
+                        and multiparams and len(multiparams[0]) > 1
+                        and not raced):
+                    raced.append(True)
+                    row = multiparams[0][0]
+                    conn.execute(table.insert(), row)
+                    record_changes({(row['user_id'], row['date']): 1})
+            raced = []
+            dialect = db.engine.dialect
+            event.listen(db.engine, 'before_execute', racing_insert)
+            dialect.supports_sane_multi_rowcount = False
+            try:
+                self.assertTrue(generate_appointments([user_id]) > 0)
+                self.assertTrue(raced)
+                self.assertEqual(check_availability(), [])
+            finally:
+                dialect.supports_sane_multi_rowcount = True
+                event.remove(db.engine, 'before_execute', racing_insert)
+                Appointment.query.filter_by(user_id=user_id).delete()
+                user_datastore.delete_user(User.query.get(user_id))
+                db.session.commit()
+                rebuild_availability()
+
+    def test_archive_appointments(self):
+        """ Testing that the past bookings are archived and the past slots
+        purged, in bounded batches, the days to come being left as they are.
+
+        """
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///test.db'
+        past = datetime.date.today() - datetime.timedelta(days=10)
+        with app.app_context():
+            to_come = Appointment.query.count()
+            rows = [{'user_id': 4, 'date': past,
+                     'time': datetime.time(8 + hour, 0),
+                     'bookable_booked': status, 'topic': what,
+                     'booked_by_name': None, 'booked_by_phone': None}
+                    for hour, status in enumerate(['bookable', 'tbd',
+                                                   'booked', 'booked',
+                                                   'bookable'])]
+            rows[2].update(booked_by_name='test user',
+                           booked_by_phone='+15550006666')
+            db.session.execute(Appointment.__table__.insert(), rows)
+            db.session.commit()
+            rebuild_availability()
+            stats = archive_appointments(batch_size=1, max_batches=1)
+            self.assertFalse(stats['complete'])
+            self.assertEqual(stats['archived'], 1)
+            stats = archive_appointments()
+            self.assertTrue(stats['complete'])
+            self.assertEqual(stats['archived'], 1)
+            self.assertEqual(stats['slots_purged'], 2)
+            self.assertEqual(Appointment.query.count(), to_come)
+            archived = (AppointmentArchive.query
+                        .filter_by(booked_by_phone='+15550006666').one())
+            self.assertEqual(archived.date, past)
+            self.assertEqual(archived.booked_by_name, 'test user')
+            self.assertEqual(archive_appointments()['archived'], 0)
+            self.assertEqual(check_availability(), [])
+
+    def test_availability_summary(self):
+        """ Testing that the availability summary stays in line with
+        the appointments through bookings, toggles and cancellations.
+
+        """
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///test.db'
+        app.config['OUTBOX_DISPATCH'] = 'none'
+        phone_number = '+15550008888'
+        tomorrow = datetime.date.today() + datetime.timedelta(days=1)
+        with app.app_context():
+            self.assertEqual(check_availability(), [])
+            first, second = (Appointment.query
+                             .filter(Appointment.bookable_booked == 'bookable')
+                             .filter(Appointment.date > tomorrow)
+                             .filter_by(user_id=4)
+                             .limit(2).all())
+            self.assertEqual(create_appointment(first.user_id, first.date,
+                                                first.time, phone_number,
+                                                what, 'test user'),
+                             'all_good')
+            self.assertEqual(check_availability(), [])
+            item = {'user_id': second.user_id,
+                    'date': second.date.strftime('%Y-%m-%d'),
+                    'time': second.time.strftime('%H:%M:%S')}
+            toggle_appointments([dict(item, status='bookable')])
+            self.assertEqual(check_availability(), [])
+            cancel_appointments(phone_number)
+            toggle_appointments([dict(item, status='tbd')])
+            self.assertEqual(check_availability(), [])
+            self.assertIn(what, query_available_services(10))
+
+    def test_api(self):
+        """ Testing the JSON API and its conditional GET. """
+        self.app=app.test_client()
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///test.db'
+        app.config['OUTBOX_DISPATCH'] = 'none'
+        response = self.app.get('/api/v1/services')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(what, json.loads(response.data)['services'])
+        etag = response.headers['ETag']
+        self.assertIn('max-age', response.headers['Cache-Control'])
+        response = self.app.get('/api/v1/services',
+                                headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, '')
+        # the days offered change at midnight, so do the ETags
+        from my_app import api
+        funnel_today = api.funnel_today
+        api.funnel_today = lambda: funnel_today() + datetime.timedelta(days=1)
+        try:
+            response = self.app.get('/api/v1/services',
+                                    headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 200)
+        finally:
+            api.funnel_today = funnel_today
+        response = self.app.get('/api/v1/markets?service=' + what)
+        self.assertIn(where, json.loads(response.data)['markets'])
+        response = self.app.get('/api/v1/days')
+        self.assertEqual(response.status_code, 400)
+        response = self.app.get('/api/v1/days?service=%s&market=%s'
+                                % (what, where))
+        day = json.loads(response.data)['days'][0]
+        response = self.app.get('/api/v1/slots?service=%s&market=%s&date=%s'
+                                % (what, where, day))
+        branches = json.loads(response.data)['branches']
+        self.assertTrue(branches[0]['days'][day])
+        # any change of the availability makes the ETags stale
+        with app.app_context():
+            version = availability_version()
+            appointment = (Appointment.query
+                           .filter(Appointment.bookable_booked == 'bookable')
+                           .filter_by(user_id=3).first())
+            item = {'user_id': appointment.user_id,
+                    'date': appointment.date.strftime('%Y-%m-%d'),
+                    'time': appointment.time.strftime('%H:%M:%S')}
+            toggle_appointments([dict(item, status='bookable')])
+            self.assertEqual(availability_version(), version + 1)
+        response = self.app.get('/api/v1/services',
+                                headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        with app.app_context():
+            toggle_appointments([dict(item, status='tbd')])
+
+    def test_calendar_feed(self):
+        """ Testing the calendar feeds of an agent and of a manager,
+        and their conditional GET.
+
+        """
+        self.app=app.test_client()
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///test.db'
+        app.config['OUTBOX_DISPATCH'] = 'none'
+        phone_number = '+15550007777'
+        with app.test_request_context():
+            agent_url = calendar_url(User.query.get(7))
+            manager_url = calendar_url(User.query.get(2))
+            # the admin has no feed, showing the URL writes nothing
+            self.assertIsNone(calendar_url(User.query.get(1)))
+            self.assertFalse(db.session.dirty)
+        agent_path = agent_url.split('localhost', 1)[1]
+        manager_path = manager_url.split('localhost', 1)[1]
+        response = self.app.get(agent_path)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.mimetype == 'text/calendar')
+        self.assertTrue(response.data.startswith('BEGIN:VCALENDAR'))
+        etag = response.headers['ETag']
+        modified = response.headers['Last-Modified']
+        response = self.app.get(agent_path, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, '')
+        response = self.app.get(agent_path,
+                                headers={'If-Modified-Since': modified})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(self.app.get('/calendar/unknown.ics').status_code,
+                         404)
+        # a booking changes the feeds of the agent and of the manager
+        manager_etag = self.app.get(manager_path).headers['ETag']
+        with app.app_context():
+            appointment = (Appointment.query
+                           .filter(Appointment.bookable_booked == 'bookable')
+                           .filter(Appointment.date > datetime.date.today())
+                           .filter_by(user_id=7).first())
+            self.assertEqual(create_appointment(
+                appointment.user_id, appointment.date, appointment.time,
+                phone_number, what, 'Feed Customer'), 'all_good')
+            appointment_id = appointment.id
+        try:
+            response = self.app.get(agent_path,
+                                    headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('UID:booking-%s-' % appointment_id, response.data)
+            response = self.app.get(manager_path,
+                                    headers={'If-None-Match': manager_etag})
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('Feed Customer', response.data)
+        finally:
+            with app.app_context():
+                cancel_appointments(phone_number)
+        response = self.app.get(agent_path)
+        self.assertNotIn('Feed Customer', response.data)
+
+    def test_backfill_slots(self):
+        """ Testing that reading the calendar of a new agent
+        does not create appointments, the backfill does.
+
+        """
+        self.app=app.test_client()
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///test.db'
+        self.app.get('/thanks')
+        with app.app_context():
+            user = user_datastore.create_user(email='new.agent@example.com',
+                                              password='pwd', name='New Agent',
+                                              branch_id=1)
+            user_datastore.add_role_to_user('new.agent@example.com', 'end-user')
+            db.session.commit()
+            user_id = user.id
+            try:
+                self.assertEqual(query_user_appointment(user_id)['user_apt'], [])
+                self.assertEqual(Appointment.query
+                                 .filter_by(user_id=user_id).count(), 0)
+                response = self.app.get('/cron/backfill_slots')
+                self.assertEqual(response.status_code, 201)
+                self.assertNotEqual(response.data, '0 appointments added')
+                response = self.app.get('/cron/backfill_slots')
+                self.assertEqual(response.data, '0 appointments added')
+            finally:
+                Appointment.query.filter_by(user_id=user_id).delete()
+                user_datastore.delete_user(User.query.get(user_id))
+                db.session.commit()
+
+    def test_cache(self):
+        """ Testing that the cache:
+        - evicts the least recently used entries
+        - is emptied by an invalidation
+
+        """
+        backend = MemoryBackend(max_size=2, ttl=60)
+        backend.set('a', 1)
+        backend.set('b', 2)
+        backend.get('a')
+        backend.set('c', 3)
+        self.assertEqual(backend.get('a'), 1)
+        self.assertIsNone(backend.get('b'))
+        calls = []
+        cache = Cache('test')
+        @cache.memoize('double')
+        def double(x):
+            calls.append(x)
+            return 2 * x
+        with app.app_context():
+            self.assertEqual(double(2), 4)
+            self.assertEqual(double(2), 4)
+            self.assertEqual(len(calls), 1)
+            cache.invalidate()
+            self.assertEqual(double(2), 4)
+            self.assertEqual(len(calls), 2)
+
+    def test_reminders(self):
+        """ Testing that running the reminders twice
+        does not remind a customer twice.
+
+        """
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///test.db'
+        app.config['NOTIFICATION_TRANSPORT'] = 'stub'
+        app.test_client().get('/thanks')
+        time_zone = 'Pacific/Honolulu'
+        tomorrow = (datetime.datetime.now(pytz.timezone(time_zone)).date()
+                    + datetime.timedelta(days=1))
+        phone_number = '+15550009999'
+        with app.app_context():
+            slot = (Appointment.query
+                    .filter(Appointment.bookable_booked == 'bookable')
+                    .filter(Appointment.date == tomorrow)
+                    .join(Appointment.user).join(User.branch)
+                    .filter(Branch.time_zone == time_zone)
+                    .first())
+            claim_appointment(slot.user_id, slot.date, slot.time,
+                              phone_number, what, 'test user')
+            db.session.commit()
+            first = send_reminder(time_zone)
+            second = send_reminder(time_zone)
+            for appointment in Appointment.query.filter_by(
+                    booked_by_phone=phone_number):
+                appointment.bookable_booked = 'bookable'
+                appointment.booked_by_name = None
+                appointment.booked_by_phone = None
+                appointment.active_phone = None
+                appointment.booked_at = None
+            db.session.commit()
+            rebuild_availability()
+        self.assertGreaterEqual(first['queued'], 1)
+        self.assertEqual(second['queued'], 0)
+        self.assertEqual(second['sent'], 0)
+
+    def test_query_budget(self):
+        """ Testing that the customer pages run at most a few queries
+        once the option lists are cached, and report them.
+
+        """
+        self.app=app.test_client()
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///test.db'
+        self.app.get('/thanks')
+        budgets = [('/', 1),
+                   ('/where/' + what, 1),
+                   ('/when/' + what + '/' + where, 1),
+                   ('/book/' + test_url, 3)]
+        for url, budget in budgets:
+            self.app.get(url)
+            with query_budget(budget):
+                response = self.app.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('db;dur=', response.headers['Server-Timing'])
+
+    def test_reminder_time_zones(self):
+        """ Testing that reminders are only sent during the day,
+        in the time zone of every branch.
+
+        """
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///test.db'
+        app.test_client().get('/thanks')
+        # noon in Honolulu, 8 am the next day in Saipan
+        now = pytz.utc.localize(datetime.datetime(2018, 1, 1, 22, 0))
+        with app.app_context():
+            due = due_time_zones(now)
+        self.assertEqual(due, {'Pacific/Honolulu': datetime.date(2018, 1, 2)})
+
+    def test_seed(self):
+        """ Testing that:
+        - seeding again adds nothing
+        - starting an instance writes nothing to the database
+
+        """
+        with app.app_context():
+            report = seed()
+        self.assertEqual(sum(report.values()), 0)
+        self.assertEqual([function for function in app.before_first_request_funcs
+                          if function.__module__.startswith('my_app')], [])
+
+    def test_slot_schedule(self):
+        """ Testing that a template with 30 minutes slots, closed on
+        week-ends and on a holiday, is compiled into the right slots.
+
+        """
+        template = SlotTemplate(slot_minutes=30,
+                                opening_time=datetime.time(9, 0),
+                                closing_time=datetime.time(12, 0),
+                                closed_weekdays='5,6',
+                                horizon_days=14)
+        monday = datetime.date(2018, 1, 1)
+        holiday = datetime.date(2018, 1, 2)
+        schedule = compile_template(template, holidays=[holiday])
+        self.assertEqual(schedule.slot_times[0], datetime.time(9, 0))
+        self.assertEqual(schedule.slot_times[-1], datetime.time(11, 30))
+        days = schedule.days(monday)
+        self.assertEqual(len(days), 9)
+        self.assertNotIn(holiday, days)
+        self.assertEqual(len(schedule.slots(monday)), 9 * 6)
+        template.slot_minutes = 0
+        self.assertEqual(compile_template(template).slot_times, ())
+
+    def test_resync_slots(self):
+        """ Testing that the slots nobody booked follow the changes of
+        templates and holidays, and that invalid templates are rejected.
+
+        """
+        self.app=app.test_client()
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///test.db'
+        app.config['OUTBOX_DISPATCH'] = 'none'
+        phone_number = '+15550004444'
+        self.app.post('/login', data={'email': 'admin@example.com',
+                                      'password': 'pwd'})
+        response = self.app.post('/admin/slottemplate/new/', data={
+            'user': '4', 'opening_time': '08:00', 'closing_time': '16:00',
+            'slot_minutes': '0', 'closed_weekdays': 'sat',
+            'horizon_days': '15'})
+        self.assertEqual(response.status_code, 200)
+        response = self.app.post('/admin/slottemplate/new/', data={
+            'opening_time': '08:00', 'closing_time': '16:00',
+            'slot_minutes': '30', 'closed_weekdays': '5,6',
+            'horizon_days': '15'})
+        self.assertIn('A template needs a branch or a user', response.data)
+        self.app.get('/logout')
+        with app.app_context():
+            self.assertEqual(SlotTemplate.query.count(), 0)
+            agent = User.query.get(4)
+            days = sorted(set(day for (day,) in db.session.query(
+                Appointment.date).filter(Appointment.user_id == 4)
+                .filter(Appointment.date > datetime.date.today())))
+            closed_day, other_day = days[0], days[1]
+            booked = Appointment.query.filter_by(user_id=4,
+                                                 date=closed_day).first()
+            self.assertEqual(create_appointment(
+                4, closed_day, booked.time, phone_number, what,
+                'Holiday Customer'), 'all_good')
+            holiday = Holiday(date=closed_day, branch_id=agent.branch_id)
+            template = SlotTemplate(user_id=4, slot_minutes=30,
+                                    opening_time=datetime.time(8, 0),
+                                    closing_time=datetime.time(16, 0),
+                                    closed_weekdays='', horizon_days=15)
+            db.session.add_all([holiday, template])
+            db.session.commit()
+            try:
+                resync_slots([4])
+                rebuild_availability()
+                on_closed_day = Appointment.query.filter_by(
+                    user_id=4, date=closed_day).all()
+                self.assertEqual([apt.bookable_booked
+                                  for apt in on_closed_day], ['booked'])
+                self.assertEqual(Appointment.query.filter_by(
+                    user_id=4, date=other_day).count(), 16)
+                self.assertEqual(check_availability(), [])
+            finally:
+                cancel_appointments(phone_number)
+                db.session.delete(Holiday.query.get(holiday.id))
+                db.session.delete(SlotTemplate.query.get(template.id))
+                db.session.commit()
+                resync_slots([4])
+                rebuild_availability()
+            self.assertEqual(Appointment.query.filter_by(
+                user_id=4, date=other_day).count(), 8)
+            self.assertEqual(Appointment.query.filter_by(
+                user_id=4, date=closed_day).count(), 8)
+            self.assertEqual(check_availability(), [])
+
+    def test_admin_appointments(self):
+        """ Testing that a booking freed or made in the admin
+        frees or holds the phone number of the customer, and updates
+        the availability summary without rebuilding it.
+
+        """
+        self.app=app.test_client()
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///test.db'
+        app.config['OUTBOX_DISPATCH'] = 'none'
+        phone_number = '+15550005555'
+        def edit(slot, status, phone):
+            apt_id, apt_date, apt_time = slot
+            return self.app.post(
+                '/admin/appointment/edit/?id=%s' % apt_id,
+                data={'user': '4',
+                      'date': apt_date.strftime('%Y-%m-%d'),
+                      'time': apt_time.strftime('%H:%M:%S'),
+                      'bookable_booked': status,
+                      'booked_by_phone': phone or '',
+                      'booked_by_name': 'Admin Customer' if phone else '',
+                      'topic': what if phone else ''})
+        with app.app_context():
+            first, second = (db.session.query(Appointment.id,
+                                              Appointment.date,
+                                              Appointment.time)
+                             .filter_by(bookable_booked='bookable', user_id=4)
+                             .filter(Appointment.date
+                                     > datetime.date.today())
+                             .order_by(Appointment.date, Appointment.time)
+                             .limit(2).all())
+            self.assertEqual(create_appointment(
+                4, first.date, first.time, phone_number, what,
+                'Admin Customer'), 'all_good')
+        self.app.post('/login', data={'email': 'admin@example.com',
+                                      'password': 'pwd'})
+        rebuilds = []
+        rebuild = admin.rebuild_availability
+        admin.rebuild_availability = lambda: rebuilds.append(1)
+        try:
+            edit(first, 'bookable', None)
+            with app.app_context():
+                self.assertEqual(check_availability(), [])
+                self.assertIsNone(Appointment.query.get(first.id)
+                                  .active_phone)
+                self.assertEqual(create_appointment(
+                    4, second.date, second.time, phone_number, what,
+                    'Admin Customer'), 'all_good')
+                cancel_appointments(phone_number)
+            edit(first, 'booked', phone_number)
+            with app.app_context():
+                self.assertEqual(check_availability(), [])
+                self.assertEqual(Appointment.query.get(first.id)
+                                 .active_phone, phone_number)
+                self.assertEqual(create_appointment(
+                    4, second.date, second.time, phone_number, what,
+                    'Admin Customer'), 'customer_has_appointment')
+            self.assertEqual(rebuilds, [])
+        finally:
+            admin.rebuild_availability = rebuild
+            self.app.get('/logout')
+            with app.app_context():
+                cancel_appointments(phone_number)
+                self.assertEqual(check_availability(), [])
+
+    def test_toggle_appointments(self):
+        """ Testing that the agents can switch several slots at once,
+        and that the invalid slots are reported.
+
+        """
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///test.db'
+        app.test_client().get('/thanks')
+        with app.app_context():
+            slots = [{'date': apt.date.strftime('%Y-%m-%d'),
+                      'time': apt.time.strftime('%H:%M:%S'),
+                      'user_id': apt.user_id,
+                      'status': 'bookable'}
+                     for apt in Appointment.query
+                     .filter_by(bookable_booked='bookable', user_id=4)
+                     .limit(3)]
+            invalid = [{'date': 'tomorrow', 'time': '10:00:00',
+                        'user_id': 4, 'status': 'bookable'},
+                       {'date': '1999-01-01', 'time': '10:00:00',
+                        'user_id': 4, 'status': 'bookable'}]
+            result = toggle_appointments(slots + invalid)
+            self.assertEqual(result['changed'], 3)
+            self.assertEqual(result['skipped'], invalid)
+            for slot in slots:
+                slot['status'] = 'tbd'
+            result = toggle_appointments(slots)
+            self.assertEqual(result['changed'], 3)
+            self.assertEqual(result['skipped'], [])
+            # more items than SQLite takes in one expression
+            slots = [{'date': apt.date.strftime('%Y-%m-%d'),
+                      'time': apt.time.strftime('%H:%M:%S'),
+                      'user_id': apt.user_id,
+                      'status': 'bookable'}
+                     for apt in Appointment.query
+                     .filter_by(bookable_booked='bookable', user_id=4)]
+            missing = [{'date': '2099-01-%02d' % (day + 1),
+                        'time': '%02d:%02d:00' % (hour, minute),
+                        'user_id': 4, 'status': 'bookable'}
+                       for day in range(20) for hour in range(12)
+                       for minute in range(0, 60, 12)]
+            result = toggle_appointments(slots + missing)
+            self.assertGreater(len(slots + missing), 1000)
+            self.assertEqual(result['changed'], len(slots))
+            self.assertEqual(len(result['skipped']), len(missing))
+            for slot in slots:
+                slot['status'] = 'tbd'
+            result = toggle_appointments(slots)
+            self.assertEqual(result['changed'], len(slots))
+            self.assertEqual(check_availability(), [])
+
+    def test_upgrade(self):
+        """ Testing that the database upgrade can be run repeatedly
+        and leaves every index of the data model in place.
+
+        """
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///test.db'
+        with app.app_context():
+            # an agent of an older database has no calendar token
+            User.query.filter_by(id=6).update({'calendar_token': None})
+            db.session.commit()
+            self.assertEqual(upgrade()['calendar_tokens_filled'], 1)
+            self.assertIsNotNone(User.query.get(6).calendar_token)
+            report = upgrade()
+        self.assertEqual(report['calendar_tokens_filled'], 0)
+        self.assertEqual(report['indexes_created'], [])
+        self.assertEqual(report['duplicate_slots_removed'], 0)
+
 if __name__ == "__main__":
     unittest.main()
 